@@ -14,6 +14,7 @@ import logging
 from logging import config as logconfig
 import os
 from pathlib import Path
+import sys
 from dotenv import load_dotenv
 
 
@@ -31,6 +32,8 @@ SECRET_KEY = os.environ["BADPYTHON_SECRET_KEY"]
 
 ENVIRONMENT = os.environ["BADPYTHON_ENV"]
 
+TESTING = sys.argv[1:2] == ["test"]
+
 # SECURITY WARNING: don't run with debug turned on in production!
 if ENVIRONMENT == "dev":
     DEBUG = True
@@ -55,35 +58,155 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "posts.middleware.set_client_ip",
+    "posts.middleware.profile_requests",
+    # reject over-limit clients before loading sessions or checking CSRF
+    "posts.middleware.rate_limit",
+    "posts.middleware.replica_reads",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "posts.middleware.set_client_ip",
-    "ratelimit.middleware.RatelimitMiddleware",
 ]
 
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 
 RATELIMIT_ENABLE = True
 RATELIMIT_VIEW = "posts.views.ratelimited"
-RATELIMIT_USE_CACHE = "default"
+# per client ip, counted in the default cache, so across the workers that
+# share it; only the pages limited before the middleware are
+RATELIMIT_RATE = os.environ.get("RATELIMIT_RATE", "5/s")
+RATELIMIT_METHODS = ("GET",)
+RATELIMIT_VIEWS = ("index", "submit", "suggest")
+
+
+# "unseen" serves each session posts it has not viewed yet, "random" ignores
+# what the session has seen
+RANDOM_POST_MODE = os.environ.get("RANDOM_POST_MODE", "unseen")
+
+# Serve the index from a queue of random approved posts each worker fetches
+# ahead in batches, falling back to a query when it has none to give. Queued
+# posts are dropped once approvals change (checked every
+# RANDOM_FEED_CHECK_INTERVAL seconds) or after RANDOM_FEED_MAX_AGE seconds.
+RANDOM_FEED = os.environ.get("RANDOM_FEED", "off") == "on"
+RANDOM_FEED_SIZE = int(os.environ.get("RANDOM_FEED_SIZE", "500"))
+RANDOM_FEED_BATCH_SIZE = int(os.environ.get("RANDOM_FEED_BATCH_SIZE", "100"))
+RANDOM_FEED_CHECK_INTERVAL = float(os.environ.get("RANDOM_FEED_CHECK_INTERVAL", "1.0"))
+RANDOM_FEED_MAX_AGE = float(os.environ.get("RANDOM_FEED_MAX_AGE", "60"))
+
+
+# Buffer votes in each worker and write them in batches, answering with
+# optimistic counts. Buffered votes are flushed on worker exit.
+VOTE_BUFFER = os.environ.get("VOTE_BUFFER", "off") == "on"
+VOTE_BUFFER_FLUSH_INTERVAL = float(os.environ.get("VOTE_BUFFER_FLUSH_INTERVAL", "1.0"))
+VOTE_BUFFER_MAX_PENDING = int(os.environ.get("VOTE_BUFFER_MAX_PENDING", "500"))
+
+# Route the index, suggestion and vote pages to posts.async_views. Only
+# worth it under the ASGI server, which gunicorn.conf.py turns this on for;
+# under WSGI each async view would run in an event loop of its own.
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS", "off") == "on"
+
+
+# Where cached data and sessions live. "locmem" keeps them per process.
+# "shm" shares them between the workers of a host through files on
+# /dev/shm (CACHE_DIR), which need about 128 MiB with the sizes below, more
+# than Docker's default shm_size, see docker-compose.prod.yaml. "redis"
+# shares them across hosts.
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "locmem")
+
+if CACHE_BACKEND == "redis":
+    redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": redis_url,
+        },
+        "sessions": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": redis_url,
+            "KEY_PREFIX": "sessions",
+        },
+    }
+elif CACHE_BACKEND == "shm":
+    cache_dir = os.environ.get("CACHE_DIR", "/dev/shm/badpython-cache")
+    CACHES = {
+        "default": {
+            "BACKEND": "posts.cache.MmapCache",
+            "LOCATION": os.path.join(cache_dir, "default"),
+            "OPTIONS": {
+                "slots": int(os.environ.get("CACHE_SLOTS", "16384")),
+                "slot_size": int(os.environ.get("CACHE_SLOT_SIZE", "4096")),
+            },
+        },
+        # one slot per session, so sized for many small entries
+        "sessions": {
+            "BACKEND": "posts.cache.MmapCache",
+            "LOCATION": os.path.join(cache_dir, "sessions"),
+            "OPTIONS": {
+                "slots": int(os.environ.get("SESSION_CACHE_SLOTS", "131072")),
+                "slot_size": int(os.environ.get("SESSION_CACHE_SLOT_SIZE", "512")),
+            },
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+        "sessions": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "sessions",
+        },
+    }
 
 
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-    }
-}
+# Submitted code is parsed in a pool of this many processes per worker,
+# or inline when 0. Longer submissions are rejected before parsing.
+VALIDATION_WORKERS = int(os.environ.get("VALIDATION_WORKERS", "2"))
+VALIDATION_TIMEOUT = float(os.environ.get("VALIDATION_TIMEOUT", "2.0"))
+VALIDATION_MAX_SIZE = int(os.environ.get("VALIDATION_MAX_SIZE", "20000"))
+
+
+# Share of requests whose queries and template rendering are profiled, see
+# /internal/profile. Every request is timed, and logged when slower than
+# PROFILE_SLOW_REQUEST_MS.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get("PROFILE_SLOW_REQUEST_MS", "500"))
+
+
+# Each process writes its metrics to a file in this directory, see
+# posts.metrics. Scrapers must send METRICS_TOKEN as a bearer token when
+# it is set; nginx does not pass /internal/metrics through either way.
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", None if TESTING else "/dev/shm/badpython-metrics")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
+# Cached post markup is keyed on this, bump it when that markup changes.
+POST_FRAGMENT_VERSION = 2
+
+
+# Sessions are kept in the "sessions" cache, in a compact binary encoding.
+# "django.contrib.sessions.backends.signed_cookies" works with the same
+# serializer and keeps them out of the server entirely. A per-process cache
+# would lose them whenever a request lands on another worker, so with
+# "locmem" they stay in the database, except in the tests.
+SESSION_ENGINE = os.environ.get(
+    "SESSION_ENGINE",
+    "django.contrib.sessions.backends.db"
+    if CACHE_BACKEND == "locmem" and not TESTING else "posts.sessions")
+SESSION_CACHE_ALIAS = "sessions"
+SESSION_SERIALIZER = "posts.sessions.CompactSerializer"
 
 
 ROOT_URLCONF = "badpython.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # times template rendering for posts.middleware.profile_requests
+        "BACKEND": "posts.profiler.ProfiledTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -144,17 +267,56 @@ db_name = os.environ["DB_NAME"]
 db_host = os.environ["DB_HOST"]
 db_port = os.environ["DB_PORT"]
 
+# Connections are pooled in each worker process by posts.pooled_postgres
+# rather than opened for every request; see posts.db_pool. A worker holds
+# at most DB_POOL_SIZE connections, so Postgres' max_connections must be
+# above the number of workers times that, and a request waits up to
+# DB_POOL_TIMEOUT seconds for a free one. Connections idle for longer than
+# DB_POOL_CHECK_AFTER seconds are checked before use, and ones older than
+# DB_POOL_MAX_LIFETIME are replaced. DB_POOL=off connects per request.
+#
+# Behind pgbouncer in transaction mode, as in docker-compose.yaml, set
+# DB_PGBOUNCER=on: each transaction may get a different server connection,
+# which server-side cursors don't survive, so they are turned off.
+DB_POOL = os.environ.get("DB_POOL", "on") == "on"
+
 db = {
-    "ENGINE": "django.db.backends.postgresql_psycopg2",
+    "ENGINE": "posts.pooled_postgres" if DB_POOL else "django.db.backends.postgresql_psycopg2",
     "NAME": db_name,
     "USER": db_user,
     "PASSWORD": db_pass,
     "HOST": db_host,
     "PORT": db_port,
+    "DISABLE_SERVER_SIDE_CURSORS": os.environ.get("DB_PGBOUNCER", "off") == "on",
+    "POOL": {
+        "SIZE": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "TIMEOUT": float(os.environ.get("DB_POOL_TIMEOUT", "5")),
+        "CHECK_AFTER": float(os.environ.get("DB_POOL_CHECK_AFTER", "30")),
+        "MAX_LIFETIME": float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800")),
+    },
 }
 
 DATABASES = {"default": db}
 
+# Read replicas of the database, as comma separated host:port pairs. GET
+# and HEAD requests read from one of them, other requests from the primary,
+# see posts.routers. A client that made any other request reads from the
+# primary for REPLICA_PIN_SECONDS after, so it sees its own writes. A
+# replica that can't be reached is skipped for REPLICA_RETRY_SECONDS, and
+# one more than REPLICA_MAX_LAG seconds behind, measured every
+# REPLICA_LAG_CHECK_SECONDS, until it catches up.
+for i, replica in enumerate(r for r in os.environ.get("DB_REPLICAS", "").split(",") if r.strip()):
+    replica_host, _, replica_port = replica.strip().partition(":")
+    DATABASES["replica_%s" % i] = dict(
+        db, HOST=replica_host, PORT=replica_port or db_port, TEST={"MIRROR": "default"})
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = ["posts.routers.ReplicaRouter"]
+REPLICA_PIN_SECONDS = int(os.environ.get("REPLICA_PIN_SECONDS", "10"))
+REPLICA_RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS", "30"))
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", "5"))
+REPLICA_LAG_CHECK_SECONDS = float(os.environ.get("REPLICA_LAG_CHECK_SECONDS", "5"))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
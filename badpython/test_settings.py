@@ -0,0 +1,33 @@
+"""
+Settings to run the tests against two local SQLite databases instead of
+Postgres, the second standing in for a read replica:
+
+    DJANGO_SETTINGS_MODULE=badpython.test_settings python manage.py test
+
+The replica is a database of its own rather than a test mirror of the
+primary, so a test can tell which one a query went to. No reads go to it
+unless a test turns on DATABASE_REPLICAS. Both live in the temp directory,
+out of the source tree.
+"""
+import os
+import tempfile
+
+for name in ("BADPYTHON_SECRET_KEY", "DB_USER", "DB_PASS", "DB_NAME", "DB_HOST", "DB_PORT"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("BADPYTHON_ENV", "test")
+
+from .settings import *
+
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(tempfile.gettempdir(), "badpython-test-default.sqlite3"),
+    },
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(tempfile.gettempdir(), "badpython-test-replica.sqlite3"),
+    },
+}
+
+DATABASE_REPLICAS = []
@@ -1,9 +1,56 @@
 import multiprocessing
+import os
 
 bind = "0.0.0.0:8000"
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "gevent"
-worker_connections = 500 
+
+# GUNICORN_SERVER=uvicorn serves the ASGI application from an event loop
+# in each worker, with the async views, instead of the WSGI application
+# from monkeypatched gevent greenlets
+server = os.environ.get("GUNICORN_SERVER", "gevent")
+if server == "uvicorn":
+    wsgi_app = "badpython.asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    # read by the settings in each worker
+    os.environ.setdefault("ASYNC_VIEWS", "on")
+elif server == "gevent":
+    wsgi_app = "badpython.wsgi:application"
+    worker_class = "gevent"
+    worker_connections = 500
+else:
+    raise ValueError("GUNICORN_SERVER must be gevent or uvicorn, not %r" % server)
+
 loglevel = "INFO"
 capture_output = True
-accesslog = "-"
\ No newline at end of file
+accesslog = "-"
+
+
+# the hooks that run in the arbiter load the settings without the wsgi module
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "badpython.settings")
+
+
+def on_starting(server):
+    # counters start from zero with the server
+    from posts import metrics
+    metrics.clear()
+
+
+def post_fork(server, worker):
+    from posts import metrics
+    metrics.worker_starts.inc()
+
+
+def child_exit(server, worker):
+    from posts import metrics
+    metrics.worker_exits.inc()
+
+
+def worker_exit(server, worker):
+    # write out any votes still buffered in this worker
+    from posts.vote_buffer import vote_buffer
+    vote_buffer.flush()
+    # and hang up on the database rather than leave it to notice
+    from django.db import connections
+    from posts import db_pool
+    connections.close_all()
+    db_pool.close_idle()
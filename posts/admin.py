@@ -1,11 +1,32 @@
 from django import forms
 from django.contrib import admin
 from .models import Post, Vote, Suggestion
+from .moderation import moderate_posts, moderate_suggestions
+
+
+class ModerationAdmin(admin.ModelAdmin):
+    """Bulk approve and reject actions, run through posts.moderation so
+    the catalog caches are refreshed."""
+
+    actions = ["approve", "reject"]
+    list_filter = (("approved_at", admin.EmptyFieldListFilter),)
+    moderate = None
+
+    @admin.action(description="Approve selected")
+    def approve(self, request, queryset):
+        result = self.moderate(approve=queryset.values_list("id", flat=True))
+        self.message_user(request, "Approved %s" % len(result["approved"]))
+
+    @admin.action(description="Reject selected")
+    def reject(self, request, queryset):
+        result = self.moderate(reject=queryset.values_list("id", flat=True))
+        self.message_user(request, "Rejected %s" % len(result["rejected"]))
 
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
-    pass
+class PostAdmin(ModerationAdmin):
+    list_display = ("id", "title", "pub_date", "approved_at")
+    moderate = staticmethod(moderate_posts)
 
 
 @admin.register(Vote)
@@ -14,5 +35,6 @@ class VoteAdmin(admin.ModelAdmin):
 
 
 @admin.register(Suggestion)
-class SuggestionAdmin(admin.ModelAdmin):
-    pass
+class SuggestionAdmin(ModerationAdmin):
+    list_display = ("id", "post_id", "pub_date", "approved_at")
+    moderate = staticmethod(moderate_suggestions)
@@ -0,0 +1,134 @@
+"""Async versions of the busiest views, for the ASGI server.
+
+With ASYNC_VIEWS on, posts.urls routes the index, suggestion and vote
+pages here instead of to posts.views. Each view keeps the behaviour of the
+one it extends and only swaps its I/O: queries go through the async ORM,
+while the catalog, the vote buffer, transactions and session loading still
+block on their cache or database, so they run in a thread with
+sync_to_async.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponseNotFound
+
+from . import catalog, metrics, views
+from .feed import feed
+from .models import Post, Suggestion, Vote
+from .seen import SeenSet
+from .vote_buffer import vote_buffer
+
+
+logger = logging.getLogger("posts.async_views")
+
+
+async def aget_object_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404("No %s matches the given query." % queryset.model._meta.object_name)
+
+
+async def load_session(request):
+    """Load the session off the event loop, the backend may block."""
+    await sync_to_async(request.session.keys)()
+
+
+class Index(views.Index):
+    async def get(self, request, **kwargs):
+        await load_session(request)
+        previous_id = request.GET.get("p")
+        seen = None
+        if settings.RANDOM_POST_MODE == "unseen":
+            seen = SeenSet.from_session(request.session.get("posts_seen"))
+        post = await self._arandom_post(previous_id=previous_id, seen=seen)
+        return self._respond(request, post, seen)
+
+    @classmethod
+    async def _arandom_post(cls, previous_id=None, seen=None):
+        previous_id = cls._previous_id(previous_id)
+        if settings.RANDOM_FEED:
+            post = feed.draw(exclude=previous_id, seen=seen)
+            if post is not None:
+                return post
+        # the id list may briefly lag behind deletes, so retry on a miss
+        for _ in range(3):
+            if seen is None:
+                post_id = await sync_to_async(catalog.random_post_id)(exclude=previous_id)
+            else:
+                post_id = await sync_to_async(catalog.random_unseen_post_id)(
+                    seen, exclude=previous_id)
+            if post_id is None:
+                break
+            post = await Post.objects.filter(pk=post_id).afirst()
+            if post is not None:
+                return post
+            await sync_to_async(catalog.invalidate_approved_posts)()
+        logger.info("could not get random post")
+        return None
+
+
+index = Index.as_view()
+
+
+class PostSuggestionView(views.PostSuggestionView):
+    async def get(self, request, post_id):
+        """View suggestions."""
+        post = await aget_object_or_404(Post.objects, pk=post_id)
+        ids = await sync_to_async(catalog.approved_suggestion_ids)(post.id)
+        try:
+            current_id, next_id = self._current_and_next(ids, request.GET.get("s"))
+        except LookupError:
+            return HttpResponseNotFound()
+        suggestions = {}
+        if current_id is not None:
+            suggestions = await Suggestion.objects.ain_bulk({current_id, next_id})
+        return self._render(
+            request, post, suggestions.get(current_id), suggestions.get(next_id))
+
+
+class PostSuggestionDetailView(views.PostSuggestionDetailView):
+    async def get(self, request, post_id, suggestion_id):
+        """View a specific suggestion."""
+        post = await aget_object_or_404(Post.objects, pk=post_id)
+        suggestion = await aget_object_or_404(Suggestion.objects, pk=suggestion_id)
+        return self._render(request, post, suggestion)
+
+
+class VoteView(views.VoteView):
+    async def post(self, request, post_id, **kwargs):
+        vote_field, error = self._read_vote(request)
+        if error:
+            return error
+        await load_session(request)
+        if settings.VOTE_BUFFER:
+            return await self._abuffered_vote(request, post_id, vote_field)
+        post = await aget_object_or_404(Post.objects, pk=post_id)
+        existing_vote = await self._aexisting_vote(request, post)
+        vote, previous = self._apply_vote(post, existing_vote, vote_field)
+        await sync_to_async(self._save_vote)(post, vote, previous)
+        metrics.votes.inc(buffered="false")
+        self._update_session(request, post, {"id": vote.id, "is_bad": vote.is_bad})
+        counts = await post.aget_current_vote_counts()
+        return self._vote_response(vote.id, counts['is_bad'], counts['not_bad'])
+
+    async def _abuffered_vote(self, request, post_id, vote_field):
+        post = await aget_object_or_404(
+            Post.objects.only("bad_votes", "not_bad_votes"), pk=post_id)
+        previous = request.session.get("votes", dict()).get(str(post.id))
+        vote = await sync_to_async(vote_buffer.cast)(post.id, vote_field, previous)
+        metrics.votes.inc(buffered="true")
+        bad, not_bad = vote_buffer.pending_counts(post.id)
+        self._update_session(request, post, vote)
+        return self._vote_response(
+            vote["id"], post.bad_votes + bad, post.not_bad_votes + not_bad)
+
+    async def _aexisting_vote(self, request, post):
+        vote_id = self._existing_vote_id(request, post)
+        if vote_id:
+            try:
+                return await Vote.objects.aget(pk=vote_id)
+            except Exception as e:
+                logger.exception("Could not get existing vote for id %s", vote_id)
+        return None
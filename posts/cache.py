@@ -0,0 +1,281 @@
+"""A cache backend shared by every worker process on a host.
+
+Entries live in a fixed-size hash table in a memory-mapped file, which on
+``/dev/shm`` never touches disk. Every process maps the same file, so rate
+limit counters and cached data are seen by all gunicorn workers, and ``incr``
+and ``add`` are atomic across them under an ``flock`` on the file.
+
+Each key hashes to a group of ``probes`` consecutive slots of ``slot_size``
+bytes. Values too big for a slot are written to a file beside the table and
+the slot only records that they are there.
+
+A table takes ``slots * slot_size`` bytes up front, and the overflow files
+more as they are written, so the file system needs room for every table
+on it: Docker gives containers only 64 MiB of ``/dev/shm`` unless
+``shm_size`` raises it.
+
+    CACHES = {
+        "default": {
+            "BACKEND": "posts.cache.MmapCache",
+            "LOCATION": "/dev/shm/badpython-cache",
+            "OPTIONS": {"slots": 16384, "slot_size": 4096},
+        }
+    }
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+logger = logging.getLogger("posts.cache")
+
+
+# key hash, expiry (0 for never), value length
+SLOT_HEADER = struct.Struct("<QdI")
+# value length marking a value stored in its own file
+IN_FILE = 0xFFFFFFFF
+
+
+class MmapCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._dir = location
+        self._slots = int(options.get("slots", 16384))
+        self._slot_size = int(options.get("slot_size", 4096))
+        self._probes = int(options.get("probes", 8))
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # a forked worker must not share the parent's file description,
+        # or flock would not exclude the parent
+        if self._pid == os.getpid():
+            return
+        os.makedirs(self._dir, exist_ok=True)
+        path = os.path.join(self._dir, "table")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._slots * self._slot_size
+        if os.fstat(fd).st_size != size:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.ftruncate(fd, size)
+                # take the pages now: on a full tmpfs that fails here with
+                # ENOSPC, where touching a page of a sparse file would SIGBUS
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.close(fd)
+                raise
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        # the thread lock keeps greenlets of one worker apart, flock the workers
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _hash(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def _offsets(self, h):
+        first = h % self._slots
+        for i in range(self._probes):
+            yield ((first + i) % self._slots) * self._slot_size
+
+    def _value_path(self, h):
+        return os.path.join(self._dir, "%016x.value" % h)
+
+    def _find(self, key, h):
+        """The slot offset and pickled value of a live entry, or (None, None)."""
+        now = time.time()
+        for offset in self._offsets(h):
+            slot_hash, expires, length = SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_hash != h:
+                continue
+            if expires and expires <= now:
+                return None, None
+            if length == IN_FILE:
+                try:
+                    with open(self._value_path(h), "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    return None, None
+            elif length <= self._slot_size - SLOT_HEADER.size:
+                start = offset + SLOT_HEADER.size
+                data = self._map[start:start + length]
+            else:
+                return None, None
+            try:
+                stored_key, pickled = pickle.loads(data)
+            except Exception:
+                # a slot left half written by a worker that died, a miss
+                return None, None
+            if stored_key != key:
+                return None, None
+            return offset, pickled
+        return None, None
+
+    def _store(self, key, h, pickled, timeout):
+        expires = self.get_backend_timeout(timeout) or 0
+        data = pickle.dumps((key, pickled), self.pickle_protocol)
+        now = time.time()
+        target = None
+        for offset in self._offsets(h):
+            slot_hash, slot_expires, _ = SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_hash == h:
+                target = offset
+                break
+            if target is None and (slot_hash == 0 or (slot_expires and slot_expires <= now)):
+                target = offset
+        if target is None:
+            # the group is full, evict the entry its key hashes to
+            target = next(self._offsets(h))
+        in_file = len(data) > self._slot_size - SLOT_HEADER.size
+        slot_hash, _, _ = SLOT_HEADER.unpack_from(self._map, target)
+        if slot_hash and (slot_hash != h or not in_file):
+            # drops the file of a value that had one, unless it is replaced
+            self._remove(slot_hash, target)
+        else:
+            # empty until written, so a worker dying halfway leaves a miss
+            SLOT_HEADER.pack_into(self._map, target, 0, 0, 0)
+        if in_file:
+            path = self._value_path(h)
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+            except OSError:
+                logger.warning("Could not write a %s byte value to %s", len(data), path, exc_info=True)
+                for name in (path, path + ".tmp"):
+                    try:
+                        os.remove(name)
+                    except FileNotFoundError:
+                        pass
+                return
+            SLOT_HEADER.pack_into(self._map, target, h, expires, IN_FILE)
+        else:
+            start = target + SLOT_HEADER.size
+            self._map[start:start + len(data)] = data
+            SLOT_HEADER.pack_into(self._map, target, h, expires, len(data))
+
+    def _remove(self, h, offset):
+        _, _, length = SLOT_HEADER.unpack_from(self._map, offset)
+        SLOT_HEADER.pack_into(self._map, offset, 0, 0, 0)
+        if length == IN_FILE:
+            try:
+                os.remove(self._value_path(h))
+            except FileNotFoundError:
+                pass
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        h = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key, h)
+            if offset is not None:
+                return False
+            self._store(key, h, pickled, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._locked(exclusive=False):
+            _, pickled = self._find(key, self._hash(key))
+        if pickled is None:
+            return default
+        try:
+            return pickle.loads(pickled)
+        except Exception:
+            return default
+
+    def get_many(self, keys, version=None):
+        # one lock for all of them, rather than one per key
+        made = {key: self.make_and_validate_key(key, version=version) for key in keys}
+        with self._locked(exclusive=False):
+            found = {key: self._find(made[key], self._hash(made[key]))[1] for key in keys}
+        values = {}
+        for key, pickled in found.items():
+            if pickled is None:
+                continue
+            try:
+                values[key] = pickle.loads(pickled)
+            except Exception:
+                pass
+        return values
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        with self._locked():
+            self._store(key, self._hash(key), pickled, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        h = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key, h)
+            if offset is None:
+                return False
+            _, _, length = SLOT_HEADER.unpack_from(self._map, offset)
+            expires = self.get_backend_timeout(timeout) or 0
+            SLOT_HEADER.pack_into(self._map, offset, h, expires, length)
+            return True
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        h = self._hash(key)
+        with self._locked():
+            offset, pickled = self._find(key, h)
+            if offset is None:
+                raise ValueError("Key '%s' not found" % key)
+            _, expires, _ = SLOT_HEADER.unpack_from(self._map, offset)
+            new_value = pickle.loads(pickled) + delta
+            pickled = pickle.dumps(new_value, self.pickle_protocol)
+            # keep the entry's expiry rather than resetting it
+            self._store(key, h, pickled, expires - time.time() if expires else None)
+        return new_value
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._locked(exclusive=False):
+            offset, _ = self._find(key, self._hash(key))
+        return offset is not None
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        h = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key, h)
+            if offset is None:
+                return False
+            self._remove(h, offset)
+            return True
+
+    def clear(self):
+        with self._locked():
+            self._map[:] = bytes(len(self._map))
+            for name in os.listdir(self._dir):
+                if name.endswith((".value", ".value.tmp")):
+                    os.remove(os.path.join(self._dir, name))
@@ -0,0 +1,199 @@
+import itertools
+import logging
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+
+from . import metrics
+from .models import Post, Suggestion
+from .routers import use_primary
+
+
+logger = logging.getLogger("posts.catalog")
+
+
+# (generation, count) of the approved post ids, which are cached in chunks
+# of APPROVED_POSTS_CHUNK under the generation's keys, so a request reads
+# one chunk rather than the whole list
+APPROVED_POSTS_KEY = "catalog:approved_posts"
+APPROVED_POSTS_CHUNK_KEY = "catalog:approved_post_ids:%s:%s"
+APPROVED_POSTS_CHUNK = 500
+
+APPROVED_POSTS_VERSION_KEY = "catalog:approved_posts_version"
+
+# Approvals made from another process (e.g. a management command) cannot
+# invalidate a per-process cache, so bound how stale the id list may get.
+APPROVED_POSTS_TIMEOUT = 60
+
+APPROVED_SUGGESTIONS_KEY = "catalog:approved_suggestion_ids:%s"
+APPROVED_SUGGESTIONS_TIMEOUT = 60
+
+
+def _load_approved_posts():
+    """Cache the approved post ids, returning their generation and the ids."""
+    # an index-only scan of the partial index on approved posts, on the
+    # primary so a lagging replica's list isn't cached
+    with use_primary():
+        ids = tuple(
+            Post.objects.filter(approved_at__isnull=False)
+            .values_list("id", flat=True)
+            .order_by("id")
+        )
+    logger.debug("Loaded %s approved post ids", len(ids))
+    generation = random.getrandbits(32)
+    cache.set_many(
+        {
+            APPROVED_POSTS_CHUNK_KEY % (generation, n): ids[start:start + APPROVED_POSTS_CHUNK]
+            for n, start in enumerate(range(0, len(ids), APPROVED_POSTS_CHUNK))
+        },
+        # the chunks outlive the count, so one read with it is still there
+        APPROVED_POSTS_TIMEOUT * 2,
+    )
+    cache.set(APPROVED_POSTS_KEY, (generation, len(ids)), APPROVED_POSTS_TIMEOUT)
+    return generation, ids
+
+
+class ApprovedPosts:
+    """The approved post ids in order, read from the cache a chunk at a time.
+
+    Only the count is read up front, and indexing fetches the one chunk
+    holding the id, so picking an id costs the same however many there are.
+    """
+
+    def __init__(self):
+        approved = cache.get(APPROVED_POSTS_KEY)
+        metrics.cache_lookups.inc(
+            cache="approved_posts", result="miss" if approved is None else "hit")
+        self._chunks = {}
+        if approved is None:
+            self._reload()
+        else:
+            self.generation, self.count = approved
+
+    def _reload(self):
+        self.generation, ids = _load_approved_posts()
+        self.count = len(ids)
+        self._chunks = {
+            n: ids[start:start + APPROVED_POSTS_CHUNK]
+            for n, start in enumerate(range(0, len(ids), APPROVED_POSTS_CHUNK))
+        }
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        n = i // APPROVED_POSTS_CHUNK
+        if n not in self._chunks:
+            chunk = cache.get(APPROVED_POSTS_CHUNK_KEY % (self.generation, n))
+            if chunk is None:
+                # evicted before the count, so start over from the database
+                self._reload()
+                return self[min(i, self.count - 1)]
+            self._chunks[n] = chunk
+        return self._chunks[n][i % APPROVED_POSTS_CHUNK]
+
+    def all(self):
+        keys = [
+            APPROVED_POSTS_CHUNK_KEY % (self.generation, n)
+            for n in range(-(-self.count // APPROVED_POSTS_CHUNK))
+        ]
+        cached = cache.get_many(keys)
+        if len(cached) < len(keys):
+            self._reload()
+            chunks = self._chunks.values()
+        else:
+            chunks = [cached[key] for key in keys]
+        return tuple(itertools.chain.from_iterable(chunks))
+
+
+def approved_post_ids():
+    """All approved post ids, in order."""
+    return ApprovedPosts().all()
+
+
+def invalidate_approved_posts():
+    cache.delete(APPROVED_POSTS_KEY)
+    # tells every worker's random feed to drop the posts it holds
+    if not cache.add(APPROVED_POSTS_VERSION_KEY, 1, None):
+        try:
+            cache.incr(APPROVED_POSTS_VERSION_KEY)
+        except ValueError:
+            # evicted since the add; gone is a change as well
+            pass
+
+
+def approved_posts_version():
+    """Changes whenever the approved posts do."""
+    return cache.get(APPROVED_POSTS_VERSION_KEY, 0)
+
+
+def random_post_id(exclude=None):
+    """Pick a uniformly random approved post id other than `exclude`.
+
+    Constant time: draw an index, and if it lands on the excluded id shift
+    by a random non-zero offset, which keeps the remaining ids equally likely.
+    """
+    ids = ApprovedPosts()
+    n = len(ids)
+    if n == 0:
+        return None
+    i = random.randrange(n)
+    if ids[i] == exclude:
+        if n == 1:
+            return None
+        i = (i + random.randrange(1, n)) % n
+    return ids[i]
+
+
+# random draws to try before falling back to scanning for unseen ids
+UNSEEN_PROBES = 8
+
+
+def random_unseen_post_id(seen, exclude=None):
+    """Pick a random approved post id that is not in the `seen` set.
+
+    Random probing finds an unseen post quickly while most are unseen; once
+    the session has seen most of the catalog, scan for what is left.
+    """
+    ids = ApprovedPosts()
+    if not ids:
+        return None
+    for _ in range(UNSEEN_PROBES):
+        post_id = ids[random.randrange(len(ids))]
+        if post_id != exclude and post_id not in seen:
+            return post_id
+    unseen = [i for i in ids.all() if i != exclude and i not in seen]
+    if not unseen:
+        return None
+    return random.choice(unseen)
+
+
+def approved_suggestion_ids(post_id):
+    """The ids of a post's approved suggestions in order, cached per post."""
+    key = APPROVED_SUGGESTIONS_KEY % post_id
+    ids = cache.get(key)
+    metrics.cache_lookups.inc(cache="approved_suggestions", result="miss" if ids is None else "hit")
+    if ids is None:
+        with use_primary():
+            ids = tuple(
+                Suggestion.objects.filter(post_id=post_id, approved_at__isnull=False)
+                .values_list("id", flat=True)
+                .order_by("id")
+            )
+        cache.set(key, ids, APPROVED_SUGGESTIONS_TIMEOUT)
+    return ids
+
+
+def invalidate_approved_suggestions(post_id):
+    cache.delete(APPROVED_SUGGESTIONS_KEY % post_id)
+
+
+def invalidate_post_fragment(post_id):
+    """Drop the cached markup of a post's code from index.html."""
+    key = make_template_fragment_key(
+        "post_code", [post_id, settings.POST_FRAGMENT_VERSION])
+    cache.delete(key)
@@ -0,0 +1,181 @@
+"""Database connections pooled per worker process.
+
+The ``posts.pooled_postgres`` backend takes a connection from its
+database's pool when Django connects, and gives it back when Django closes
+it at the end of the request, so a worker holds at most the pool's size in
+connections however many requests it serves at once.
+
+The pool waits on a threading.Condition. gevent's monkeypatching makes that
+cooperative, so greenlets waiting for a connection yield to the others, and
+under the ASGI server it is shared by the threads the ORM runs in.
+"""
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+
+
+logger = logging.getLogger("posts.db_pool")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """At most `size` connections made by `connect`.
+
+    Idle connections are handed out most recently returned first, so the
+    ones at the bottom of the stack are left to age and get replaced. One
+    idle for longer than `check_after` seconds is passed to `check` before
+    it is handed out, and replaced if that returns False; one older than
+    `max_lifetime` seconds is replaced rather than reused. When every
+    connection is in use `get` waits up to `timeout` seconds for one.
+    """
+
+    def __init__(self, connect, size, timeout=5.0, check=None, check_after=30.0,
+                 max_lifetime=30 * 60.0, alias="default"):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._check = check
+        self.check_after = check_after
+        self.max_lifetime = max_lifetime
+        self.alias = alias
+        self._cond = threading.Condition()
+        # (connection, returned at) pairs, the most recently returned last
+        self._idle = []
+        self._opened_at = {}
+        self._open = 0
+        self._waiting = 0
+
+    def get(self):
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    metrics.db_pool_timeouts.inc(alias=self.alias)
+                    raise PoolTimeout(
+                        "All %s connections to %s were in use for %.1fs"
+                        % (self.size, self.alias, self.timeout))
+                waited = True
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            if self._idle:
+                connection, returned_at = self._idle.pop()
+            else:
+                connection = None
+                self._open += 1
+        metrics.db_pool_checkouts.inc(alias=self.alias, waited=str(waited).lower())
+        metrics.db_pool_wait_seconds.observe(time.monotonic() - start, alias=self.alias)
+        try:
+            if connection is not None:
+                now = time.monotonic()
+                if self._expired(connection, now):
+                    self._close(connection, "lifetime")
+                    connection = None
+                elif (
+                    self._check is not None
+                    and now - returned_at > self.check_after
+                    and not self._check(connection)
+                ):
+                    self._close(connection, "check")
+                    connection = None
+            if connection is None:
+                connection = self._connect()
+                self._opened_at[connection] = time.monotonic()
+                metrics.db_pool_connects.inc(alias=self.alias)
+        except BaseException:
+            # give up the slot the failed connection was to take
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def put(self, connection, reusable=True):
+        """Take back a connection from `get`, closing it unless `reusable`."""
+        reason = None
+        if not reusable:
+            reason = "broken"
+        elif self._expired(connection, time.monotonic()):
+            reason = "lifetime"
+        if reason is not None:
+            self._close(connection, reason)
+        with self._cond:
+            if reason is None:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._open -= 1
+            self._cond.notify()
+
+    def close_idle(self):
+        """Close the connections not in use, for when the worker exits."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for connection, _ in idle:
+            self._close(connection, "exit")
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+                "waiting": self._waiting,
+            }
+
+    def _expired(self, connection, now):
+        opened_at = self._opened_at.get(connection, now)
+        return now - opened_at > self.max_lifetime
+
+    def _close(self, connection, reason):
+        self._opened_at.pop(connection, None)
+        metrics.db_pool_closes.inc(alias=self.alias, reason=reason)
+        try:
+            connection.close()
+        except Exception:
+            logger.exception("Failed to close a pooled connection to %s", self.alias)
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+    """This process's pool for a database, made with `factory` the first
+    time; a forked worker starts without the connections of its parent."""
+    global _pools, _pools_pid
+    pid = os.getpid()
+    pool = _pools.get(alias) if _pools_pid == pid else None
+    if pool is None:
+        with _pools_lock:
+            if _pools_pid != pid:
+                _pools, _pools_pid = {}, pid
+            pool = _pools.get(alias)
+            if pool is None:
+                pool = _pools[alias] = factory()
+    return pool
+
+
+def stats():
+    """Per-database pool statistics for this process."""
+    pools = _pools if _pools_pid == os.getpid() else {}
+    return {alias: pool.stats() for alias, pool in list(pools.items())}
+
+
+def close_idle():
+    if _pools_pid == os.getpid():
+        for pool in list(_pools.values()):
+            pool.close_idle()
@@ -0,0 +1,140 @@
+from collections import deque
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import catalog, metrics
+from .models import Post
+
+
+logger = logging.getLogger("posts.feed")
+
+
+# queued posts to look at for one that is neither excluded nor seen
+DRAW_PROBES = 16
+
+
+class RandomFeed:
+    """A queue of random approved posts, fetched ahead of the requests.
+
+    Each worker process holds one. A background thread keeps it topped up
+    to `size` posts, fetching a batch of `batch_size` random approved ids
+    with one ``id__in`` query, so drawing from it costs no query. Every
+    `check_interval` seconds the thread compares the catalog version, and
+    empties the queue when approvals changed. A post queued for longer
+    than `max_age` seconds is dropped rather than shown.
+    """
+
+    def __init__(self, size=500, batch_size=100, check_interval=1.0, max_age=60.0):
+        self.size = size
+        self.batch_size = batch_size
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        # (post, fetched at) pairs
+        self._queue = deque()
+        self._version = None
+
+    def draw(self, exclude=None, seen=None):
+        """A queued post other than `exclude` and not in `seen`, or None
+        when the queue has none."""
+        self._start()
+        now = time.monotonic()
+        post, passed = None, []
+        with self._lock:
+            for _ in range(min(DRAW_PROBES, len(self._queue))):
+                queued, fetched_at = entry = self._queue.popleft()
+                if now - fetched_at > self.max_age:
+                    continue
+                if queued.id == exclude or (seen is not None and queued.id in seen):
+                    # still good for another session
+                    passed.append(entry)
+                    continue
+                post = queued
+                break
+            self._queue.extend(passed)
+            low = len(self._queue) < self.size // 2
+        if low:
+            self._wake.set()
+        metrics.feed_draws.inc(result="miss" if post is None else "hit")
+        return post
+
+    def refill(self):
+        """Top the queue up, after emptying it if approvals changed."""
+        version = catalog.approved_posts_version()
+        with self._lock:
+            if version != self._version:
+                if self._queue:
+                    logger.debug("Approvals changed, dropping %s queued posts", len(self._queue))
+                self._queue.clear()
+                self._version = version
+        while self._refill_batch(version):
+            pass
+
+    def _refill_batch(self, version):
+        """Queue a batch of posts; False once the queue is full enough,
+        there is nothing left to queue, or approvals changed."""
+        with self._lock:
+            missing = self.size - len(self._queue)
+            queued = {post.id for post, _ in self._queue}
+        if missing < min(self.batch_size, self.size // 2):
+            return False
+        # indexing reads only the cached chunks holding the picked ids
+        ids = catalog.ApprovedPosts()
+        wanted = min(missing, self.batch_size)
+        sample = []
+        # enough extra picks to make up for the ones already queued
+        for i in random.sample(range(len(ids)), min(len(ids), wanted + len(queued))):
+            if ids[i] not in queued:
+                sample.append(ids[i])
+                if len(sample) == wanted:
+                    break
+        if not sample:
+            return False
+        posts = list(
+            Post.objects.filter(id__in=sample, approved_at__isnull=False)
+            .only("id", "title", "code")
+        )
+        random.shuffle(posts)
+        fetched_at = time.monotonic()
+        with self._lock:
+            if self._version != version:
+                return False
+            self._queue.extend((post, fetched_at) for post in posts)
+        metrics.feed_refills.inc()
+        # fewer than asked for means every approved post is queued
+        return len(sample) == wanted
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="random-feed", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception:
+                logger.exception("Unexpected error refilling the random feed")
+            finally:
+                connections.close_all()
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+
+
+feed = RandomFeed(
+    size=settings.RANDOM_FEED_SIZE,
+    batch_size=settings.RANDOM_FEED_BATCH_SIZE,
+    check_interval=settings.RANDOM_FEED_CHECK_INTERVAL,
+    max_age=settings.RANDOM_FEED_MAX_AGE,
+)
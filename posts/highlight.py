@@ -0,0 +1,35 @@
+import hashlib
+import logging
+
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import PythonLexer
+
+from . import metrics
+
+
+logger = logging.getLogger("posts.highlight")
+
+
+HIGHLIGHT_KEY = "highlight:%s"
+
+# token spans only; the templates supply the <pre><code> around them
+formatter = HtmlFormatter(nowrap=True)
+
+
+def highlight_code(code):
+    """Python code as highlighted HTML, memoized by a hash of the code.
+
+    Posts and suggestions do not change once approved, so the markup is
+    cached without a timeout and code is never tokenized twice.
+    """
+    key = HIGHLIGHT_KEY % hashlib.sha256(code.encode()).hexdigest()
+    html = cache.get(key)
+    metrics.cache_lookups.inc(cache="highlight", result="miss" if html is None else "hit")
+    if html is None:
+        logger.debug("Highlighting %s", key)
+        html = highlight(code, PythonLexer(), formatter)
+        cache.set(key, html, None)
+    return mark_safe(html)
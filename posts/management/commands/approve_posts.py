@@ -1,59 +1,87 @@
-from datetime import datetime
+import re
+import sys
+
 from django.core.management.base import BaseCommand, CommandError
-from ...models import Post, PostApproval
-from ...views import parse_errors
+from ...moderation import moderate_posts, moderate_suggestions
+
 
+def parse_ids(lines):
+    """Read approve, reject and delete ids from lines of text.
+
+    Ids may be separated by commas or whitespace. A line reading
+    "Approvals", "Rejects" or "Deletes" switches which set the ids after it
+    belong to, so the output of check_suggestions --dry-run can be fed
+    straight in; ids before any of them are approvals.
+    """
+    approve, reject, delete = set(), set(), set()
+    target = approve
+    for line in lines:
+        line = line.strip()
+        if line.lower() in ("approvals", "approve"):
+            target = approve
+        elif line.lower() in ("rejects", "reject"):
+            target = reject
+        elif line.lower() in ("deletes", "delete"):
+            target = delete
+        elif line and not line.startswith("#"):
+            for token in re.split(r"[\s,]+", line):
+                if not token:
+                    continue
+                try:
+                    target.add(int(token))
+                except ValueError:
+                    raise CommandError("Not an id: %r" % token)
+    return approve, reject, delete
 
-# Approvals
-# 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 18, 19
-# Deletes
-# 15, 16, 17, 20
 
 class Command(BaseCommand):
-    help = 'Approve posts'
-
-    # def _load_posts(self):
-    #     yaml = YAML()
-    #     fp = "posts/resources/posts.yaml"
-    #     with open(fp, "r") as f:
-    #         posts = yaml.load(f)['posts']
-    #     for title, code in posts.items():
-    #         err, _ = parse_errors(code)
-    #         if not err:
-    #             yield Post(title=title, code=code)
-    #         else:
-    #             raise Exception("Invalid code: %s", title)
-
-    approvals = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 18, 19]
-    deletes = [15, 16, 17, 20]
-    
+    help = 'Approve, reject or delete posts, or suggestions, in one transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', help='ids to approve')
+        parser.add_argument(
+            '--reject', action='append', default=[], metavar='IDS',
+            help='approved ids to take back to moderation, comma separated; may be repeated')
+        parser.add_argument(
+            '--delete', action='append', default=[], metavar='IDS',
+            help='ids to delete, comma separated; may be repeated')
+        parser.add_argument(
+            '--file', metavar='PATH',
+            help='read ids from a file, or "-" for stdin; '
+                 'ids after a "Rejects" or "Deletes" line are rejected or deleted')
+        parser.add_argument(
+            '--suggestions', action='store_true',
+            help='moderate suggestions instead of posts')
+
     def handle(self, *args, **options):
-        completed = []
+        approve, _, _ = parse_ids(options['ids'])
+        _, reject, _ = parse_ids(['Rejects'] + options['reject'])
+        _, _, delete = parse_ids(['Deletes'] + options['delete'])
+        if options['file'] == '-':
+            more = parse_ids(sys.stdin)
+        elif options['file']:
+            with open(options['file']) as f:
+                more = parse_ids(f)
+        else:
+            more = set(), set(), set()
+        approve |= more[0]
+        reject |= more[1]
+        delete |= more[2]
+        if not (approve or reject or delete):
+            raise CommandError("No ids given")
+        moderate = moderate_suggestions if options['suggestions'] else moderate_posts
         try:
-            for i in self.approvals:
-                try:
-                    post = Post.objects.get(id=i)
-                except:
-                    post = None
-                if post:
-                    approval = PostApproval.objects.filter(post=post).first()
-                    if approval and approval.approved_at:
-                        self.stdout.write(f"Post {i} already approved, skipping...")
-                    elif approval:
-                        approval.approved_at = datetime.now()
-                        approval.save()
-                        completed.append(i)
-                    else:
-                        approval = PostApproval(post=post, approved_at=datetime.utcnow())
-                        approval.save()
-                        completed.append(i)
-                else:
-                    self.stdout.write("No post %s" % i)
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR("ERROR trying to approve post. Approved: %s" % completed))
-            self.stdout.write(str(e))
-            return
+            result = moderate(approve=approve, reject=reject, delete=delete)
+        except ValueError as e:
+            raise CommandError(str(e))
+        kind = 'suggestions' if options['suggestions'] else 'posts'
+        if result['already_approved']:
+            self.stdout.write("Already approved: %s" % result['already_approved'])
+        if result['missing']:
+            self.stdout.write(self.style.WARNING("No such %s: %s" % (kind, result['missing'])))
         self.stdout.write(
-            self.style.SUCCESS('Successfully approved: %s' % completed)
+            self.style.SUCCESS(
+                'Approved %s: %s\nRejected %s: %s\nDeleted %s: %s'
+                % (kind, result['approved'], kind, result['rejected'], kind, result['deleted'])
+            )
         )
@@ -0,0 +1,290 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from ...models import Post, Suggestion, Vote
+from ...profiler import RequestProfile
+
+
+ENDPOINTS = ("index", "vote", "submit", "suggest", "suggestions", "suggestion_detail")
+
+SUFFIXES = {"k": 1000, "m": 1000 * 1000}
+
+BATCH_SIZE = 5000
+
+
+def count(value):
+    """Parse a row count like 10000, 100k or 1M."""
+    value = value.strip().lower()
+    try:
+        if value[-1:] in SUFFIXES:
+            return int(float(value[:-1]) * SUFFIXES[value[-1]])
+        return int(value)
+    except ValueError:
+        raise CommandError("Not a count: %r" % value)
+
+
+def percentile(ordered, p):
+    return ordered[round(p * (len(ordered) - 1))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway database and measure latency, throughput and queries '
+        'of each endpoint under concurrent clients'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--posts', type=count, default=count('10k'),
+            help='approved posts to seed, e.g. 10k, 100k or 1M')
+        parser.add_argument(
+            '--votes-per-post', type=float, default=2,
+            help='votes to seed per post on average')
+        parser.add_argument(
+            '--suggestions-per-post', type=float, default=0.5,
+            help='approved suggestions to seed per post on average')
+        parser.add_argument(
+            '--requests', type=int, default=500,
+            help='requests to make to each endpoint')
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='clients making requests at once')
+        parser.add_argument(
+            '--endpoints', default=",".join(ENDPOINTS),
+            help='comma separated url names to benchmark')
+        parser.add_argument(
+            '--keepdb', action='store_true',
+            help='keep the benchmark database, and its seed, for the next run')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='random seed, for the same data and requests every run')
+        parser.add_argument('--save-baseline', metavar='PATH', help='write the results here')
+        parser.add_argument(
+            '--baseline', metavar='PATH',
+            help='compare against results saved with --save-baseline')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='relative slowdown against the baseline to report as a regression')
+
+    def handle(self, *args, **options):
+        endpoints = [e.strip() for e in options['endpoints'].split(',') if e.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError("Unknown endpoints: %s" % ", ".join(sorted(unknown)))
+        self.seed = options['seed']
+        self.random = random.Random(self.seed)
+        verbosity = options['verbosity']
+        # the test database machinery gives us a database of our own
+        old_name = connection.settings_dict['NAME']
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # an in-memory database would lock whole tables between clients
+            test_settings['NAME'] = os.path.join(
+                tempfile.gettempdir(), 'badpython-benchmark.sqlite3')
+        connection.creation.create_test_db(
+            verbosity=max(verbosity - 1, 0), autoclobber=True, keepdb=options['keepdb'])
+        try:
+            self._seed(options)
+            caches = {
+                alias: dict(config, KEY_PREFIX="benchmark")
+                for alias, config in settings.CACHES.items()
+            }
+            # keep clear of the keys of a server sharing the cache, and of
+            # the replicas, which have none of the benchmark's rows
+            with override_settings(
+                    CACHES=caches, RATELIMIT_ENABLE=False, ALLOWED_HOSTS=["*"],
+                    DATABASE_REPLICAS=[]):
+                results = {
+                    endpoint: self._run(endpoint, options['requests'], options['concurrency'])
+                    for endpoint in endpoints
+                }
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=max(verbosity - 1, 0), keepdb=options['keepdb'])
+        results = {
+            "posts": self.post_count,
+            "database": connection.vendor,
+            "endpoints": results,
+        }
+        self._report(results)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['baseline']:
+            self._compare(results, options['baseline'], options['tolerance'])
+
+    def _seed(self, options):
+        target = options['posts']
+        existing = Post.objects.count()
+        if existing == target:
+            self.stdout.write("Reusing %s seeded posts" % existing)
+        else:
+            if existing:
+                raise CommandError(
+                    "The kept database has %s posts, not %s; run without --keepdb "
+                    "to seed it again" % (existing, target))
+            self._seed_rows(target, options)
+        self.post_count = target
+        self.post_ids = list(Post.objects.values_list("id", flat=True))
+        self.suggestions = list(
+            Suggestion.objects.filter(approved_at__isnull=False).values_list("post_id", "id"))
+        if not self.post_ids:
+            raise CommandError("Nothing to benchmark without posts")
+
+    def _seed_rows(self, target, options):
+        start = time.perf_counter()
+        now = timezone.now()
+        rand = self.random
+        for first in range(0, target, BATCH_SIZE):
+            n = min(BATCH_SIZE, target - first)
+            posts = [
+                Post(title="Post %s" % i, code="x_%s = %s\nprint(x_%s)\n" % (i, i, i), approved_at=now)
+                for i in range(first, first + n)
+            ]
+            Post.objects.bulk_create(posts)
+            votes, suggestions = [], []
+            for post in posts:
+                for _ in range(self._poisson(options['votes_per_post'])):
+                    is_bad = rand.random() < 0.5
+                    votes.append(Vote(post_id=post.id, is_bad=is_bad))
+                    if is_bad:
+                        post.bad_votes += 1
+                    else:
+                        post.not_bad_votes += 1
+                for j in range(self._poisson(options['suggestions_per_post'])):
+                    suggestions.append(Suggestion(
+                        post_id=post.id, code="x_%s = %s" % (post.id, j),
+                        description="Suggestion %s" % j, approved_at=now))
+            Vote.objects.bulk_create(votes)
+            Suggestion.objects.bulk_create(suggestions)
+            Post.objects.bulk_update(posts, ["bad_votes", "not_bad_votes"])
+            if options['verbosity'] > 1:
+                self.stdout.write("Seeded %s posts" % (first + n))
+        self.stdout.write("Seeded %s posts in %.1fs" % (target, time.perf_counter() - start))
+
+    def _poisson(self, mean):
+        # Knuth's method, fine for the small means used here
+        limit, k, p = math.exp(-mean), 0, 1.0
+        while True:
+            p *= self.random.random()
+            if p <= limit:
+                return k
+            k += 1
+
+    def _request(self, client, rand, endpoint, n):
+        """Make the n-th request to an endpoint; returns the response."""
+        if endpoint == "index":
+            return client.get(reverse("index"))
+        if endpoint == "vote":
+            post_id = rand.choice(self.post_ids)
+            return client.post(
+                reverse("vote", args=[post_id]),
+                json.dumps({"isBad": rand.random() < 0.5}), content_type="application/json")
+        if endpoint == "submit":
+            code = "benchmark_%s_%s = %s" % (self.run_id, n, n)
+            return client.post(
+                reverse("submit"), json.dumps({"title": "Benchmark %s" % n, "code": code}),
+                content_type="application/json")
+        if endpoint == "suggest":
+            post_id = rand.choice(self.post_ids)
+            code = "suggestion_%s_%s = %s" % (self.run_id, n, n)
+            return client.post(
+                reverse("suggest", args=[post_id]), json.dumps({"code": code, "summary": "s"}),
+                content_type="application/json")
+        if not self.suggestions:
+            raise CommandError("No suggestions seeded to benchmark %s with" % endpoint)
+        post_id, suggestion_id = rand.choice(self.suggestions)
+        if endpoint == "suggestions":
+            # navigating to a suggestion, as the next link does
+            return client.get(reverse("suggestions", args=[post_id]), {"s": suggestion_id})
+        return client.get(reverse("suggestion_detail", args=[post_id, suggestion_id]))
+
+    def _client_run(self, endpoint, requests, seed):
+        """One client's requests; returns (latencies, queries) lists."""
+        client = Client()
+        # a generator per client: threads sharing one would make the
+        # requests depend on their scheduling, not only on the seed
+        rand = random.Random(seed)
+        latencies, queries = [], []
+        try:
+            for n in requests:
+                profile = RequestProfile()
+                with connection.execute_wrapper(profile):
+                    start = time.perf_counter()
+                    response = self._request(client, rand, endpoint, n)
+                    latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    raise CommandError(
+                        "%s answered %s" % (endpoint, response.status_code))
+                queries.append(profile.queries)
+        finally:
+            connections.close_all()
+        return latencies, queries
+
+    def _run(self, endpoint, requests, concurrency):
+        self.run_id = "%x" % self.random.getrandbits(32)
+        shares = [range(i, requests, concurrency) for i in range(concurrency)]
+        start = time.perf_counter()
+        seeds = [self.seed + i for i in range(concurrency)]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            runs = list(pool.map(
+                lambda share, seed: self._client_run(endpoint, share, seed), shares, seeds))
+        elapsed = time.perf_counter() - start
+        latencies = sorted(l for run_latencies, _ in runs for l in run_latencies)
+        queries = [q for _, run_queries in runs for q in run_queries]
+        return {
+            "requests": len(latencies),
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "throughput": len(latencies) / elapsed,
+            "queries": sum(queries) / len(queries),
+        }
+
+    def _report(self, results):
+        self.stdout.write(
+            "%s posts on %s" % (results["posts"], results["database"]))
+        self.stdout.write(
+            "%-18s %8s %9s %9s %9s %8s"
+            % ("endpoint", "requests", "p50 ms", "p99 ms", "req/s", "queries"))
+        for endpoint, r in results["endpoints"].items():
+            self.stdout.write(
+                "%-18s %8d %9.2f %9.2f %9.1f %8.2f"
+                % (endpoint, r["requests"], r["p50_ms"], r["p99_ms"], r["throughput"], r["queries"]))
+
+    def _compare(self, results, path, tolerance):
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline.get("posts") != results["posts"]:
+            self.stdout.write(self.style.WARNING(
+                "The baseline was taken with %s posts" % baseline.get("posts")))
+        regressions = []
+        for endpoint, r in results["endpoints"].items():
+            base = baseline.get("endpoints", {}).get(endpoint)
+            if base is None:
+                continue
+            for key in ("p50_ms", "p99_ms"):
+                if r[key] > base[key] * (1 + tolerance):
+                    regressions.append(
+                        "%s %s %.2f -> %.2f" % (endpoint, key, base[key], r[key]))
+            if r["throughput"] * (1 + tolerance) < base["throughput"]:
+                regressions.append("%s throughput %.1f -> %.1f" % (
+                    endpoint, base["throughput"], r["throughput"]))
+            # the average moves a little with cache hits, but not by half a
+            # query per request unless an endpoint gained one
+            if r["queries"] > base["queries"] + 0.5:
+                regressions.append("%s queries %.2f -> %.2f" % (
+                    endpoint, base["queries"], r["queries"]))
+        if regressions:
+            raise CommandError("Regressions against %s:\n%s" % (path, "\n".join(regressions)))
+        self.stdout.write(self.style.SUCCESS("No regressions against %s" % path))
@@ -1,26 +1,76 @@
-import csv
-# import profanity_filter
-
-# pf = profanity_filter.ProfanityFilter()
-
-approvals = []
-deletes = []
-with open('./suggestions.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        # clean = pf.is_clean(row['code'])
-        c = ""
-        msg = f"Suggestion {row['id']} {c}\n"
-        msg += row['code']
-        msg += "\n"
-        print(msg)
-        resp = input("What to do [Y/d/ ]")
-        if resp == "Y":
-            approvals.append(row['id'])
-        elif resp == "d":
-            deletes.append(row['id'])
-        else:
-            continue
+import sys
+
+from django.core.management.base import BaseCommand
+from ...models import Suggestion
+from ...moderation import moderate_suggestions
+
+
+class Command(BaseCommand):
+    help = 'Review pending suggestions one by one, applying decisions in batches'
+
+    stealth_options = ('stdin',)
 
-print("Approvals\n%s"% ",".join(approvals))
-print("Deletes\n%s" % ",".join(deletes))
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=50,
+            help='decisions to collect before committing them')
+        parser.add_argument(
+            '--chunk-size', type=int, default=200,
+            help='pending suggestions to fetch from the database at a time')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='print the decisions for approve_posts --suggestions instead of applying them')
+
+    def handle(self, *args, **options):
+        self.stdin = options.get('stdin', sys.stdin)
+        self.dry_run = options['dry_run']
+        self.approvals, self.deletes = [], []
+        self.decided = {'approved': 0, 'deleted': 0}
+        pending = (
+            Suggestion.objects
+                .filter(approved_at=None)
+                .select_related('post')
+                .only('code', 'description', 'post__title', 'post__code')
+                .order_by('id')
+        )
+        # a server-side cursor on postgres, so memory stays flat
+        for suggestion in pending.iterator(chunk_size=options['chunk_size']):
+            answer = self._review(suggestion)
+            if answer is None:
+                break
+            if answer == 'y':
+                self.approvals.append(suggestion.id)
+            elif answer == 'd':
+                self.deletes.append(suggestion.id)
+            if len(self.approvals) + len(self.deletes) >= options['batch_size']:
+                self._apply()
+        self._apply()
+        if not self.dry_run:
+            self.stdout.write(self.style.SUCCESS(
+                'Approved %(approved)s and deleted %(deleted)s suggestions' % self.decided))
+
+    def _review(self, suggestion):
+        """Show a suggestion beside its post; None means stop reviewing."""
+        post = suggestion.post
+        self.stdout.write(f"Post {post.id}: {post.title}\n{post.code}\n")
+        self.stdout.write(f"Suggestion {suggestion.id}: {suggestion.description}\n{suggestion.code}\n")
+        self.stdout.write("What to do [y/d/q/ ] ", ending='')
+        self.stdout.flush()
+        answer = self.stdin.readline()
+        if not answer:
+            # end of input
+            return None
+        answer = answer.strip().lower()
+        return None if answer == 'q' else answer
+
+    def _apply(self):
+        if not (self.approvals or self.deletes):
+            return
+        if self.dry_run:
+            self.stdout.write("Approvals\n%s" % ",".join(map(str, self.approvals)))
+            self.stdout.write("Deletes\n%s" % ",".join(map(str, self.deletes)))
+        else:
+            result = moderate_suggestions(approve=self.approvals, delete=self.deletes)
+            self.decided['approved'] += len(result['approved'])
+            self.decided['deleted'] += len(result['deleted'])
+        self.approvals, self.deletes = [], []
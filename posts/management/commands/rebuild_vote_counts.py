@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...models import Post
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-post vote counters from the raw votes'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = Post.rebuild_vote_counts()
+        self.stdout.write(
+            self.style.SUCCESS('Rebuilt vote counts for %s posts' % updated)
+        )
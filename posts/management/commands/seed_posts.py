@@ -1,33 +1,157 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import json
+import multiprocessing
+import os
+
 from ruamel.yaml import YAML
+from ruamel.yaml.events import CollectionEndEvent, CollectionStartEvent, ScalarEvent
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from ... import catalog
 from ...models import Post
-from ...views import parse_errors
+from ...validation import parse_code
+
+
+def yaml_posts(f):
+    """Stream (title, code) pairs from a YAML file's "posts" mapping.
+
+    Reads parser events rather than loading the document, so a large file
+    is never held in memory.
+    """
+    depth, top_key, title = 0, None, None
+    for event in YAML().parse(f):
+        if isinstance(event, CollectionStartEvent):
+            depth += 1
+        elif isinstance(event, CollectionEndEvent):
+            depth -= 1
+            if depth == 1:
+                top_key = None
+        elif isinstance(event, ScalarEvent):
+            if depth == 1:
+                top_key = event.value if top_key is None else None
+            elif depth == 2 and top_key == "posts":
+                if title is None:
+                    title = event.value
+                else:
+                    yield title, event.value
+                    title = None
+
+
+def jsonl_posts(f):
+    """Stream (title, code) pairs from lines of {"title": ..., "code": ...}."""
+    for n, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            yield entry["title"], entry["code"]
+        except (ValueError, KeyError, TypeError):
+            raise CommandError("Line %s is not a post: %r" % (n, line[:80]))
+
+
+def directory_posts(path):
+    """Stream (title, code) pairs from the .py files under a directory,
+    titled after their file names."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".py"):
+                with open(os.path.join(root, name)) as f:
+                    code = f.read()
+                yield name[:-3].replace("_", " "), code
+
+
+def read_posts(path):
+    if os.path.isdir(path):
+        yield from directory_posts(path)
+        return
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            yield from jsonl_posts(f)
+        elif path.endswith((".yaml", ".yml")):
+            yield from yaml_posts(f)
+        else:
+            raise CommandError("Unknown post file type: %s" % path)
+
+
+# titles from file names can be longer than the column
+TITLE_LENGTH = Post._meta.get_field("title").max_length
 
 
 class Command(BaseCommand):
-    help = 'Load a few initial posts'
-
-    def _load_posts(self):
-        yaml = YAML()
-        fp = "posts/resources/posts.yaml"  
-        with open(fp, "r") as f:
-            posts = yaml.load(f)['posts']
-        for title, code in posts.items():
-            err, _ = parse_errors(code)
-            if not err:
-                yield Post(title=title, code=code)
-            else: 
-                raise Exception("Invalid code: %s", title)
+    help = 'Load posts from YAML, JSONL or directories of .py files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*', default=['posts/resources/posts.yaml'],
+            help='.yaml, .yml or .jsonl files, or directories of .py files')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='posts to validate and insert at a time')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='processes to validate code with')
+        parser.add_argument(
+            '--skip-invalid', action='store_true',
+            help='skip invalid code instead of stopping')
+        parser.add_argument(
+            '--approve', action='store_true',
+            help='approve the posts instead of queueing them for moderation')
 
     def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        self.saved = self.invalid = self.duplicates = 0
+        posts = (post for path in options['paths'] for post in read_posts(path))
+        pool = ProcessPoolExecutor(
+            max_workers=options['workers'],
+            mp_context=multiprocessing.get_context("spawn"),
+        )
         try:
-            posts = list(self._load_posts())
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR("Could not load posts: %s" % e))
-            return
-        for post in posts:
-            post.save()
+            with pool:
+                while True:
+                    batch = list(islice(posts, batch_size))
+                    if not batch:
+                        break
+                    results = pool.map(
+                        parse_code, [code for _, code in batch],
+                        chunksize=max(1, len(batch) // (options['workers'] * 4)),
+                    )
+                    self._save_batch(batch, results, options)
+        except CommandError as e:
+            raise CommandError("%s (saved %s posts before stopping)" % (e, self.saved))
+        finally:
+            if self.saved:
+                # bulk_create sends no post_save signals
+                catalog.invalidate_approved_posts()
         self.stdout.write(
-            self.style.SUCCESS('Successfully saved %s posts' % len(posts))
+            self.style.SUCCESS(
+                'Successfully saved %s posts, skipped %s invalid and %s duplicates'
+                % (self.saved, self.invalid, self.duplicates)
+            )
         )
+
+    def _save_batch(self, batch, results, options):
+        new = {}
+        for (title, code), (errors, code_hash) in zip(batch, results):
+            if errors:
+                if not options['skip_invalid']:
+                    raise CommandError("Invalid code in %r: %s" % (title, errors))
+                self.invalid += 1
+            elif code_hash in new:
+                self.duplicates += 1
+            else:
+                # duplicates are checked per batch below, not per post as in Post.new
+                new[code_hash] = Post(
+                    title=title[:TITLE_LENGTH], code=code, code_hash=code_hash)
+        existing = set(
+            Post.objects.filter(code_hash__in=new).values_list("code_hash", flat=True))
+        self.duplicates += len(existing)
+        posts = [post for code_hash, post in new.items() if code_hash not in existing]
+        if options['approve']:
+            approved_at = timezone.now()
+            for post in posts:
+                post.approved_at = approved_at
+        Post.objects.bulk_create(posts)
+        self.saved += len(posts)
+        self.stdout.write("Saved %s posts" % self.saved)
@@ -0,0 +1,317 @@
+"""Prometheus metrics, aggregated across gunicorn's worker processes.
+
+Every process writes its own samples into a memory-mapped file in
+METRICS_DIR, named after its pid, so updating a metric takes no lock
+shared with other processes. The /internal/metrics view reads every file
+in the directory and sums the samples. Files of exited workers are kept,
+so counters never go backwards; gunicorn's on_starting hook clears the
+directory when the server starts. Without METRICS_DIR the values are only
+kept in this process.
+
+Only counters and histograms are recorded this way, since their samples
+can be summed across processes.
+"""
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+
+# bytes used so far, at the start of each file
+HEADER = struct.Struct("<Q")
+# length of the key, followed by the key padded to 8 bytes and the value
+KEY_LENGTH = struct.Struct("<I")
+VALUE = struct.Struct("<d")
+INITIAL_SIZE = 64 * 1024
+
+
+def _padded(n):
+    return n + (-n % 8)
+
+
+def _entries(data):
+    """Yield (key, value offset) pairs from the bytes of a value file."""
+    if len(data) < HEADER.size:
+        return
+    used, = HEADER.unpack_from(data, 0)
+    pos = HEADER.size
+    while pos < used:
+        length, = KEY_LENGTH.unpack_from(data, pos)
+        start = pos + KEY_LENGTH.size
+        key = data[start:start + length].decode()
+        pos = _padded(start + length)
+        yield key, pos
+        pos += VALUE.size
+
+
+def _read_samples(data):
+    """Yield (key, value) pairs from the bytes of a value file."""
+    for key, pos in _entries(data):
+        yield key, VALUE.unpack_from(data, pos)[0]
+
+
+class ValueFile:
+    """Float values by key, in a file that only this process writes."""
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._positions = {}
+        if path is None:
+            self._fd = -1
+            self._size = INITIAL_SIZE
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._size = max(os.fstat(self._fd).st_size, INITIAL_SIZE)
+            os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        used, = HEADER.unpack_from(self._map, 0)
+        if used == 0:
+            HEADER.pack_into(self._map, 0, HEADER.size)
+        else:
+            # a restarted worker that got the same pid carries on counting
+            self._positions.update(_entries(self._map))
+
+    def _grow(self, needed):
+        size = self._size
+        while size < needed:
+            size *= 2
+        if self._fd == -1:
+            new_map = mmap.mmap(-1, size)
+            new_map[:self._size] = self._map[:]
+        else:
+            os.ftruncate(self._fd, size)
+            new_map = mmap.mmap(self._fd, size)
+        self._map.close()
+        self._map, self._size = new_map, size
+
+    def _position(self, key):
+        pos = self._positions.get(key)
+        if pos is None:
+            encoded = key.encode()
+            used, = HEADER.unpack_from(self._map, 0)
+            value_pos = _padded(used + KEY_LENGTH.size + len(encoded))
+            if value_pos + VALUE.size > self._size:
+                self._grow(value_pos + VALUE.size)
+            KEY_LENGTH.pack_into(self._map, used, len(encoded))
+            start = used + KEY_LENGTH.size
+            self._map[start:start + len(encoded)] = encoded
+            VALUE.pack_into(self._map, value_pos, 0.0)
+            # readers only look at entries below the header's length
+            HEADER.pack_into(self._map, 0, value_pos + VALUE.size)
+            pos = self._positions[key] = value_pos
+        return pos
+
+    def inc(self, key, amount=1.0):
+        with self._lock:
+            pos = self._position(key)
+            value, = VALUE.unpack_from(self._map, pos)
+            VALUE.pack_into(self._map, pos, value + amount)
+
+    def inc_many(self, amounts):
+        """Add to several values, given (key, amount) pairs."""
+        with self._lock:
+            for key, amount in amounts:
+                pos = self._position(key)
+                value, = VALUE.unpack_from(self._map, pos)
+                VALUE.pack_into(self._map, pos, value + amount)
+
+    def samples(self):
+        with self._lock:
+            return list(_read_samples(self._map))
+
+
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+def _file():
+    """This process's value file, opened again in a forked worker."""
+    global _values, _values_pid
+    pid = os.getpid()
+    if _values_pid != pid:
+        with _values_lock:
+            if _values_pid != pid:
+                directory = settings.METRICS_DIR
+                path = None
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, "%s.db" % pid)
+                _values, _values_pid = ValueFile(path), pid
+    return _values
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _sample_key(family, name, labels):
+    if labels:
+        label_text = ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+        name = "%s{%s}" % (name, label_text)
+    # the family is kept to group samples under their HELP and TYPE lines
+    return "%s\0%s" % (family, name)
+
+
+REGISTRY = {}
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        REGISTRY[name] = self
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        _file().inc(_sample_key(self.name, self.name + "_total", labels), amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # buckets are stored cumulative, as they are exposed, and every one
+        # is written so they are all created in order on the first observation
+        amounts = [
+            (_sample_key(self.name, self.name + "_bucket", dict(labels, le=bound)),
+             1 if value <= bound else 0)
+            for bound in self.buckets
+        ]
+        amounts.append((_sample_key(self.name, self.name + "_bucket", dict(labels, le="+Inf")), 1))
+        amounts.append((_sample_key(self.name, self.name + "_count", labels), 1))
+        amounts.append((_sample_key(self.name, self.name + "_sum", labels), value))
+        _file().inc_many(amounts)
+
+
+def _live_pids(directory):
+    pids = []
+    for name in os.listdir(directory):
+        if not name.endswith(".db"):
+            continue
+        try:
+            pid = int(name[:-3])
+            os.kill(pid, 0)
+        except (ValueError, ProcessLookupError):
+            continue
+        except PermissionError:
+            pass
+        pids.append(pid)
+    return pids
+
+
+def collect():
+    """Sum the samples of every process, by metric family."""
+    directory = settings.METRICS_DIR
+    totals = {}
+    if directory and os.path.isdir(directory):
+        sources = []
+        for name in os.listdir(directory):
+            if name.endswith(".db"):
+                try:
+                    with open(os.path.join(directory, name), "rb") as f:
+                        sources.append(f.read())
+                except FileNotFoundError:
+                    continue
+        samples = (sample for data in sources for sample in _read_samples(data))
+        workers = len(_live_pids(directory))
+    else:
+        samples = _file().samples()
+        workers = 1
+    for key, value in samples:
+        totals[key] = totals.get(key, 0.0) + value
+    families = {}
+    for key, value in totals.items():
+        family, sample = key.split("\0", 1)
+        families.setdefault(family, []).append((sample, value))
+    return families, workers
+
+
+def _format(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    families, workers = collect()
+    lines = [
+        "# HELP badpython_processes Processes with a metrics file that are running.",
+        "# TYPE badpython_processes gauge",
+        "badpython_processes %s" % workers,
+    ]
+    for name in sorted(families):
+        metric = REGISTRY.get(name)
+        if metric is not None:
+            lines.append("# HELP %s %s" % (name, metric.documentation))
+            lines.append("# TYPE %s %s" % (name, metric.type))
+        # in the order they were first written, which keeps buckets in order
+        for sample, value in families[name]:
+            lines.append("%s %s" % (sample, _format(value)))
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    """Remove the files of every process; for when the server starts."""
+    directory = settings.METRICS_DIR
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(".db"):
+                os.remove(os.path.join(directory, name))
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+requests = Counter("badpython_requests", "Requests by URL name and status code.")
+request_seconds = Histogram(
+    "badpython_request_seconds", "Request latency by URL name.", LATENCY_BUCKETS)
+request_queries = Histogram(
+    "badpython_request_queries", "Queries per profiled request by URL name.",
+    (0, 1, 2, 3, 5, 10, 20, 50))
+request_db_seconds = Counter(
+    "badpython_request_db_seconds", "Time in queries of profiled requests by URL name.")
+request_render_seconds = Counter(
+    "badpython_request_render_seconds", "Time rendering templates of profiled requests by URL name.")
+ratelimited = Counter("badpython_ratelimited", "Requests rejected by the rate limit.")
+votes = Counter("badpython_votes", "Votes cast, by whether they were buffered.")
+votes_flushed = Counter("badpython_votes_flushed", "Buffered votes written to the database.")
+votes_dropped = Counter(
+    "badpython_votes_dropped", "Buffered votes dropped instead of written, as for a deleted post.")
+submissions = Counter("badpython_submissions", "Posts and suggestions submitted, by outcome.")
+cache_lookups = Counter("badpython_cache_lookups", "Cache lookups by cache and result.")
+session_writes = Counter("badpython_session_writes", "Sessions written to the session cache.")
+validation_seconds = Histogram(
+    "badpython_validation_seconds", "Time to validate submitted code.",
+    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+validation_timeouts = Counter("badpython_validation_timeouts", "Code parses that timed out.")
+worker_starts = Counter("badpython_worker_starts", "Gunicorn workers started.")
+worker_exits = Counter("badpython_worker_exits", "Gunicorn workers exited, counted by the arbiter.")
+db_pool_checkouts = Counter(
+    "badpython_db_pool_checkouts",
+    "Connections taken from the pool, by whether every one was in use first.")
+db_pool_wait_seconds = Histogram(
+    "badpython_db_pool_wait_seconds", "Time waiting for a pooled connection.",
+    (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+db_pool_timeouts = Counter(
+    "badpython_db_pool_timeouts", "Requests that gave up waiting for a pooled connection.")
+db_pool_connects = Counter("badpython_db_pool_connects", "Connections opened by the pool.")
+db_pool_closes = Counter("badpython_db_pool_closes", "Pooled connections closed, by reason.")
+read_requests = Counter(
+    "badpython_read_requests",
+    "GET and HEAD requests not pinned to the primary, by the database they read from.")
+replica_skips = Counter(
+    "badpython_replica_skips", "Replicas passed over for a request, by reason.")
+feed_draws = Counter(
+    "badpython_feed_draws", "Index posts drawn from the random feed, by whether one was queued.")
+feed_refills = Counter("badpython_feed_refills", "Batches of posts fetched into the random feed.")
@@ -1,18 +1,304 @@
+import asyncio
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+import functools
+import logging
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.urls import Resolver404, get_resolver, resolve
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .profiler import RequestProfile, current_profile, profiler
+from .routers import health, read_alias
+
+
+logger = logging.getLogger("posts.middleware")
+
+
+def _client_ip(meta):
+    ip = meta.get("HTTP_CF_CONNECTING_IP")
+    if ip is None:
+        ip = meta.get("HTTP_X_REAL_IP")
+    if ip is None:
+        ip = meta.get("REMOTE_ADDR")
+    if ip is None:
+        x_forwarded_for = meta.get("HTTP_X_FORWARDED_FOR")
+        if x_forwarded_for:
+            try:
+                ip = x_forwarded_for.split(",")[0].strip()
+            except IndexError:
+                ip = x_forwarded_for.strip()
+    return ip
+
+
+@sync_and_async_middleware
 def set_client_ip(get_response):
-    def process_request(request):
-        ip = request.META.get("HTTP_CF_CONNECTING_IP")
-        if ip is None:
-            ip = request.META.get("HTTP_X_REAL_IP")
-        if ip is None:
-            ip = request.META.get("REMOTE_ADDR")
-        if ip is None:
-            x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
-            if x_forwarded_for:
-                try:
-                    ip = x_forwarded_for.split(",")[0].strip()
-                except IndexError:
-                    ip = x_forwarded_for.strip()
-        request.META["CLIENT_IP"] = ip
-        return get_response(request)
+    if asyncio.iscoroutinefunction(get_response):
+        async def process_request(request):
+            request.META["CLIENT_IP"] = _client_ip(request.META)
+            return await get_response(request)
+    else:
+        def process_request(request):
+            request.META["CLIENT_IP"] = _client_ip(request.META)
+            return get_response(request)
+
+    return process_request
+
+
+def _wrap_connections(profile):
+    """Count the queries of this thread's connections into `profile`,
+    until the returned ExitStack is closed."""
+    stack = ExitStack()
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(profile))
+    return stack
+
+
+@contextmanager
+def _profiling(profile):
+    token = current_profile.set(profile)
+    try:
+        with _wrap_connections(profile):
+            yield
+    finally:
+        current_profile.reset(token)
+
+
+@asynccontextmanager
+async def _aprofiling(profile):
+    # connections are per thread, and the async ORM queries from the one
+    # thread that every sync_to_async call of a request runs in
+    token = current_profile.set(profile)
+    try:
+        stack = await sync_to_async(_wrap_connections)(profile)
+        try:
+            yield
+        finally:
+            await sync_to_async(stack.close)()
+    finally:
+        current_profile.reset(token)
+
+
+def _record(request, response, seconds, profile):
+    match = request.resolver_match
+    view = match.view_name if match is not None else "unresolved"
+    profiler.record(view, seconds, profile)
+    metrics.requests.inc(view=view, status=response.status_code)
+    metrics.request_seconds.observe(seconds, view=view)
+    if profile is not None:
+        metrics.request_queries.observe(profile.queries, view=view)
+        metrics.request_db_seconds.inc(profile.db_seconds, view=view)
+        metrics.request_render_seconds.inc(profile.render_seconds, view=view)
+    if seconds * 1000 >= settings.PROFILE_SLOW_REQUEST_MS:
+        if profile is None:
+            logger.warning("Slow request %s %s took %.3fs", request.method, request.path, seconds)
+        else:
+            logger.warning(
+                "Slow request %s %s took %.3fs: %s queries in %.3fs, render %.3fs, slowest %.3fs: %s",
+                request.method, request.path, seconds, profile.queries,
+                profile.db_seconds, profile.render_seconds,
+                profile.slowest_seconds, profile.slowest_sql,
+            )
+
+
+@sync_and_async_middleware
+def profile_requests(get_response):
+    """Time each request and profile a sample of PROFILE_SAMPLE_RATE of them.
+
+    Requests slower than PROFILE_SLOW_REQUEST_MS are logged, with their
+    query count, database and render time and slowest query if sampled.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def process_request(request):
+            start = time.perf_counter()
+            profile = None
+            if random.random() < settings.PROFILE_SAMPLE_RATE:
+                profile = RequestProfile()
+                async with _aprofiling(profile):
+                    response = await get_response(request)
+            else:
+                response = await get_response(request)
+            _record(request, response, time.perf_counter() - start, profile)
+            return response
+    else:
+        def process_request(request):
+            start = time.perf_counter()
+            profile = None
+            if random.random() < settings.PROFILE_SAMPLE_RATE:
+                profile = RequestProfile()
+                with _profiling(profile):
+                    response = get_response(request)
+            else:
+                response = get_response(request)
+            _record(request, response, time.perf_counter() - start, profile)
+            return response
+
+    return process_request
+
+
+class SlidingWindowLimiter:
+    """Per-client request limits with a sliding window counter.
+
+    Each client has a counter per fixed window in `cache`, and the previous
+    window's count is weighted by how much of it still overlaps the sliding
+    window. With a shared cache every worker adds to the same counters, so
+    the limit holds across the host. Rejected requests are not counted, so
+    a client that keeps retrying gets through again as the window slides.
+    Both windows are read at once, and workers reading them at the same
+    moment may let a few requests over the limit.
+    """
+
+    def __init__(self, rate, cache):
+        self.limit, self.window = self.parse_rate(rate)
+        self.cache = cache
+
+    @staticmethod
+    def parse_rate(rate):
+        """Parse a rate like "5/s" or "100/m" into (count, seconds)."""
+        count, period = rate.split("/")
+        seconds = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}[period[-1]]
+        if period[:-1]:
+            seconds *= int(period[:-1])
+        return int(count), seconds
+
+    def _key(self, client, start):
+        return "ratelimit:%s:%d" % (client, start)
+
+    def allow(self, client, now=None):
+        if now is None:
+            now = time.time()
+        start = int(now // self.window) * self.window
+        key, previous_key = self._key(client, start), self._key(client, start - self.window)
+        counts = self.cache.get_many([key, previous_key])
+        overlap = 1 - (now - start) / self.window
+        if counts.get(previous_key, 0) * overlap + counts.get(key, 0) + 1 > self.limit:
+            return False
+        # the first request of the window, unless another worker beat us
+        if key not in counts and self.cache.add(key, 1, self.window * 2):
+            return True
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # expired since it was read
+            self.cache.add(key, 1, self.window * 2)
+        return True
+
+
+@functools.lru_cache(maxsize=8)
+def _limited_paths(resolver, names):
+    """The paths of the url names taking no arguments, and the path prefixes
+    of those that do, so most paths are told apart without resolving them."""
+    paths, prefixes = set(), set()
+    for name in names:
+        for possibilities, *_ in resolver.reverse_dict.getlist(name):
+            for template, params in possibilities:
+                if params:
+                    prefixes.add("/" + template.split("%(", 1)[0])
+                else:
+                    paths.add("/" + template.replace("%%", "%"))
+    return frozenset(paths), tuple(prefixes)
+
+
+@sync_and_async_middleware
+def rate_limit(get_response):
+    """Reject clients over RATELIMIT_RATE before any other work is done.
+
+    Only the views named in RATELIMIT_VIEWS are limited, for the methods in
+    RATELIMIT_METHODS. Must come after set_client_ip and before the session
+    middleware. Limits are counted in the default cache, so across every
+    worker sharing it.
+    """
+    limiter = SlidingWindowLimiter(settings.RATELIMIT_RATE, cache)
+    view = import_string(settings.RATELIMIT_VIEW)
+
+    def limited(request):
+        if not settings.RATELIMIT_ENABLE or request.method not in settings.RATELIMIT_METHODS:
+            return False
+        urlconf = getattr(request, "urlconf", None)
+        path = request.path_info
+        paths, prefixes = _limited_paths(get_resolver(urlconf), tuple(settings.RATELIMIT_VIEWS))
+        if path not in paths:
+            if not path.startswith(prefixes):
+                return False
+            try:
+                match = resolve(path, urlconf)
+            except Resolver404:
+                return False
+            if match.url_name not in settings.RATELIMIT_VIEWS:
+                return False
+        return not limiter.allow(request.META["CLIENT_IP"])
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def process_request(request):
+            # the cache may block
+            if await sync_to_async(limited)(request):
+                return view(request)
+            return await get_response(request)
+    else:
+        def process_request(request):
+            if limited(request):
+                return view(request)
+            return get_response(request)
+
+    return process_request
+
+
+# set on the responses to writes, to send the client's reads to the primary
+PIN_COOKIE = "primary"
+
+
+@sync_and_async_middleware
+def replica_reads(get_response):
+    """Read from a replica in GET and HEAD requests, see posts.routers.
+
+    Any other request pins the client to the primary for
+    REPLICA_PIN_SECONDS, so it reads its own writes.
+    """
+
+    def reads_from_replica(request):
+        return (
+            settings.DATABASE_REPLICAS
+            and request.method in ("GET", "HEAD")
+            and PIN_COOKIE not in request.COOKIES
+        )
+
+    def choose():
+        alias = health.choose()
+        metrics.read_requests.inc(database=alias or "default")
+        return alias
+
+    def pin(request, response):
+        if request.method not in ("GET", "HEAD", "OPTIONS") and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PIN_COOKIE, "1", max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True, samesite="Lax")
+        return response
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def process_request(request):
+            if not reads_from_replica(request):
+                return pin(request, await get_response(request))
+            # connecting to the replica blocks, and must happen in the
+            # thread the request's queries run in
+            token = read_alias.set(await sync_to_async(choose)())
+            try:
+                return await get_response(request)
+            finally:
+                read_alias.reset(token)
+    else:
+        def process_request(request):
+            if not reads_from_replica(request):
+                return pin(request, get_response(request))
+            token = read_alias.set(choose())
+            try:
+                return get_response(request)
+            finally:
+                read_alias.reset(token)
 
     return process_request
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.13 on 2026-10-18 11:47
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_votes(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    Vote = apps.get_model('posts', 'Vote')
+    db = schema_editor.connection.alias
+
+    def count(is_bad):
+        votes = (
+            Vote.objects
+                .using(db)
+                .filter(post=OuterRef('pk'), is_bad=is_bad)
+                .order_by()
+                .values('post')
+                .annotate(count=Count('id'))
+                .values('count')
+        )
+        return Coalesce(Subquery(votes), 0)
+
+    Post.objects.using(db).update(bad_votes=count(True), not_bad_votes=count(False))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0004_auto_20210101_2029'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='bad_votes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='not_bad_votes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_votes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.1.13 on 2026-10-18 11:59
+
+import ast
+
+from django.db import migrations, models
+
+from posts.validation import code_hash
+
+
+def hash_code(apps, schema_editor):
+    db = schema_editor.connection.alias
+    for name in ('Post', 'Suggestion'):
+        model = apps.get_model('posts', name)
+        batch = []
+        for obj in model.objects.using(db).only('code').iterator(chunk_size=500):
+            try:
+                obj.code_hash = code_hash(ast.parse(obj.code))
+            except (SyntaxError, ValueError, RecursionError, MemoryError):
+                # left unhashed, it never counts as a duplicate
+                continue
+            batch.append(obj)
+            if len(batch) == 500:
+                model.objects.using(db).bulk_update(batch, ['code_hash'])
+                batch = []
+        model.objects.using(db).bulk_update(batch, ['code_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0005_post_vote_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='code_hash',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='suggestion',
+            name='code_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='suggestion',
+            index=models.Index(fields=['post', 'code_hash'], name='posts_sugge_post_id_97b1c8_idx'),
+        ),
+        migrations.RunPython(hash_code, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:02
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe_approvals(apps, schema_editor):
+    """Keep one approval per post and suggestion: the earliest approved
+    one, or else the oldest pending one."""
+    db = schema_editor.connection.alias
+    for name, field in (('PostApproval', 'post_id'), ('SuggestionApproval', 'suggestion_id')):
+        model = apps.get_model('posts', name)
+        duplicated = (
+            model.objects.using(db).values(field)
+                .annotate(n=Count('id'))
+                .filter(n__gt=1)
+                .values_list(field, flat=True)
+        )
+        for object_id in duplicated.iterator():
+            approvals = model.objects.using(db).filter(**{field: object_id})
+            keep = (
+                approvals.exclude(approved_at=None).order_by('approved_at', 'id').first()
+                or approvals.order_by('id').first()
+            )
+            approvals.exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0006_code_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_approvals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='postapproval',
+            index=models.Index(condition=models.Q(('approved_at__isnull', False)), fields=['post'], name='posts_post_approval_approved'),
+        ),
+        migrations.AddIndex(
+            model_name='suggestion',
+            index=models.Index(fields=['post', 'id'], name='posts_suggestion_post_id'),
+        ),
+        migrations.AddIndex(
+            model_name='suggestionapproval',
+            index=models.Index(condition=models.Q(('approved_at__isnull', False)), fields=['suggestion'], name='posts_sugg_approval_approved'),
+        ),
+        migrations.AddConstraint(
+            model_name='postapproval',
+            constraint=models.UniqueConstraint(fields=('post',), name='posts_postapproval_unique_post'),
+        ),
+        migrations.AddConstraint(
+            model_name='suggestionapproval',
+            constraint=models.UniqueConstraint(fields=('suggestion',), name='posts_suggestionapproval_unique_suggestion'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:03
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_approvals(apps, schema_editor):
+    db = schema_editor.connection.alias
+    for name, approval_name, field in (
+        ('Post', 'PostApproval', 'post'),
+        ('Suggestion', 'SuggestionApproval', 'suggestion'),
+    ):
+        model = apps.get_model('posts', name)
+        approval = apps.get_model('posts', approval_name)
+        approved_at = approval.objects.using(db).filter(**{field: OuterRef('pk')}).values('approved_at')
+        model.objects.using(db).update(approved_at=Subquery(approved_at[:1]))
+
+
+def restore_approvals(apps, schema_editor):
+    db = schema_editor.connection.alias
+    for name, approval_name, field in (
+        ('Post', 'PostApproval', 'post_id'),
+        ('Suggestion', 'SuggestionApproval', 'suggestion_id'),
+    ):
+        model = apps.get_model('posts', name)
+        approval = apps.get_model('posts', approval_name)
+        rows = model.objects.using(db).values_list('id', 'approved_at').iterator(chunk_size=1000)
+        batch = []
+        for object_id, approved_at in rows:
+            batch.append(approval(**{field: object_id, 'approved_at': approved_at}))
+            if len(batch) == 1000:
+                approval.objects.using(db).bulk_create(batch)
+                batch = []
+        approval.objects.using(db).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0007_approval_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='approved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='suggestion',
+            name='approved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_approvals, restore_approvals),
+        migrations.RemoveIndex(
+            model_name='suggestion',
+            name='posts_suggestion_post_id',
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('approved_at__isnull', False)), fields=['id'], name='posts_post_approved'),
+        ),
+        migrations.AddIndex(
+            model_name='suggestion',
+            index=models.Index(condition=models.Q(('approved_at__isnull', False)), fields=['post', 'id'], name='posts_suggestion_approved'),
+        ),
+        migrations.DeleteModel(
+            name='PostApproval',
+        ),
+        migrations.DeleteModel(
+            name='SuggestionApproval',
+        ),
+    ]
@@ -0,0 +1,68 @@
+import ast
+import hashlib
+
+from django.db import migrations
+
+
+# 0006 hashed ast.dump's output, which differs between Python versions.
+# This is a copy of posts.validation.code_hash as of this migration, which
+# hashes a normalised tree instead, so later changes to that don't change
+# what this does.
+
+IGNORED_FIELDS = {'kind', 'type_comment'}
+
+
+def normal_form(node):
+    if isinstance(node, list):
+        return tuple(normal_form(item) for item in node)
+    if not isinstance(node, ast.AST):
+        return repr(node)
+    name = type(node).__name__
+    if name == 'Index':
+        return normal_form(node.value)
+    if name == 'ExtSlice':
+        return normal_form(ast.Tuple(elts=node.dims, ctx=ast.Load()))
+    if name == 'JoinedStr':
+        node = ast.JoinedStr(values=[
+            value for value in node.values
+            if not (isinstance(value, ast.Constant) and value.value == '')
+        ])
+    fields = tuple(
+        (field, normal_form(value))
+        for field, value in sorted(ast.iter_fields(node))
+        if field not in IGNORED_FIELDS and value is not None and value != []
+    )
+    return (name,) + fields
+
+
+def code_hash(tree):
+    return hashlib.sha256(repr(normal_form(tree)).encode()).hexdigest()
+
+
+def rehash_code(apps, schema_editor):
+    db = schema_editor.connection.alias
+    for name in ('Post', 'Suggestion'):
+        model = apps.get_model('posts', name)
+        batch = []
+        for obj in model.objects.using(db).only('code').iterator(chunk_size=500):
+            try:
+                obj.code_hash = code_hash(ast.parse(obj.code))
+            except (SyntaxError, ValueError, RecursionError, MemoryError):
+                # left unhashed, it never counts as a duplicate
+                obj.code_hash = None
+            batch.append(obj)
+            if len(batch) == 500:
+                model.objects.using(db).bulk_update(batch, ['code_hash'])
+                batch = []
+        model.objects.using(db).bulk_update(batch, ['code_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0008_fold_approvals'),
+    ]
+
+    operations = [
+        migrations.RunPython(rehash_code, migrations.RunPython.noop),
+    ]
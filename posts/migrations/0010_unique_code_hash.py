@@ -0,0 +1,39 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:49
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def unhash_duplicates(apps, schema_editor):
+    # posts submitted at the same moment could both be saved before; the
+    # later ones are left unhashed, as code that doesn't parse is
+    Post = apps.get_model('posts', 'Post')
+    db = schema_editor.connection.alias
+    duplicates = (
+        Post.objects.using(db)
+            .exclude(code_hash=None)
+            .order_by()
+            .values('code_hash')
+            .annotate(first=Min('id'), count=Count('id'))
+            .filter(count__gt=1)
+    )
+    for row in duplicates:
+        (Post.objects.using(db)
+            .filter(code_hash=row['code_hash'])
+            .exclude(pk=row['first'])
+            .update(code_hash=None))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0009_stable_code_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(unhash_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='post',
+            constraint=models.UniqueConstraint(condition=models.Q(('code_hash__isnull', False)), fields=('code_hash',), name='posts_post_unique_code_hash'),
+        ),
+    ]
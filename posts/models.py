@@ -1,14 +1,17 @@
 from collections import defaultdict
 import datetime
 import socket
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django import utils
+from django.db.models.functions import Coalesce
 
 from .exceptions import DuplicateError
 
 
 class PublishableMixin(models.Model):
     pub_date = models.DateTimeField("date published", auto_now_add=True)
+    # null until a moderator approves it
+    approved_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         abstract = True
@@ -18,34 +21,100 @@ class Post(PublishableMixin, models.Model):
     title = models.CharField(max_length=128, null=False)
     code = models.TextField(null=False)
     note = models.TextField(null=True)
+    bad_votes = models.PositiveIntegerField(default=0)
+    not_bad_votes = models.PositiveIntegerField(default=0)
+    # sha256 of the normalised AST, see posts.validation.code_hash
+    code_hash = models.CharField(max_length=64, null=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            # so two submissions of the same code at once can't both be saved
+            models.UniqueConstraint(
+                fields=["code_hash"], name="posts_post_unique_code_hash",
+                condition=models.Q(code_hash__isnull=False)),
+        ]
+        indexes = [
+            # the approved post ids, read by catalog.approved_post_ids
+            models.Index(
+                fields=["id"], name="posts_post_approved",
+                condition=models.Q(approved_at__isnull=False)),
+        ]
+
+    @classmethod
+    def new(cls, title, code, code_hash=None):
+        """Save a new post.
+
+        Raises DuplicateError if a post with the same code_hash exists,
+        which the unique constraint catches even when the other was saved
+        at the same time.
+        """
+        post = Post(title=title, code=code, note=None, code_hash=code_hash)
+        try:
+            with transaction.atomic():
+                post.save()
+        except IntegrityError:
+            raise DuplicateError(code_hash)
+        return post
 
     @classmethod
-    def new(cls, title, code):
-        return Post(title=title, code=code, note=None)
+    def count_vote(cls, post_id, is_bad, previous=None):
+        """Adjust the vote counters for a new vote, or a changed one.
+
+        A change must only be counted by the request whose update of the
+        vote changed it, see views.VoteView._save_vote.
+        """
+        if previous == is_bad:
+            return
+        field, other = ("bad_votes", "not_bad_votes") if is_bad else ("not_bad_votes", "bad_votes")
+        counts = {field: models.F(field) + 1}
+        if previous is not None:
+            counts[other] = models.F(other) - 1
+        cls.objects.filter(pk=post_id).update(**counts)
+
+    @classmethod
+    def rebuild_vote_counts(cls):
+        """Recount every post's votes from the raw Vote rows."""
+        def count(is_bad):
+            votes = (
+                Vote.objects
+                    .filter(post=models.OuterRef("pk"), is_bad=is_bad)
+                    .order_by()
+                    .values("post")
+                    .annotate(count=models.Count("id"))
+                    .values("count")
+            )
+            return Coalesce(models.Subquery(votes), 0)
+        return cls.objects.update(
+            bad_votes=count(VoteField.Bad()),
+            not_bad_votes=count(VoteField.Good()),
+        )
 
     def get_current_vote_counts(self):
-        _id = self.id        
-        vote_counts = (
-            Vote
-                .objects
-                .filter(post__id=_id)
-                .all()
-                .values('post_id', 'is_bad')
-                .annotate(count=models.Count('id'))
+        counts = (
+            Post.objects
+                .filter(pk=self.id)
+                .values("bad_votes", "not_bad_votes")
+                .get()
         )
+        return self._vote_counts(counts)
+
+    async def aget_current_vote_counts(self):
+        counts = await (
+            Post.objects
+                .filter(pk=self.id)
+                .values("bad_votes", "not_bad_votes")
+                .aget()
+        )
+        return self._vote_counts(counts)
+
+    @staticmethod
+    def _vote_counts(counts):
         result = defaultdict(int)
-        for count in vote_counts:
-            if count['is_bad']:
-                result['is_bad'] = count['count']
-            else:
-                result['not_bad'] = count['count']
+        result['is_bad'] = counts['bad_votes']
+        result['not_bad'] = counts['not_bad_votes']
         return result
 
 
-class PostApproval(models.Model):
-    post = models.ForeignKey(Post, null=False, on_delete=models.PROTECT)
-    approved_at = models.DateTimeField(null=True)
-
 class VoteField(models.BooleanField):
     description = "A Vote, good or bad code."
 
@@ -70,26 +139,44 @@ class Vote(models.Model):
     is_bad = VoteField(null=False, db_index=True)
 
     @classmethod
-    def new(cls, post_id: int, is_bad: bool) -> "Vote":
-        post = Post.objects.get(pk=post_id)
-        if post is None:
-            return None
-        return Vote(post=post, is_bad=is_bad)
+    def new(cls, post, is_bad: bool) -> "Vote":
+        """`post` may be a loaded Post or just its id; neither is queried."""
+        if isinstance(post, Post):
+            return Vote(post=post, is_bad=is_bad)
+        return Vote(post_id=post, is_bad=is_bad)
 
 
 class Suggestion(PublishableMixin, models.Model):
     post = models.ForeignKey(Post, null=False, on_delete=models.PROTECT)
     code = models.TextField(null=False)
     description = models.TextField()
+    code_hash = models.CharField(max_length=64, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["post", "code_hash"]),
+            # a post's approved suggestions in id order, see
+            # catalog.approved_suggestion_ids
+            models.Index(
+                fields=["post", "id"], name="posts_suggestion_approved",
+                condition=models.Q(approved_at__isnull=False)),
+        ]
 
     @classmethod
-    def new(cls, post_id: int, code: bytes, summary: str):
-        post = Post.objects.get(pk=post_id)
-        if post is None:
-            return None
-        return Suggestion(post=post, code=code, description=summary)
-
-class SuggestionApproval(models.Model):
-    suggestion = models.ForeignKey(Suggestion, null=False, on_delete=models.PROTECT)
-    approved_at = models.DateTimeField(null=True)
-    
+    def new(cls, post, code: str, summary: str, code_hash=None) -> "Suggestion":
+        """`post` may be a loaded Post or just its id; neither is queried.
+
+        Raises DuplicateError if the post already has a suggestion with the
+        same code_hash, or if the code is the post's own.
+        """
+        post_id = post.id if isinstance(post, Post) else post
+        if code_hash is not None:
+            duplicate = (
+                cls.objects.filter(post_id=post_id, code_hash=code_hash).exists()
+                or (isinstance(post, Post) and post.code_hash == code_hash)
+            )
+            if duplicate:
+                raise DuplicateError(code_hash)
+        if isinstance(post, Post):
+            return Suggestion(post=post, code=code, description=summary, code_hash=code_hash)
+        return Suggestion(post_id=post, code=code, description=summary, code_hash=code_hash)
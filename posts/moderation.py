@@ -0,0 +1,126 @@
+"""Approve, reject and delete posts and suggestions in bulk.
+
+Each call runs in one transaction, approving and rejecting with a fixed
+number of set-based statements however many ids it is given. ``update()``
+sends no model signals, so the catalog caches the signal receivers would
+have cleared are invalidated here once the transaction commits. Deletes
+go through ``delete()``, which fetches the rows it deletes to send their
+signals; they are rare next to approvals.
+"""
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import catalog
+from .highlight import highlight_code
+from .models import Post, Suggestion, Vote
+
+
+logger = logging.getLogger("posts.moderation")
+
+
+def _approve(model, ids, now):
+    """Approve the existing objects among `ids`; returns (approved, already)."""
+    rows = model.objects.filter(pk__in=ids).values_list("id", "approved_at")
+    already = {i for i, approved_at in rows if approved_at is not None}
+    pending = {i for i, approved_at in rows if approved_at is None}
+    model.objects.filter(pk__in=pending, approved_at=None).update(approved_at=now)
+    return pending, already
+
+
+def _reject(model, ids):
+    """Return approved objects among `ids` to moderation; returns their ids."""
+    rejected = set(
+        model.objects.filter(pk__in=ids, approved_at__isnull=False)
+        .values_list("id", flat=True))
+    model.objects.filter(pk__in=rejected).update(approved_at=None)
+    return rejected
+
+
+def _check(approve, reject, delete):
+    approve, reject, delete = set(approve), set(reject), set(delete)
+    conflicts = (approve & reject) | (approve & delete) | (reject & delete)
+    if conflicts:
+        raise ValueError("Conflicting decisions for %s" % sorted(conflicts))
+    return approve, reject, delete
+
+
+def moderate_posts(approve=(), reject=(), delete=()):
+    """Approve, reject and delete posts by id, in one transaction.
+
+    Rejecting takes an approved post back off the site. Deleting a post
+    deletes its votes and suggestions with it. Returns a dict of sorted id
+    lists: approved, already_approved, rejected, deleted and missing
+    (requested ids with no post, or rejected ids that were not approved).
+    """
+    approve, reject, delete = _check(approve, reject, delete)
+    now = timezone.now()
+    with transaction.atomic():
+        approved, already = _approve(Post, approve, now)
+        rejected = _reject(Post, reject)
+        deleted = set(
+            Post.objects.filter(pk__in=delete).values_list("id", flat=True))
+        if deleted:
+            # votes and suggestions protect their post from deletion
+            Suggestion.objects.filter(post_id__in=deleted).delete()
+            Vote.objects.filter(post_id__in=deleted).delete()
+            Post.objects.filter(pk__in=deleted).delete()
+        transaction.on_commit(lambda: _posts_changed(approved, rejected | deleted))
+    result = {
+        "approved": sorted(approved),
+        "already_approved": sorted(already),
+        "rejected": sorted(rejected),
+        "deleted": sorted(deleted),
+        "missing": sorted(
+            (approve | reject | delete) - approved - already - rejected - deleted),
+    }
+    logger.info("Moderated posts: %s", result)
+    return result
+
+
+def moderate_suggestions(approve=(), reject=(), delete=()):
+    """Approve, reject and delete suggestions by id, in one transaction.
+
+    Returns a dict of sorted id lists like moderate_posts.
+    """
+    approve, reject, delete = _check(approve, reject, delete)
+    now = timezone.now()
+    with transaction.atomic():
+        approved, already = _approve(Suggestion, approve, now)
+        rejected = _reject(Suggestion, reject)
+        deleted = set(
+            Suggestion.objects.filter(pk__in=delete).values_list("id", flat=True))
+        changed = approved | rejected | deleted
+        post_ids = set(
+            Suggestion.objects.filter(pk__in=changed).values_list("post_id", flat=True))
+        if deleted:
+            Suggestion.objects.filter(pk__in=deleted).delete()
+        transaction.on_commit(lambda: _suggestions_changed(approved, post_ids))
+    result = {
+        "approved": sorted(approved),
+        "already_approved": sorted(already),
+        "rejected": sorted(rejected),
+        "deleted": sorted(deleted),
+        "missing": sorted(
+            (approve | reject | delete) - approved - already - rejected - deleted),
+    }
+    logger.info("Moderated suggestions: %s", result)
+    return result
+
+
+def _posts_changed(approved, removed):
+    if approved or removed:
+        catalog.invalidate_approved_posts()
+    for post_id in removed:
+        catalog.invalidate_approved_suggestions(post_id)
+        catalog.invalidate_post_fragment(post_id)
+    for code in Post.objects.filter(pk__in=approved).values_list("code", flat=True):
+        highlight_code(code)
+
+
+def _suggestions_changed(approved, post_ids):
+    for post_id in post_ids:
+        catalog.invalidate_approved_suggestions(post_id)
+    for code in Suggestion.objects.filter(pk__in=approved).values_list("code", flat=True):
+        highlight_code(code)
@@ -0,0 +1,118 @@
+"""PostgreSQL with connections pooled per worker process, see posts.db_pool.
+
+The pool is configured by the database's "POOL" settings: SIZE, TIMEOUT,
+CHECK_AFTER and MAX_LIFETIME, in seconds, passed on to ConnectionPool.
+CONN_MAX_AGE must stay 0, so each request gives its connection back.
+"""
+from functools import partial
+import logging
+
+from django.db.backends.postgresql import base
+import psycopg2.extras
+from psycopg2 import extensions
+
+from .. import db_pool
+
+
+Database = base.Database
+
+logger = logging.getLogger("posts.pooled_postgres")
+
+
+def _connect(conn_params, isolation_level=None):
+    connection = Database.connect(**conn_params)
+    if isolation_level is not None and isolation_level != connection.isolation_level:
+        connection.set_session(isolation_level=isolation_level)
+    # as the postgresql backend does, to leave decoding jsonb to Django
+    psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+    return connection
+
+
+def _check(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        if not connection.autocommit:
+            connection.rollback()
+        return True
+    except Database.Error:
+        logger.info("Replacing a pooled connection that failed its check")
+        return False
+
+
+def _reset(connection):
+    """Roll back whatever the connection left open; False if it is unusable."""
+    if connection.closed:
+        return False
+    status = connection.info.transaction_status
+    if status == extensions.TRANSACTION_STATUS_IDLE:
+        return True
+    if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+        try:
+            connection.rollback()
+            return True
+        except Database.Error:
+            return False
+    return False
+
+
+def _install_wait_callback():
+    """Wait on the database's socket through gevent when it has patched
+    the worker, so a greenlet blocked on a query yields to the others."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return
+    if not monkey.is_module_patched("socket"):
+        return
+    from gevent.socket import wait_read, wait_write
+
+    def wait(connection, timeout=None):
+        while True:
+            state = connection.poll()
+            if state == extensions.POLL_OK:
+                return
+            elif state == extensions.POLL_READ:
+                wait_read(connection.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(connection.fileno(), timeout=timeout)
+            else:
+                raise Database.OperationalError("Bad result from poll: %r" % state)
+
+    extensions.set_wait_callback(wait)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _pool(self, conn_params=None):
+        def factory():
+            _install_wait_callback()
+            options = self.settings_dict.get("POOL", {})
+            params = conn_params if conn_params is not None else self.get_connection_params()
+            return db_pool.ConnectionPool(
+                partial(_connect, params, self.settings_dict["OPTIONS"].get("isolation_level")),
+                size=options.get("SIZE", 10),
+                timeout=options.get("TIMEOUT", 5.0),
+                check=_check,
+                check_after=options.get("CHECK_AFTER", 30.0),
+                max_lifetime=options.get("MAX_LIFETIME", 30 * 60.0),
+                alias=self.alias,
+            )
+        return db_pool.get_pool(self.alias, factory)
+
+    def get_new_connection(self, conn_params):
+        try:
+            connection = self._pool(conn_params).get()
+        except db_pool.PoolTimeout as e:
+            raise Database.OperationalError(str(e)) from e
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        # Django keeps using a connection closed in an atomic block until
+        # the block exits, so that one can't go back to the pool
+        reusable = not self.in_atomic_block and _reset(self.connection)
+        with self.wrap_database_errors:
+            self._pool().put(self.connection, reusable=reusable)
@@ -0,0 +1,141 @@
+"""Per-request database and template profiling.
+
+The ``posts.middleware.profile_requests`` middleware times every request,
+and for a sample of them also counts queries through an execute wrapper
+on each database connection and times template rendering through
+``ProfiledTemplates``. Totals and histograms are kept per view, in each
+worker process, and served at ``/internal/profile``.
+"""
+from contextvars import ContextVar
+import threading
+import time
+
+from django.template.backends.django import DjangoTemplates
+
+
+# upper bounds of the request latency histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# upper bounds of the queries per request histogram
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+# characters of SQL kept for the slowest query
+SQL_LENGTH = 500
+
+# the profile of the request being handled, if it was sampled
+current_profile = ContextVar("current_profile", default=None)
+
+
+def _bucket(bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+class RequestProfile:
+    """Collects one request's queries; installed with execute_wrapper."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.slowest_sql = None
+        self.slowest_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            self.queries += 1
+            self.db_seconds += seconds
+            if seconds > self.slowest_seconds:
+                self.slowest_sql, self.slowest_seconds = sql, seconds
+
+
+class Profiler:
+    """Per-view request statistics for this worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def _new_view(self):
+        return {
+            "requests": 0,
+            "seconds_total": 0.0,
+            "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            "sampled": 0,
+            "queries_total": 0,
+            "query_buckets": [0] * (len(QUERY_BUCKETS) + 1),
+            "db_seconds_total": 0.0,
+            "render_seconds_total": 0.0,
+            "slowest_query": None,
+        }
+
+    def record(self, view, seconds, profile=None):
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = self._new_view()
+            stats["requests"] += 1
+            stats["seconds_total"] += seconds
+            stats["latency_buckets"][_bucket(LATENCY_BUCKETS, seconds)] += 1
+            if profile is None:
+                return
+            stats["sampled"] += 1
+            stats["queries_total"] += profile.queries
+            stats["query_buckets"][_bucket(QUERY_BUCKETS, profile.queries)] += 1
+            stats["db_seconds_total"] += profile.db_seconds
+            stats["render_seconds_total"] += profile.render_seconds
+            slowest = stats["slowest_query"]
+            if profile.slowest_sql and (slowest is None or profile.slowest_seconds > slowest["seconds"]):
+                stats["slowest_query"] = {
+                    "sql": profile.slowest_sql[:SQL_LENGTH],
+                    "seconds": profile.slowest_seconds,
+                }
+
+    def stats(self):
+        """A copy of the per-view statistics, with labelled histograms."""
+        with self._lock:
+            views = {
+                view: dict(stats, latency_buckets=list(stats["latency_buckets"]),
+                           query_buckets=list(stats["query_buckets"]))
+                for view, stats in self._views.items()
+            }
+        for stats in views.values():
+            stats["latency_buckets"] = dict(
+                zip(map(str, LATENCY_BUCKETS + ("+Inf",)), stats["latency_buckets"]))
+            stats["query_buckets"] = dict(
+                zip(map(str, QUERY_BUCKETS + ("+Inf",)), stats["query_buckets"]))
+        return views
+
+
+profiler = Profiler()
+
+
+class ProfiledTemplate:
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        profile = current_profile.get()
+        if profile is None:
+            return self.template.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            profile.render_seconds += time.perf_counter() - start
+
+
+class ProfiledTemplates(DjangoTemplates):
+    """The Django template backend, timing renders of sampled requests."""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return ProfiledTemplate(super().get_template(template_name))
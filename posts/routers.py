@@ -0,0 +1,151 @@
+"""Reads from the database replicas in DATABASE_REPLICAS.
+
+The ``posts.middleware.replica_reads`` middleware picks a replica for each
+GET or HEAD request, and the router sends that request's reads to it. Every
+other read goes to the primary: those of other requests, of management
+commands and background threads, those in a transaction on the primary,
+and those of sessions and users, which a GET can write too.
+A client that wrote recently is pinned to the primary for
+REPLICA_PIN_SECONDS, so it reads its own writes despite replication lag.
+
+A replica that can't be connected to is skipped for REPLICA_RETRY_SECONDS.
+Every REPLICA_LAG_CHECK_SECONDS each replica's lag is measured, and one
+more than REPLICA_MAX_LAG seconds behind is skipped until it catches up.
+With no usable replica, reads fall back to the primary.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from . import metrics
+
+
+logger = logging.getLogger("posts.routers")
+
+# the replica the current request reads from, if any
+read_alias = ContextVar("read_alias", default=None)
+
+LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+def replication_lag(alias):
+    """Seconds the replica is behind the primary; 0 for databases without
+    streaming replication, such as the SQLite ones of the tests."""
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(LAG_SQL)
+        lag, = cursor.fetchone()
+    return float(lag or 0)
+
+
+class ReplicaHealth:
+    """Which replicas are usable, as seen by this worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._down_until = {}
+            self._lag = {}
+            self._lag_checked = {}
+
+    def choose(self):
+        """A usable replica to read from, connected, or None for the primary."""
+        replicas = list(settings.DATABASE_REPLICAS)
+        random.shuffle(replicas)
+        now = time.monotonic()
+        for alias in replicas:
+            with self._lock:
+                if self._down_until.get(alias, 0) > now:
+                    continue
+                last_checked = self._lag_checked.get(alias, -float("inf"))
+                check_lag = now - last_checked >= settings.REPLICA_LAG_CHECK_SECONDS
+                if check_lag:
+                    # only one request at a time measures it
+                    self._lag_checked[alias] = now
+            try:
+                connections[alias].ensure_connection()
+                if check_lag:
+                    lag = self._lag[alias] = replication_lag(alias)
+                    if lag > settings.REPLICA_MAX_LAG:
+                        logger.warning("Replica %s is %.1fs behind, reading from others", alias, lag)
+            except DatabaseError:
+                logger.warning(
+                    "Replica %s is unreachable, skipping it for %ss",
+                    alias, settings.REPLICA_RETRY_SECONDS, exc_info=True)
+                metrics.replica_skips.inc(database=alias, reason="down")
+                with self._lock:
+                    self._down_until[alias] = now + settings.REPLICA_RETRY_SECONDS
+                continue
+            if self._lag.get(alias, 0) > settings.REPLICA_MAX_LAG:
+                metrics.replica_skips.inc(database=alias, reason="lag")
+                continue
+            return alias
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                alias: {
+                    "down_for": max(0.0, self._down_until.get(alias, 0) - now),
+                    "lag": self._lag.get(alias),
+                }
+                for alias in settings.DATABASE_REPLICAS
+            }
+
+
+health = ReplicaHealth()
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary within the block, e.g. to fill a cache that
+    would otherwise keep a lagging replica's answer."""
+    token = read_alias.set(None)
+    try:
+        yield
+    finally:
+        read_alias.reset(token)
+
+
+def _in_transaction():
+    # as Django does for durable blocks, ignoring the blocks a TestCase
+    # wraps each test in
+    blocks = connections[DEFAULT_DB_ALIAS].atomic_blocks
+    return any(not block._from_testcase for block in blocks)
+
+
+# apps whose rows a GET writes, e.g. the session, and the next request
+# reads back before a replica may have caught up
+PRIMARY_APPS = {"sessions", "auth"}
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = read_alias.get()
+        if alias is None or model._meta.app_label in PRIMARY_APPS or _in_transaction():
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
@@ -0,0 +1,101 @@
+import base64
+
+from .varint import read_varint, write_varint
+
+
+# longest encoding kept in a session, a few hundred spread out ids or over a
+# thousand close together; sessions live in 512 byte cache slots
+SEEN_MAX_LENGTH = 256
+
+
+class SeenSet:
+    """A compact set of post ids, stored in the session as text.
+
+    It is encoded either as a bitmap over the span of the ids, ``offset:bits``
+    with bit ``i`` marking post ``offset + i``, or as the sorted ids in varint
+    deltas, ``d:deltas``, whichever is shorter. Ids close together cost a
+    bit each and ids far apart a few bytes each, so the payload grows with
+    the number of posts seen rather than the span of their ids.
+    """
+
+    def __init__(self, ids=()):
+        self.ids = set(ids)
+
+    @classmethod
+    def from_session(cls, value):
+        if not value:
+            return cls()
+        if isinstance(value, list):
+            # sessions from before the bitmap stored a plain list of ids
+            return cls(i for i in value if isinstance(i, int))
+        try:
+            kind, encoded = value.split(":", 1)
+            data = base64.urlsafe_b64decode(encoded)
+            if kind == "d":
+                return cls(_read_deltas(data))
+            return cls(_read_bitmap(int(kind), data))
+        except (ValueError, IndexError):
+            return cls()
+
+    def encode(self):
+        ids = sorted(self.ids)
+        deltas = _write_deltas(ids)
+        span = ids[-1] - (ids[0] & ~7) + 1 if ids else 0
+        if len(deltas) < (span + 7) >> 3:
+            return "d:" + base64.urlsafe_b64encode(deltas).decode("ascii")
+        offset, bits = _write_bitmap(ids)
+        return f"{offset}:" + base64.urlsafe_b64encode(bits).decode("ascii")
+
+    def __contains__(self, post_id):
+        return post_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return bool(self.ids)
+
+    def add(self, post_id):
+        """Mark a post as seen, returning False if it already was."""
+        if post_id in self.ids:
+            return False
+        self.ids.add(post_id)
+        return True
+
+
+def _write_deltas(ids):
+    out, last = bytearray(), 0
+    for i in ids:
+        write_varint(out, i - last)
+        last = i
+    return bytes(out)
+
+
+def _read_deltas(data):
+    ids, last, pos = [], 0, 0
+    while pos < len(data):
+        delta, pos = read_varint(data, pos)
+        last += delta
+        ids.append(last)
+    return ids
+
+
+def _write_bitmap(ids):
+    if not ids:
+        return 0, b""
+    offset = ids[0] & ~7
+    bits = bytearray(((ids[-1] - offset) >> 3) + 1)
+    for post_id in ids:
+        i = post_id - offset
+        bits[i >> 3] |= 1 << (i & 7)
+    return offset, bytes(bits)
+
+
+def _read_bitmap(offset, bits):
+    if offset < 0:
+        raise ValueError("negative offset")
+    return [
+        offset + (n << 3) + bit
+        for n, byte in enumerate(bits) if byte
+        for bit in range(8) if byte & (1 << bit)
+    ]
@@ -0,0 +1,295 @@
+"""Cache-backed sessions with a compact binary encoding.
+
+Sessions here mostly hold post ids: the posts a visitor submitted, their
+votes and suggestions keyed by post, and the ``posts_seen`` set. The ids
+are written sorted, as varint deltas, and anything else in the session falls
+back to JSON. Sessions are only written when a view changes them, and then
+to the cache rather than the database.
+
+Sessions already in the database are not moved: switching SESSION_ENGINE
+from the database to this backend starts every visitor on a new session.
+The serializer does read Django's JSON, so with the database or signed
+cookie backends existing sessions carry on.
+"""
+import base64
+import json
+
+from django.contrib.sessions.backends import cache
+from django.contrib.sessions.backends.base import CreateError, UpdateError
+
+from . import metrics
+from .varint import read_varint, write_varint
+
+
+VERSION = 1
+
+# section tags
+POSTS, SEEN, VOTES, SUGGESTIONS, OTHER, SEEN_DELTAS = 1, 2, 3, 4, 5, 6
+
+# vote flags
+IS_BAD, HAS_ID, HAS_TOKEN = 1, 2, 4
+
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _by_post_id(d):
+    """Re-key a dict by int post id, or None if a key is not a post id.
+
+    Views add int keys to dicts loaded with str keys; as with JSON, the
+    entry set last wins.
+    """
+    by_id = {}
+    for key, value in d.items():
+        try:
+            post_id = int(key)
+        except (TypeError, ValueError):
+            return None
+        if post_id < 0:
+            return None
+        by_id[post_id] = value
+    return by_id
+
+
+def _write_ids(out, ids):
+    write_varint(out, len(ids))
+    last = 0
+    for i in ids:
+        write_varint(out, i - last)
+        last = i
+
+
+def _read_ids(data, pos):
+    count, pos = read_varint(data, pos)
+    ids, last = [], 0
+    for _ in range(count):
+        delta, pos = read_varint(data, pos)
+        last += delta
+        ids.append(last)
+    return ids, pos
+
+
+def _encode_posts(out, posts):
+    if not isinstance(posts, list) or not all(_is_id(i) for i in posts):
+        return False
+    # only membership is ever checked, so order need not be kept
+    _write_ids(out, sorted(posts))
+    return True
+
+
+def _encode_seen(out, seen):
+    if not isinstance(seen, str):
+        return False
+    try:
+        offset, encoded = seen.split(":", 1)
+        bits = base64.urlsafe_b64decode(encoded)
+        offset = int(offset)
+    except ValueError:
+        return False
+    if offset < 0:
+        return False
+    write_varint(out, offset)
+    write_varint(out, len(bits))
+    out.extend(bits)
+    return True
+
+
+def _encode_seen_deltas(out, seen):
+    if not isinstance(seen, str) or not seen.startswith("d:"):
+        return False
+    try:
+        deltas = base64.urlsafe_b64decode(seen[2:])
+        pos = 0
+        while pos < len(deltas):
+            _, pos = read_varint(deltas, pos)
+    except (ValueError, IndexError):
+        return False
+    write_varint(out, len(deltas))
+    out.extend(deltas)
+    return True
+
+
+def _encode_votes(out, votes):
+    if not isinstance(votes, dict):
+        return False
+    votes = _by_post_id(votes)
+    if votes is None:
+        return False
+    ids = sorted(votes)
+    entries = []
+    for post_id in ids:
+        vote = votes[post_id]
+        if not isinstance(vote, dict) or set(vote) - {"id", "is_bad", "token"}:
+            return False
+        vote_id, is_bad, token = vote.get("id"), vote.get("is_bad"), vote.get("token")
+        if not isinstance(is_bad, bool) or not (vote_id is None or _is_id(vote_id)):
+            return False
+        if token is not None:
+            try:
+                token = bytes.fromhex(token)
+            except (TypeError, ValueError):
+                return False
+            if len(token) != 16:
+                return False
+        entries.append((vote_id, is_bad, token))
+    write_varint(out, len(ids))
+    last = 0
+    for post_id, (vote_id, is_bad, token) in zip(ids, entries):
+        write_varint(out, post_id - last)
+        last = post_id
+        flags = (IS_BAD if is_bad else 0) | (HAS_ID if vote_id is not None else 0)
+        flags |= HAS_TOKEN if token is not None else 0
+        out.append(flags)
+        if vote_id is not None:
+            write_varint(out, vote_id)
+        if token is not None:
+            out.extend(token)
+    return True
+
+
+def _encode_suggestions(out, suggestions):
+    if not isinstance(suggestions, dict):
+        return False
+    suggestions = _by_post_id(suggestions)
+    if suggestions is None:
+        return False
+    ids = sorted(suggestions)
+    values = [suggestions[i] for i in ids]
+    if not all(_is_id(v) for v in values):
+        return False
+    _write_ids(out, ids)
+    for value in values:
+        write_varint(out, value)
+    return True
+
+
+def _take(data, pos, length):
+    if pos + length > len(data):
+        raise ValueError("Truncated session data")
+    return data[pos:pos + length], pos + length
+
+
+# the sections a key may be written as, tried in order
+ENCODERS = {
+    "posts": [(POSTS, _encode_posts)],
+    "posts_seen": [(SEEN, _encode_seen), (SEEN_DELTAS, _encode_seen_deltas)],
+    "votes": [(VOTES, _encode_votes)],
+    "suggestions": [(SUGGESTIONS, _encode_suggestions)],
+}
+
+
+class CompactSerializer:
+    """Session serializer for use with signing.dumps and signing.loads.
+
+    Loads the JSON written by Django's default serializer too, so sessions
+    kept in the database or in cookies survive the switch of serializer.
+    """
+
+    def dumps(self, obj):
+        out = bytearray([VERSION])
+        other = {}
+        for key, value in obj.items():
+            for tag, encode in ENCODERS.get(key, ()):
+                section = bytearray()
+                if encode(section, value):
+                    out.append(tag)
+                    out.extend(section)
+                    break
+            else:
+                other[key] = value
+        if other:
+            data = json.dumps(other, separators=(",", ":")).encode()
+            out.append(OTHER)
+            write_varint(out, len(data))
+            out.extend(data)
+        return bytes(out)
+
+    def loads(self, data):
+        if data[:1] != bytes([VERSION]):
+            return json.loads(data.decode("latin-1"))
+        try:
+            return self._read_sections(data)
+        except IndexError:
+            raise ValueError("Truncated session data") from None
+
+    def _read_sections(self, data):
+        session, pos = {}, 1
+        while pos < len(data):
+            tag = data[pos]
+            pos += 1
+            if tag == POSTS:
+                session["posts"], pos = _read_ids(data, pos)
+            elif tag == SEEN:
+                offset, pos = read_varint(data, pos)
+                length, pos = read_varint(data, pos)
+                bits, pos = _take(data, pos, length)
+                bits = base64.urlsafe_b64encode(bits).decode("ascii")
+                session["posts_seen"] = f"{offset}:{bits}"
+            elif tag == SEEN_DELTAS:
+                length, pos = read_varint(data, pos)
+                deltas, pos = _take(data, pos, length)
+                deltas = base64.urlsafe_b64encode(deltas).decode("ascii")
+                session["posts_seen"] = f"d:{deltas}"
+            elif tag == VOTES:
+                count, pos = read_varint(data, pos)
+                votes, post_id = {}, 0
+                for _ in range(count):
+                    delta, pos = read_varint(data, pos)
+                    post_id += delta
+                    flags = data[pos]
+                    pos += 1
+                    vote = {"id": None, "is_bad": bool(flags & IS_BAD)}
+                    if flags & HAS_ID:
+                        vote["id"], pos = read_varint(data, pos)
+                    if flags & HAS_TOKEN:
+                        token, pos = _take(data, pos, 16)
+                        vote["token"] = token.hex()
+                    votes[str(post_id)] = vote
+                session["votes"] = votes
+            elif tag == SUGGESTIONS:
+                ids, pos = _read_ids(data, pos)
+                suggestions = {}
+                for post_id in ids:
+                    suggestions[str(post_id)], pos = read_varint(data, pos)
+                session["suggestions"] = suggestions
+            elif tag == OTHER:
+                length, pos = read_varint(data, pos)
+                other, pos = _take(data, pos, length)
+                session.update(json.loads(other.decode()))
+            else:
+                raise ValueError("Unknown session section %s" % tag)
+        return session
+
+
+class SessionStore(cache.SessionStore):
+    """Stores the compact encoding in the cache instead of a pickled dict."""
+
+    def load(self):
+        try:
+            data = self._cache.get(self.cache_key)
+        except Exception:
+            data = None
+        if data is not None:
+            try:
+                return self.serializer().loads(data)
+            except Exception:
+                # an undecodable session is reset, like Django does
+                pass
+        self._session_key = None
+        return {}
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        if must_create:
+            func = self._cache.add
+        elif self._cache.has_key(self.cache_key):
+            func = self._cache.set
+        else:
+            raise UpdateError
+        data = self.serializer().dumps(self._get_session(no_load=must_create))
+        result = func(self.cache_key, data, self.get_expiry_age())
+        metrics.session_writes.inc()
+        if must_create and not result:
+            raise CreateError
@@ -0,0 +1,33 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import catalog
+from .highlight import highlight_code
+from .models import Post, Suggestion
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def post_changed(sender, instance, created=False, **kwargs):
+    if created and instance.approved_at is None:
+        # a pending post is not in the list yet, nor rendered anywhere
+        return
+    catalog.invalidate_approved_posts()
+    if not created:
+        catalog.invalidate_post_fragment(instance.id)
+
+
+@receiver(post_save, sender=Suggestion)
+@receiver(post_delete, sender=Suggestion)
+def suggestion_changed(sender, instance, created=False, **kwargs):
+    if created and instance.approved_at is None:
+        # a pending suggestion is not in the index yet
+        return
+    catalog.invalidate_approved_suggestions(instance.post_id)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Suggestion)
+def highlight_approved(sender, instance, **kwargs):
+    if instance.approved_at is not None:
+        highlight_code(instance.code)
@@ -1,4 +1,7 @@
 from django import template
+from django.conf import settings
+
+from ..highlight import highlight_code
 
 register = template.Library()
 
@@ -17,4 +20,14 @@ def exists(context, arg):
 
 @register.simple_tag(takes_context=False)
 def define(val=None):
-    return val
\ No newline at end of file
+    return val
+
+@register.simple_tag(takes_context=False)
+def post_fragment_version():
+    """Part of the post fragment cache key, bumped when the markup changes."""
+    return settings.POST_FRAGMENT_VERSION
+
+
+@register.filter
+def highlight(code):
+    return highlight_code(code)
@@ -1,3 +1,1138 @@
-from django.test import TestCase
+import ast
+import fcntl
+import json
+import multiprocessing
+import os
+import runpy
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from importlib import import_module
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+
+from . import async_views, catalog, metrics, middleware, routers, sessions, views
+from .cache import SLOT_HEADER, MmapCache
+from .db_pool import ConnectionPool, PoolTimeout
+from .exceptions import DuplicateError
+from .feed import RandomFeed
+from .management.commands.approve_posts import parse_ids
+from .middleware import SlidingWindowLimiter
+from .moderation import moderate_posts, moderate_suggestions
+from .profiler import Profiler
+from .seen import SeenSet
+from .sessions import CompactSerializer, SessionStore
+from .models import Post, Suggestion, Vote
+from .validation import INVALID, Validator, code_hash
+from .vote_buffer import TOKEN_KEY, VoteBuffer
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class QueryCountTest(TestCase):
+    """Pin the number of queries each endpoint issues.
+
+    Sessions live in the cache, so loading and saving them costs no queries.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(
+            title="bad", code="x = 1", approved_at=timezone.now())
+        self.suggestion = Suggestion.objects.create(
+            post=self.post, code="x = 2", description="better", approved_at=timezone.now())
+
+    def _post_json(self, url, body):
+        return self.client.post(url, json.dumps(body), content_type="application/json")
+
+    def test_index(self):
+        Post.objects.create(title="worse", code="y = 1", approved_at=timezone.now())
+        # warm the approved post ids
+        self.client.get(reverse("index"))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_vote(self):
+        url = reverse("vote", args=[self.post.id])
+        with self.assertNumQueries(6):
+            response = self._post_json(url, {"isBad": True})
+        self.assertEqual(response.json()["currentVoteCounts"], {"bad": 1, "notBad": 0})
+
+    def test_change_vote(self):
+        url = reverse("vote", args=[self.post.id])
+        self._post_json(url, {"isBad": True})
+        with self.assertNumQueries(7):
+            response = self._post_json(url, {"isBad": False})
+        self.assertEqual(response.json()["currentVoteCounts"], {"bad": 0, "notBad": 1})
+        self.assertEqual(Vote.objects.count(), 1)
+
+    def test_concurrent_change_counts_once(self):
+        vote = Vote.objects.create(post=self.post, is_bad=True)
+        Post.objects.filter(pk=self.post.id).update(bad_votes=1)
+        # two requests that both read the vote before either changed it
+        for _ in range(2):
+            views.VoteView._save_vote(self.post, Vote(id=vote.id, post=self.post, is_bad=False), True)
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.bad_votes, self.post.not_bad_votes), (0, 1))
+
+    def test_submit(self):
+        # the insert, in a savepoint so a duplicate can be caught
+        with self.assertNumQueries(3):
+            response = self._post_json(reverse("submit"), {"title": "t", "code": "y = 1"})
+        self.assertRedirects(response, reverse("index"), fetch_redirect_response=False)
+
+    def test_suggest(self):
+        url = reverse("suggest", args=[self.post.id])
+        with self.assertNumQueries(3):
+            response = self._post_json(url, {"code": "x = 3", "summary": "s"})
+        self.assertRedirects(response, reverse("index"), fetch_redirect_response=False)
+
+    def test_suggestions(self):
+        url = reverse("suggestions", args=[self.post.id])
+        # warm the approved suggestion ids
+        self.client.get(url)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.context["suggestion"], self.suggestion)
+
+    def test_suggestion_detail(self):
+        url = reverse("suggestion_detail", args=[self.post.id, self.suggestion.id])
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.context["suggestion"], self.suggestion)
+        # the code is highlighted, not shown raw
+        self.assertContains(response, '<span class="n">')
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class DuplicateTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _post_json(self, url, body):
+        return self.client.post(url, json.dumps(body), content_type="application/json")
+
+    def test_duplicate_submission(self):
+        self._post_json(reverse("submit"), {"title": "t", "code": "x = 1"})
+        # whitespace and comments do not make it different code
+        response = self._post_json(reverse("submit"), {"title": "u", "code": "x=1  # again\n"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("already", response.json()["message"])
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_duplicate_suggestion(self):
+        self._post_json(reverse("submit"), {"title": "t", "code": "x = 1"})
+        post = Post.objects.get()
+        url = reverse("suggest", args=[post.id])
+        response = self._post_json(url, {"code": "x = 1", "summary": "same"})
+        self.assertIn("already", response.json()["message"])
+        self._post_json(url, {"code": "x = 2", "summary": "better"})
+        # a different session suggesting the same code
+        self.client = self.client_class()
+        response = self._post_json(url, {"code": "x = (2)", "summary": "also better"})
+        self.assertIn("already", response.json()["message"])
+        self.assertEqual(Suggestion.objects.count(), 1)
+
+    def test_duplicate_post(self):
+        Post.objects.create(title="t", code="x = 1", code_hash="h")
+        with self.assertRaises(DuplicateError):
+            Post.new("u", "x=1", code_hash="h")
+        # the transaction is still usable
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_code_hash_is_stable(self):
+        # stored hashes must not change with the Python version or a later
+        # edit of code_hash, which would need another rehash migration
+        tree = ast.parse("x = a[1, 2:3]\ny = f'{x:>{w}}'")
+        expected = "16e8ab9524ba434e12cf0f8f2a93ef81583900a5a453f56ca66e5606d8981e17"
+        self.assertEqual(code_hash(tree), expected)
+        migration = import_module("posts.migrations.0009_stable_code_hash")
+        self.assertEqual(migration.code_hash(tree), expected)
+
+
+@override_settings(RATELIMIT_ENABLE=False, VALIDATION_WORKERS=1)
+class ValidationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.validator = Validator()
+        self.addCleanup(self._shutdown)
+        patcher = mock.patch("posts.views.validator", self.validator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _shutdown(self):
+        if self.validator._pool is not None:
+            self.validator._pool.shutdown()
+
+    def _submit(self, code):
+        return self.client.post(
+            reverse("submit"), json.dumps({"title": "t", "code": code}),
+            content_type="application/json")
+
+    def test_timeout_replaces_pool(self):
+        nested = "x = " + "[" * 90 + "]" * 90
+        with override_settings(VALIDATION_TIMEOUT=0.001):
+            response = self._submit(nested)
+        # the form shows the message of a 200, as for invalid code
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["errors"][0]["reason"], "took too long to parse")
+        self.assertIsNone(self.validator._pool)
+        self.assertEqual(self.validator.stats()["timeouts"], 1)
+        # a new pool parses the next submission
+        response = self._submit(nested)
+        self.assertRedirects(response, reverse("index"), fetch_redirect_response=False)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_invalid_code(self):
+        response = self._submit("x = (")
+        self.assertEqual(response.json()["message"], INVALID)
+        self.assertEqual(Post.objects.count(), 0)
+
+
+class ModerationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.posts = [Post.objects.create(title=str(i), code="x = %s" % i) for i in range(4)]
+
+    def test_query_count_does_not_grow(self):
+        ids = [p.id for p in self.posts]
+        catalog.approved_post_ids()
+        with self.assertNumQueries(5), self.captureOnCommitCallbacks(execute=True):
+            result = moderate_posts(approve=ids[:3], delete=[])
+        self.assertEqual(result["approved"], ids[:3])
+        # the approved post ids are refreshed, though no signals were sent
+        self.assertEqual(catalog.approved_post_ids(), tuple(ids[:3]))
+
+    def test_reject(self):
+        post = self.posts[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate_posts(approve=[post.id])
+        self.assertEqual(catalog.approved_post_ids(), (post.id,))
+        with self.captureOnCommitCallbacks(execute=True):
+            result = moderate_posts(reject=[post.id, self.posts[1].id])
+        self.assertEqual(result["rejected"], [post.id])
+        self.assertEqual(catalog.approved_post_ids(), ())
+
+    def test_delete_post_with_suggestions(self):
+        post = self.posts[0]
+        Suggestion.objects.create(post=post, code="y", description="s")
+        Vote.objects.create(post=post, is_bad=True)
+        result = moderate_posts(delete=[post.id, 999])
+        self.assertEqual(result["deleted"], [post.id])
+        self.assertEqual(result["missing"], [999])
+        self.assertFalse(Post.objects.filter(pk=post.id).exists())
+
+    def test_approve_suggestions(self):
+        post = self.posts[0]
+        suggestion = Suggestion.objects.create(post=post, code="y", description="s")
+        self.assertEqual(catalog.approved_suggestion_ids(post.id), ())
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate_suggestions(approve=[suggestion.id])
+        self.assertEqual(catalog.approved_suggestion_ids(post.id), (suggestion.id,))
+
+
+class CommandTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_check_suggestions(self):
+        post = Post.objects.create(title="t", code="x = 1")
+        suggestions = [
+            Suggestion.objects.create(post=post, code="x = %s" % i, description=str(i))
+            for i in range(4)]
+        stdout = StringIO()
+        # approve, delete, skip, then quit before the last one
+        call_command("check_suggestions", "--batch-size=1",
+                     stdin=StringIO("y\nD\n\nq\n"), stdout=stdout)
+        self.assertIn("Approved 1 and deleted 1 suggestions", stdout.getvalue())
+        self.assertIsNotNone(Suggestion.objects.get(pk=suggestions[0].id).approved_at)
+        self.assertFalse(Suggestion.objects.filter(pk=suggestions[1].id).exists())
+        self.assertEqual(
+            list(Suggestion.objects.filter(approved_at=None).values_list("id", flat=True)),
+            [suggestions[2].id, suggestions[3].id])
+
+    def test_approve_posts(self):
+        now = timezone.now()
+        pending, approved, doomed = [
+            Post.objects.create(title=str(i), code="x = %s" % i, approved_at=now if i else None)
+            for i in range(3)]
+        Vote.objects.create(post=doomed, is_bad=True)
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("approve_posts", str(pending.id), "--reject=%s" % approved.id,
+                         stdout=stdout)
+            call_command("approve_posts", "--delete=%s" % doomed.id, stdout=stdout)
+        self.assertIn("Rejected posts: [%s]" % approved.id, stdout.getvalue())
+        self.assertEqual(
+            list(Post.objects.exclude(approved_at=None).values_list("id", flat=True)),
+            [pending.id])
+        self.assertFalse(Post.objects.filter(pk=doomed.id).exists())
+        self.assertEqual(catalog.approved_post_ids(), (pending.id,))
+
+    def test_parse_ids(self):
+        lines = ["1, 2", "Rejects", "3", "# a comment", "Deletes", "4 5"]
+        self.assertEqual(parse_ids(lines), ({1, 2}, {3}, {4, 5}))
+
+    def test_rebuild_vote_counts(self):
+        post = Post.objects.create(title="t", code="x = 1", bad_votes=5, not_bad_votes=5)
+        empty = Post.objects.create(title="u", code="x = 2", bad_votes=1)
+        Vote.objects.create(post=post, is_bad=True)
+        Vote.objects.create(post=post, is_bad=True)
+        Vote.objects.create(post=post, is_bad=False)
+        stdout = StringIO()
+        call_command("rebuild_vote_counts", stdout=stdout)
+        self.assertIn("Rebuilt vote counts for 2 posts", stdout.getvalue())
+        post.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual((post.bad_votes, post.not_bad_votes), (2, 1))
+        self.assertEqual((empty.bad_votes, empty.not_bad_votes), (0, 0))
+
+    def test_check_suggestions_dry_run(self):
+        post = Post.objects.create(title="t", code="x = 1")
+        suggestion = Suggestion.objects.create(post=post, code="x = 2", description="s")
+        stdout = StringIO()
+        call_command("check_suggestions", "--dry-run", stdin=StringIO("y\n"), stdout=stdout)
+        self.assertIn("Approvals\n%s" % suggestion.id, stdout.getvalue())
+        self.assertIsNone(Suggestion.objects.get().approved_at)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_seed_posts(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        Post.objects.create(title="old", code="x = 1", code_hash=code_hash(ast.parse("x = 1")))
+        jsonl = self._write("posts.jsonl", "\n".join(json.dumps(post) for post in [
+            {"title": "one", "code": "x = 1"},
+            {"title": "two", "code": "y = 2"},
+            {"title": "again", "code": "y=2  # same code"},
+            {"title": "broken", "code": "y = ("},
+        ]))
+        yaml = self._write("posts.yaml", "posts:\n  three: |\n    z = 3\n")
+        stdout = StringIO()
+        call_command("seed_posts", jsonl, yaml, "--workers=1", "--batch-size=2",
+                     "--skip-invalid", "--approve", stdout=stdout)
+        self.assertIn("saved 2 posts, skipped 1 invalid and 2 duplicates", stdout.getvalue())
+        self.assertEqual(
+            sorted(Post.objects.exclude(approved_at=None).values_list("title", flat=True)),
+            ["three", "two"])
+        # bulk_create sends no signals, but the catalog is refreshed
+        self.assertEqual(len(catalog.approved_post_ids()), 2)
+
+    def test_seed_posts_from_files(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self._write("%s.py" % ("long_" * 40), "x = 1\n")
+        call_command("seed_posts", self.tmp, "--workers=1", stdout=StringIO())
+        post = Post.objects.get()
+        # pending moderation, titled after the file name cut to fit
+        self.assertIsNone(post.approved_at)
+        self.assertEqual(post.title, ("long " * 40)[:128])
+
+    def test_seed_posts_stops_on_invalid_code(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self._write("good.py", "x = 1\n")
+        self._write("worse.py", "x = (\n")
+        with self.assertRaisesMessage(CommandError, "saved 0 posts before stopping"):
+            call_command("seed_posts", self.tmp, "--workers=1", stdout=StringIO())
+        self.assertEqual(Post.objects.count(), 0)
+
+
+@mock.patch.object(catalog, "APPROVED_POSTS_CHUNK", 2)
+class CatalogTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.posts = [
+            Post.objects.create(title=str(i), code="x = %s" % i, approved_at=now)
+            for i in range(5)
+        ]
+        self.ids = tuple(post.id for post in self.posts)
+
+    def test_ids_are_cached_in_chunks(self):
+        self.assertEqual(catalog.approved_post_ids(), self.ids)
+        generation, count = cache.get(catalog.APPROVED_POSTS_KEY)
+        self.assertEqual(count, 5)
+        chunk = cache.get(catalog.APPROVED_POSTS_CHUNK_KEY % (generation, 2))
+        self.assertEqual(chunk, self.ids[4:])
+        with self.assertNumQueries(0):
+            self.assertEqual(catalog.approved_post_ids(), self.ids)
+
+    def test_random_post_id_reads_one_chunk(self):
+        catalog.approved_post_ids()
+        with mock.patch.object(cache, "get", wraps=cache.get) as get:
+            self.assertIn(catalog.random_post_id(), self.ids)
+        # the count and the chunk the id is in
+        self.assertEqual(get.call_count, 2)
+
+    def test_evicted_chunk_is_reloaded(self):
+        catalog.approved_post_ids()
+        generation, _ = cache.get(catalog.APPROVED_POSTS_KEY)
+        cache.delete(catalog.APPROVED_POSTS_CHUNK_KEY % (generation, 1))
+        self.assertEqual(catalog.approved_post_ids(), self.ids)
+        self.assertIn(catalog.random_post_id(), self.ids)
+
+    def test_exclude(self):
+        first, second = self.ids[:2]
+        Post.objects.exclude(id__in=[first, second]).delete()
+        for _ in range(10):
+            self.assertEqual(catalog.random_post_id(exclude=first), second)
+            self.assertEqual(catalog.random_unseen_post_id(set(), exclude=second), first)
+        self.assertIsNone(catalog.random_unseen_post_id({first}, exclude=second))
+        Post.objects.filter(id=second).delete()
+        self.assertIsNone(catalog.random_post_id(exclude=first))
+
+    def test_empty_catalog(self):
+        Post.objects.all().delete()
+        self.assertEqual(catalog.approved_post_ids(), ())
+        self.assertIsNone(catalog.random_post_id())
+        self.assertIsNone(catalog.random_unseen_post_id(set()))
+        self.assertIsNone(views.Index._random_post())
+
+    @override_settings(RATELIMIT_ENABLE=False, RANDOM_POST_MODE="unseen")
+    def test_index_serves_unseen_posts(self):
+        shown = {self.client.get(reverse("index")).context["post"].id for _ in self.ids}
+        self.assertEqual(shown, set(self.ids))
+        # then starts over
+        response = self.client.get(reverse("index"))
+        self.assertRedirects(response, reverse("submit"), fetch_redirect_response=False)
+        self.assertEqual(self.client.get(reverse("index")).status_code, 200)
+
+    def test_seen_set_is_capped(self):
+        session = self.client.session
+        session["posts_seen"] = SeenSet(range(1000, 300000, 1000)).encode()
+        session.save()
+        response = self.client.get(reverse("index"))
+        seen = SeenSet.from_session(self.client.session["posts_seen"])
+        self.assertEqual(seen.ids, {response.context["post"].id})
+
+    def test_index_retries_deleted_post(self):
+        gone, post = self.posts[:2]
+        catalog.approved_post_ids()
+        # deleted without the signal, so the cached ids still have it
+        Post.objects.filter(id=gone.id)._raw_delete("default")
+        with mock.patch.object(
+                catalog, "random_post_id", side_effect=[gone.id, post.id]):
+            self.assertEqual(views.Index._random_post(), post)
+        # and the stale ids were dropped
+        self.assertNotIn(gone.id, catalog.approved_post_ids())
+
+
+class SeenSetTest(SimpleTestCase):
+    def test_round_trip(self):
+        seen = SeenSet()
+        self.assertFalse(seen)
+        for post_id in (5, 3, 9, 3):
+            seen.add(post_id)
+        self.assertEqual(len(seen), 3)
+        loaded = SeenSet.from_session(seen.encode())
+        self.assertEqual(loaded.ids, {3, 5, 9})
+        self.assertIn(9, loaded)
+        self.assertNotIn(4, loaded)
+        self.assertFalse(loaded.add(5))
+        self.assertTrue(loaded.add(4))
+
+    def test_dense_ids_encode_as_bitmap(self):
+        seen = SeenSet(range(100, 164))
+        encoded = seen.encode()
+        self.assertTrue(encoded.startswith("96:"))
+        self.assertEqual(SeenSet.from_session(encoded).ids, set(range(100, 164)))
+
+    def test_size_grows_with_ids_not_span(self):
+        encoded = SeenSet([1, 100000]).encode()
+        self.assertLess(len(encoded), 16)
+        self.assertEqual(SeenSet.from_session(encoded).ids, {1, 100000})
+
+    def test_old_values(self):
+        # a list of ids, and the bitmap of before the delta encoding
+        self.assertEqual(SeenSet.from_session([1, 2]).ids, {1, 2})
+        self.assertEqual(SeenSet.from_session("8:Aw==").ids, {8, 9})
+        for value in ("", None, "x:Aw==", "d:gA==", "no colon"):
+            self.assertFalse(SeenSet.from_session(value))
+
+
+def _incr_in_child(cache, key, times):
+    for _ in range(times):
+        cache.incr(key)
+
+
+class MmapCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = self._cache()
+
+    def _cache(self, **options):
+        options = {"slots": 64, "slot_size": 256, **options}
+        return MmapCache(self.dir, {"OPTIONS": options})
+
+    def _value_files(self):
+        return [name for name in os.listdir(self.dir) if name.endswith(".value")]
+
+    def test_get_set_add_incr(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"x": 1})
+        self.assertEqual(self.cache.get("a"), {"x": 1})
+        self.assertFalse(self.cache.add("a", 2))
+        self.assertTrue(self.cache.add("b", 2))
+        self.assertEqual(self.cache.incr("b", 3), 5)
+        with self.assertRaises(ValueError):
+            self.cache.incr("c")
+        self.assertTrue(self.cache.delete("a"))
+        self.assertFalse(self.cache.has_key("a"))
+
+    def test_get_many_locks_once(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        with mock.patch("posts.cache.fcntl.flock", wraps=fcntl.flock) as flock:
+            self.assertEqual(self.cache.get_many(["a", "b", "c"]), {"a": 1, "b": 2})
+        # locked and unlocked
+        self.assertEqual(flock.call_count, 2)
+
+    def test_expiry(self):
+        self.cache.set("a", 1, 60)
+        self.cache.incr("a")
+        with mock.patch("posts.cache.time.time", return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get("a"))
+            # an expired entry does not block add
+            self.assertTrue(self.cache.add("a", 5))
+            self.assertEqual(self.cache.get("a"), 5)
+
+    def test_full_group_evicts(self):
+        cache = self._cache(slots=1, probes=1)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+
+    def test_large_values_go_to_files(self):
+        big = "x" * 1000
+        self.cache.set("a", big)
+        self.assertEqual(self.cache.get("a"), big)
+        self.assertEqual(len(self._value_files()), 1)
+        # and the file goes when a small value replaces it
+        self.cache.set("a", "small")
+        self.assertEqual(self.cache.get("a"), "small")
+        self.assertEqual(self._value_files(), [])
+        self.cache.set("a", big)
+        self.cache.delete("a")
+        self.assertEqual(self._value_files(), [])
+
+    def test_evicted_large_value_file_is_removed(self):
+        cache = self._cache(slots=1, probes=1)
+        cache.set("a", "x" * 1000)
+        cache.set("b", 1)
+        self.assertEqual(self._value_files(), [])
+
+    def test_torn_slot_is_a_miss(self):
+        self.cache.set("a", "value")
+        key = self.cache.make_key("a")
+        offset, _ = self.cache._find(key, self.cache._hash(key))
+        # as if a worker died while writing the value
+        start = offset + SLOT_HEADER.size
+        self.cache._map[start:start + 8] = b"\xff" * 8
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", "again")
+        self.assertEqual(self.cache.get("a"), "again")
+
+    def test_shared_between_processes(self):
+        self.cache.set("n", 0)
+        context = multiprocessing.get_context("fork")
+        children = [
+            context.Process(target=_incr_in_child, args=(self.cache, "n", 50))
+            for _ in range(4)
+        ]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+        self.assertEqual(self.cache.get("n"), 200)
+
+    def test_clear(self):
+        self.cache.set("a", "x" * 1000)
+        self.cache.set("b", 1)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self._value_files(), [])
+
+
+class CompactSerializerTest(SimpleTestCase):
+    session = {
+        "posts": [9, 3],
+        "posts_seen": SeenSet([1, 100000]).encode(),
+        "votes": {"3": {"id": 7, "is_bad": True}, "9": {"id": None, "is_bad": False,
+                                                        "token": "ab" * 16}},
+        "suggestions": {"9": 4},
+        "_auth_user_id": "1",
+    }
+
+    def test_round_trip(self):
+        data = CompactSerializer().dumps(self.session)
+        loaded = CompactSerializer().loads(data)
+        self.assertEqual(loaded, {**self.session, "posts": [3, 9]})
+        self.assertLess(len(data), len(json.dumps(self.session)) / 2)
+        # a bitmap stays one
+        seen = SeenSet(range(8, 40)).encode()
+        data = CompactSerializer().dumps({"posts_seen": seen})
+        self.assertEqual(CompactSerializer().loads(data), {"posts_seen": seen})
+
+    def test_values_it_cannot_encode_go_to_json(self):
+        session = {"posts": ["x"], "votes": {"1": {"is_bad": "yes"}}, "posts_seen": "junk"}
+        data = CompactSerializer().dumps(session)
+        self.assertEqual(data[1], sessions.OTHER)
+        self.assertEqual(CompactSerializer().loads(data), session)
+        with self.assertRaises(TypeError):
+            CompactSerializer().dumps({"when": timezone.now()})
+
+    def test_loads_json_sessions(self):
+        data = json.dumps(self.session).encode()
+        self.assertEqual(CompactSerializer().loads(data), self.session)
+
+    def test_signed(self):
+        signed = signing.dumps(self.session, salt="s", serializer=CompactSerializer)
+        loaded = signing.loads(signed, salt="s", serializer=CompactSerializer)
+        self.assertEqual(loaded["suggestions"], {"9": 4})
+        with self.assertRaises(signing.BadSignature):
+            signing.loads(signed[:-1] + "x", salt="s", serializer=CompactSerializer)
+
+    def test_corrupt_data(self):
+        data = CompactSerializer().dumps(self.session)
+        with self.assertRaises(ValueError):
+            CompactSerializer().loads(bytes([sessions.VERSION, 99]))
+        # cut in the posts' ids, and in the JSON
+        for truncated in (data[:3], data[:-1]):
+            with self.assertRaises(ValueError):
+                CompactSerializer().loads(truncated)
+        # the store starts a new session instead
+        store = SessionStore()
+        store._cache.set(store.cache_key_prefix + "broken", data[:3])
+        store = SessionStore("broken")
+        self.assertEqual(store.load(), {})
+        self.assertIsNone(store.session_key)
+
+    def test_store_round_trip(self):
+        store = SessionStore()
+        store.update(self.session)
+        store.save()
+        self.assertEqual(dict(SessionStore(store.session_key).load()), {
+            **self.session, "posts": [3, 9]})
+
+
+class SlidingWindowLimiterTest(SimpleTestCase):
+    def setUp(self):
+        self.cache = LocMemCache("ratelimit-tests", {})
+        self.cache.clear()
+        self.limiter = SlidingWindowLimiter("4/10s", self.cache)
+
+    def test_parse_rate(self):
+        self.assertEqual(SlidingWindowLimiter.parse_rate("5/s"), (5, 1))
+        self.assertEqual(SlidingWindowLimiter.parse_rate("100/m"), (100, 60))
+        self.assertEqual(SlidingWindowLimiter.parse_rate("10/5m"), (10, 300))
+
+    def test_window(self):
+        allowed = [self.limiter.allow("a", now=100) for _ in range(5)]
+        self.assertEqual(allowed, [True] * 4 + [False])
+        self.assertTrue(self.limiter.allow("b", now=100))
+        # halfway through the next window the last one counts for half,
+        # without the rejected request
+        self.assertTrue(self.limiter.allow("a", now=115))
+        self.assertTrue(self.limiter.allow("a", now=115))
+        self.assertFalse(self.limiter.allow("a", now=115))
+        # and the one before that not at all
+        self.assertTrue(self.limiter.allow("a", now=130))
+
+    def test_retrying_does_not_extend_the_limit(self):
+        for _ in range(4):
+            self.limiter.allow("a", now=100)
+        for now in range(100, 110):
+            self.assertFalse(self.limiter.allow("a", now=now))
+        # the four allowed ones count for half here, as if there had been
+        # no retries
+        self.assertTrue(self.limiter.allow("a", now=115))
+
+    def test_reads_both_windows_at_once(self):
+        self.limiter.allow("a", now=100)
+        with mock.patch.object(self.cache, "get_many", wraps=self.cache.get_many) as get_many, \
+                mock.patch.object(self.cache, "incr", wraps=self.cache.incr) as incr, \
+                mock.patch.object(self.cache, "add", wraps=self.cache.add) as add:
+            self.assertTrue(self.limiter.allow("a", now=105))
+        # one read of both windows and one write
+        self.assertEqual((get_many.call_count, incr.call_count, add.call_count), (1, 1, 0))
+
+    def test_shared_between_workers(self):
+        other = SlidingWindowLimiter("4/10s", self.cache)
+        for limiter in (self.limiter, other, self.limiter, other):
+            self.assertTrue(limiter.allow("a", now=100))
+        self.assertFalse(other.allow("a", now=100))
+
+
+@override_settings(RATELIMIT_ENABLE=True, RATELIMIT_RATE="2/m")
+class RateLimitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(title="bad", code="x = 1", approved_at=timezone.now())
+
+    def test_limited_views(self):
+        for _ in range(2):
+            self.assertNotEqual(self.client.get(reverse("index")).status_code, 429)
+        # one limit across the limited views
+        response = self.client.get(reverse("submit"))
+        self.assertEqual(response.status_code, 429)
+        # another client still gets through
+        response = self.client.get(reverse("index"), REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(response.status_code, 200)
+
+    def test_other_paths_are_not_resolved(self):
+        with mock.patch("posts.middleware.resolve") as resolve:
+            for _ in range(3):
+                self.client.get(reverse("metrics"))
+            self.client.get(reverse("index"))
+        resolve.assert_not_called()
+        # a path with arguments is resolved to tell if it is limited
+        with mock.patch("posts.middleware.resolve", wraps=middleware.resolve) as resolve:
+            self.client.get(reverse("suggestions", args=[self.post.id]))
+        resolve.assert_called_once()
+
+    def test_other_views_are_not_limited(self):
+        for _ in range(3):
+            response = self.client.get(reverse("suggestions", args=[self.post.id]))
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(
+                reverse("vote", args=[self.post.id]), json.dumps({"isBad": True}),
+                content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+
+
+@override_settings(RATELIMIT_ENABLE=False, PROFILE_SAMPLE_RATE=1.0)
+class ProfilerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Post.objects.create(title="bad", code="x = 1", approved_at=timezone.now())
+
+    def test_profiles_queries_and_rendering(self):
+        with mock.patch("posts.middleware.profiler", Profiler()) as profiler:
+            with self.assertNumQueries(2):
+                self.client.get(reverse("index"))
+        stats = profiler.stats()["index"]
+        self.assertEqual(stats["requests"], 1)
+        self.assertEqual(stats["sampled"], 1)
+        self.assertEqual(stats["queries_total"], 2)
+        self.assertEqual(stats["query_buckets"]["2"], 1)
+        self.assertGreater(stats["render_seconds_total"], 0)
+
+    def test_stats_are_for_staff(self):
+        response = self.client.get(reverse("profile_stats"))
+        self.assertEqual(response.status_code, 403)
+
+
+@mock.patch.object(VoteBuffer, "_start")
+class VoteBufferTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(title="bad", code="x = 1", approved_at=timezone.now())
+        self.buffer = VoteBuffer(max_pending=3)
+
+    def _counts(self):
+        self.post.refresh_from_db()
+        return self.post.bad_votes, self.post.not_bad_votes
+
+    def test_flush(self, _start):
+        vote = self.buffer.cast(self.post.id, True)
+        self.buffer.cast(self.post.id, False)
+        self.assertEqual(self.buffer.pending_counts(self.post.id), (1, 1))
+        # one insert for both votes and one update of the post's counters
+        with self.assertNumQueries(4):
+            self.buffer.flush()
+        self.assertEqual(self._counts(), (1, 1))
+        self.assertEqual(self.buffer.pending_counts(self.post.id), (0, 0))
+        # the session's token now resolves to the vote's id
+        vote_id = cache.get(TOKEN_KEY % vote["token"])
+        self.assertTrue(Vote.objects.get(pk=vote_id).is_bad)
+
+    def test_change_pending_vote(self, _start):
+        vote = self.buffer.cast(self.post.id, True)
+        vote = self.buffer.cast(self.post.id, False, vote)
+        self.assertEqual(self.buffer.pending_counts(self.post.id), (0, 1))
+        self.buffer.flush()
+        self.assertEqual(self._counts(), (0, 1))
+        self.assertFalse(Vote.objects.get().is_bad)
+
+    def test_change_flushed_vote(self, _start):
+        vote = self.buffer.cast(self.post.id, True)
+        self.buffer.flush()
+        vote = self.buffer.cast(self.post.id, False, vote)
+        self.assertIsNotNone(vote["id"])
+        self.assertEqual(self.buffer.pending_counts(self.post.id), (-1, 1))
+        self.buffer.flush()
+        self.assertEqual(self._counts(), (0, 1))
+        self.assertEqual(Vote.objects.count(), 1)
+
+    def test_failed_flush_is_retried(self, _start):
+        self.buffer.cast(self.post.id, True)
+        with mock.patch.object(Vote.objects, "bulk_create", side_effect=OperationalError):
+            self.buffer.flush()
+        self.assertEqual(self._counts(), (0, 0))
+        # kept along with the votes cast since
+        self.buffer.cast(self.post.id, False)
+        self.assertEqual(self.buffer.pending_counts(self.post.id), (1, 1))
+        self.buffer.flush()
+        self.assertEqual(self._counts(), (1, 1))
+        self.assertEqual(Vote.objects.count(), 2)
+
+    def test_max_pending_wakes_flusher(self, _start):
+        for _ in range(2):
+            self.buffer.cast(self.post.id, True)
+        self.assertFalse(self.buffer._wake.is_set())
+        self.buffer.cast(self.post.id, True)
+        self.assertTrue(self.buffer._wake.is_set())
+
+    def test_worker_exit_flushes(self, _start):
+        self.buffer.cast(self.post.id, True)
+        config = runpy.run_path(str(settings.BASE_DIR / "gunicorn.conf.py"))
+        with mock.patch("posts.vote_buffer.vote_buffer", self.buffer), \
+                mock.patch.object(connections, "close_all"):
+            config["worker_exit"](None, None)
+        self.assertEqual(self._counts(), (1, 0))
+
+
+@mock.patch.object(VoteBuffer, "_start")
+class VoteBufferCommitTest(TransactionTestCase):
+    """Foreign keys are checked when the flush commits, which a TestCase never does."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_vote_for_deleted_post_is_dropped(self, _start):
+        post = Post.objects.create(title="kept", code="x = 1")
+        deleted = Post.objects.create(title="deleted", code="x = 2")
+        buffer = VoteBuffer()
+        buffer.cast(post.id, True)
+        buffer.cast(deleted.id, False)
+        deleted.delete()
+        buffer.flush()
+        self.assertEqual(list(Vote.objects.values_list("post_id", flat=True)), [post.id])
+        post.refresh_from_db()
+        self.assertEqual((post.bad_votes, post.not_bad_votes), (1, 0))
+        # nothing is left to retry
+        self.assertEqual(buffer.pending_counts(deleted.id), (0, 0))
+        self.assertEqual((buffer._new, buffer._changed), ({}, {}))
+
+
+class MetricsTest(TestCase):
+    def test_render(self):
+        counter = metrics.Counter("test_events", "Events.")
+        histogram = metrics.Histogram("test_seconds", "Seconds.", (0.1, 1))
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        histogram.observe(0.5)
+        text = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn("# TYPE test_events counter", text)
+        self.assertIn('test_events_total{kind="a"} 3', text)
+        self.assertIn(
+            'test_seconds_bucket{le="0.1"} 0\n'
+            'test_seconds_bucket{le="1"} 1\n'
+            'test_seconds_bucket{le="+Inf"} 1\n'
+            'test_seconds_count 1\n'
+            'test_seconds_sum 0.5\n', text)
+
+
+class AsyncUrls:
+    """The site's urls as ASYNC_VIEWS routes them."""
+
+    urlpatterns = [
+        path("", async_views.index, name="index"),
+        path("post/<int:post_id>/vote", async_views.VoteView.as_view(), name="vote"),
+        path("post/submit", views.SubmissionView.as_view(), name="submit"),
+        path("post/<int:post_id>/suggest", views.SuggestionView.as_view(), name="suggest"),
+        path("post/<int:post_id>/suggestions",
+             async_views.PostSuggestionView.as_view(), name="suggestions"),
+        path("post/<int:post_id>/suggestions/<int:suggestion_id>",
+             async_views.PostSuggestionDetailView.as_view(), name="suggestion_detail"),
+    ]
+
+
+@override_settings(RATELIMIT_ENABLE=False, ROOT_URLCONF=AsyncUrls)
+class AsyncViewsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(
+            title="bad", code="x = 1", approved_at=timezone.now())
+        self.suggestions = [
+            Suggestion.objects.create(
+                post=self.post, code="x = %s" % i, description="better %s" % i,
+                approved_at=timezone.now())
+            for i in (2, 3)
+        ]
+
+    def _post_json(self, url, body):
+        return self.async_client.post(url, json.dumps(body), content_type="application/json")
+
+    def test_views_are_async(self):
+        for view in (async_views.Index, async_views.VoteView,
+                     async_views.PostSuggestionView, async_views.PostSuggestionDetailView):
+            self.assertTrue(view.view_is_async, view)
+
+    async def test_index(self):
+        response = await self.async_client.get(reverse("index"))
+        self.assertContains(response, "bad")
+        self.assertEqual(response.context["post"], self.post)
+        # the only post was seen, so the next visit starts over
+        response = await self.async_client.get(reverse("index"))
+        self.assertRedirects(response, reverse("submit"), fetch_redirect_response=False)
+
+    async def test_vote(self):
+        url = reverse("vote", args=[self.post.id])
+        response = await self._post_json(url, {"isBad": True})
+        self.assertEqual(response.json()["currentVoteCounts"], {"bad": 1, "notBad": 0})
+        response = await self._post_json(url, {"isBad": False})
+        self.assertEqual(response.json()["currentVoteCounts"], {"bad": 0, "notBad": 1})
+        self.assertEqual(await Vote.objects.acount(), 1)
+        response = await self._post_json(reverse("vote", args=[0]), {"isBad": True})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(VOTE_BUFFER=True)
+    async def test_buffered_vote(self):
+        url = reverse("vote", args=[self.post.id])
+        with mock.patch.object(VoteBuffer, "_start"), \
+                mock.patch("posts.async_views.vote_buffer", VoteBuffer()):
+            response = await self._post_json(url, {"isBad": True})
+        self.assertEqual(response.json()["currentVoteCounts"], {"bad": 1, "notBad": 0})
+
+    async def test_suggestions(self):
+        first, second = self.suggestions
+        url = reverse("suggestions", args=[self.post.id])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.context["suggestion"], first)
+        self.assertEqual(response.context["next_suggestion"], second)
+        # the last suggestion wraps around to the first
+        response = await self.async_client.get(url, {"s": second.id})
+        self.assertEqual(response.context["next_suggestion"], first)
+        response = await self.async_client.get(url, {"s": 0})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_suggestion_detail(self):
+        suggestion = self.suggestions[0]
+        url = reverse("suggestion_detail", args=[self.post.id, suggestion.id])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        url = reverse("suggestion_detail", args=[self.post.id, 0])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(PROFILE_SAMPLE_RATE=1.0)
+    async def test_profiles_async_queries(self):
+        with mock.patch("posts.middleware.profiler", Profiler()) as profiler:
+            await self.async_client.get(reverse("suggestions", args=[self.post.id]))
+        stats = profiler.stats()["suggestions"]
+        # the post, the suggestion ids and the suggestions
+        self.assertEqual(stats["queries_total"], 3)
+
+
+class FakeConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def test_reuses_connections(self):
+        pool = ConnectionPool(FakeConnection, size=2)
+        first = pool.get()
+        second = pool.get()
+        self.assertIsNot(first, second)
+        pool.put(first)
+        self.assertIs(pool.get(), first)
+        self.assertEqual(pool.stats(), {"size": 2, "open": 2, "idle": 0, "in_use": 2, "waiting": 0})
+
+    def test_times_out_when_all_in_use(self):
+        pool = ConnectionPool(FakeConnection, size=1, timeout=0.01)
+        pool.get()
+        with self.assertRaises(PoolTimeout):
+            pool.get()
+
+    def test_waiter_gets_returned_connection(self):
+        pool = ConnectionPool(FakeConnection, size=1, timeout=5)
+        connection = pool.get()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.get()))
+        waiter.start()
+        while not pool.stats()["waiting"]:
+            waiter.join(0.001)
+        pool.put(connection)
+        waiter.join()
+        self.assertEqual(got, [connection])
+
+    def test_replaces_broken_and_old_connections(self):
+        pool = ConnectionPool(FakeConnection, size=1)
+        broken = pool.get()
+        pool.put(broken, reusable=False)
+        self.assertTrue(broken.closed)
+        self.assertEqual(pool.stats()["open"], 0)
+        pool.max_lifetime = 0
+        old = pool.get()
+        pool.put(old)
+        self.assertTrue(old.closed)
+        self.assertIsNot(pool.get(), old)
+
+    def test_checks_idle_connections(self):
+        pool = ConnectionPool(FakeConnection, size=1, check=lambda c: False, check_after=0)
+        connection = pool.get()
+        pool.put(connection)
+        self.assertIsNot(pool.get(), connection)
+        self.assertTrue(connection.closed)
+
+    def test_failed_connect_frees_its_slot(self):
+        pool = ConnectionPool(mock.Mock(side_effect=OSError), size=1, timeout=0.01)
+        with self.assertRaises(OSError):
+            pool.get()
+        self.assertEqual(pool.stats()["open"], 0)
+
+
+@unittest.skipUnless("replica" in settings.DATABASES, "needs badpython.test_settings")
+@override_settings(RATELIMIT_ENABLE=False, DATABASE_REPLICAS=["replica"])
+class ReplicaTest(TestCase):
+    databases = {"default", "replica"} & set(settings.DATABASES)
+
+    def setUp(self):
+        cache.clear()
+        routers.health.reset()
+        now = timezone.now()
+        # the same post on both, but only the primary has seen a vote
+        self.post = Post.objects.create(
+            title="bad", code="x = 1", approved_at=now, bad_votes=1)
+        Post.objects.using("replica").create(
+            id=self.post.id, title="bad", code="x = 1", approved_at=now)
+
+    def _vote(self):
+        return self.client.post(
+            reverse("vote", args=[self.post.id]), json.dumps({"isBad": True}),
+            content_type="application/json")
+
+    def test_get_reads_from_replica(self):
+        with self.assertNumQueries(1, using="replica"):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["post"].bad_votes, 0)
+
+    def test_writes_read_their_own_writes(self):
+        with self.assertNumQueries(0, using="replica"):
+            response = self._vote()
+        self.assertEqual(response.json()["currentVoteCounts"]["bad"], 2)
+        self.assertIn("primary", response.cookies)
+        # and the client stays on the primary for a while after
+        with self.assertNumQueries(0, using="replica"):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["post"].bad_votes, 2)
+
+    @override_settings(SESSION_ENGINE="django.contrib.sessions.backends.db")
+    def test_sessions_read_from_primary(self):
+        self.client.get(reverse("index"))
+        session_key = self.client.session.session_key
+        # the replica has no copy of the session to miss
+        with CaptureQueriesContext(connections["replica"]) as queries:
+            self.client.get(reverse("index"))
+        self.assertFalse([q for q in queries if "django_session" in q["sql"]])
+        self.assertEqual(self.client.session.session_key, session_key)
+
+    def test_unreachable_replica_fails_over(self):
+        with mock.patch.object(
+                connections["replica"], "ensure_connection", side_effect=OperationalError):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["post"].bad_votes, 1)
+        # and is left alone until it is retried
+        with self.assertNumQueries(0, using="replica"):
+            self.client.get(reverse("index"))
+        self.assertGreater(routers.health.stats()["replica"]["down_for"], 0)
+
+    def test_lagging_replica_is_skipped(self):
+        with mock.patch("posts.routers.replication_lag", return_value=60.0):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["post"].bad_votes, 1)
+        self.assertEqual(routers.health.stats()["replica"]["lag"], 60.0)
+
+    @override_settings(ROOT_URLCONF=AsyncUrls)
+    async def test_async_get_reads_from_replica(self):
+        response = await self.async_client.get(reverse("index"))
+        self.assertEqual(response.context["post"].bad_votes, 0)
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+@mock.patch.object(RandomFeed, "_start")
+class RandomFeedTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.posts = [
+            Post.objects.create(title=str(i), code="x = %s" % i, approved_at=now)
+            for i in range(3)
+        ]
+        self.feed = RandomFeed(size=10, batch_size=2)
+
+    def test_refill_fetches_in_batches(self, _start):
+        catalog.approved_post_ids()
+        # one query for each batch of two
+        with self.assertNumQueries(2):
+            self.feed.refill()
+        drawn = {self.feed.draw().id for _ in self.posts}
+        self.assertEqual(drawn, {post.id for post in self.posts})
+        self.assertIsNone(self.feed.draw())
+
+    @mock.patch.object(catalog, "APPROVED_POSTS_CHUNK", 2)
+    def test_refill_reads_chunks_it_picks_from(self, _start):
+        catalog.approved_post_ids()
+        with mock.patch.object(catalog.ApprovedPosts, "all") as all_ids, \
+                mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            self.feed.refill()
+        # never every chunk at once
+        all_ids.assert_not_called()
+        get_many.assert_not_called()
+        drawn = {self.feed.draw().id for _ in self.posts}
+        self.assertEqual(drawn, {post.id for post in self.posts})
+
+    def test_draw_skips_excluded_and_seen(self, _start):
+        first, second, third = self.posts
+        self.feed.refill()
+        post = self.feed.draw(exclude=first.id, seen={second.id})
+        self.assertEqual(post.id, third.id)
+        # the skipped posts stay queued for other sessions
+        self.assertEqual(self.feed.draw(exclude=second.id).id, first.id)
+        self.assertIsNone(self.feed.draw(exclude=second.id))
+
+    def test_approval_change_empties_queue(self, _start):
+        self.feed.refill()
+        self.posts[0].delete()
+        catalog.invalidate_approved_posts()
+        self.feed.refill()
+        drawn = {self.feed.draw().id for _ in self.posts[1:]}
+        self.assertEqual(drawn, {post.id for post in self.posts[1:]})
+        self.assertIsNone(self.feed.draw())
+
+    def test_old_posts_are_dropped(self, _start):
+        self.feed.max_age = 0
+        self.feed.refill()
+        self.assertIsNone(self.feed.draw())
+
+    @override_settings(RANDOM_FEED=True)
+    def test_index_draws_without_queries(self, _start):
+        self.feed.refill()
+        with mock.patch("posts.views.feed", self.feed):
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse("index"))
+        self.assertIn(response.context["post"].id, {post.id for post in self.posts})
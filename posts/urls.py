@@ -1,14 +1,22 @@
+from django.conf import settings
 from django.urls import path
 
-from . import views
+from . import async_views, views
+
+# the busiest views have async versions for the ASGI server
+live = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path("", views.index, name="index"),
-    path("post/<int:post_id>/vote", views.VoteView.as_view(), name="vote"),
+    path("", live.index, name="index"),
+    path("post/<int:post_id>/vote", live.VoteView.as_view(), name="vote"),
     path("post/submit", views.SubmissionView.as_view(), name="submit"),
     path("post/<int:post_id>/suggest", views.SuggestionView.as_view(), name="suggest"),
     path("post/<int:post_id>/suggestions",
-         views.PostSuggestionView.as_view(), name="suggestions"),
+         live.PostSuggestionView.as_view(), name="suggestions"),
     path("post/<int:post_id>/suggestions/<int:suggestion_id>",
-         views.PostSuggestionDetailView.as_view(), name="suggestion_detail"),
+         live.PostSuggestionDetailView.as_view(), name="suggestion_detail"),
+    path("internal/validation", views.ValidationStatsView.as_view(), name="validation_stats"),
+    path("internal/profile", views.ProfileStatsView.as_view(), name="profile_stats"),
+    path("internal/db-pool", views.DatabasePoolStatsView.as_view(), name="db_pool_stats"),
+    path("internal/metrics", views.MetricsView.as_view(), name="metrics"),
 ]
@@ -0,0 +1,225 @@
+import ast
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+
+logger = logging.getLogger("posts.validation")
+
+
+PARSE_KEY = "parse:ast:%s"
+PARSE_TIMEOUT = 60 * 60 * 24
+
+# upper bounds, in seconds, of the validation latency histogram
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+INVALID = "Code must be valid python. Please try again."
+
+
+# fields that only some Python versions have, or that do not change the code
+IGNORED_FIELDS = {"kind", "type_comment"}
+
+
+def normal_form(node):
+    """The AST as nested tuples, the same whichever Python parsed the code.
+
+    ast.dump's output changes between versions, and so does the tree:
+    before 3.9 subscripts wrap their slice in Index or ExtSlice, and some
+    versions put empty strings in f-strings. Fields that are None or empty
+    are left out, so ones newer versions add (such as type_params) do not
+    show either.
+    """
+    if isinstance(node, list):
+        return tuple(normal_form(item) for item in node)
+    if not isinstance(node, ast.AST):
+        return repr(node)
+    name = type(node).__name__
+    if name == "Index":
+        return normal_form(node.value)
+    if name == "ExtSlice":
+        return normal_form(ast.Tuple(elts=node.dims, ctx=ast.Load()))
+    if name == "JoinedStr":
+        # 3.12.0 and 3.12.1 add empty strings to f-string format specs
+        node = ast.JoinedStr(values=[
+            value for value in node.values
+            if not (isinstance(value, ast.Constant) and value.value == "")
+        ])
+    fields = tuple(
+        (field, normal_form(value))
+        for field, value in sorted(ast.iter_fields(node))
+        if field not in IGNORED_FIELDS and value is not None and value != []
+    )
+    return (name,) + fields
+
+
+def code_hash(tree):
+    """Hash the normalised AST, so whitespace and comments do not change it.
+
+    Stored hashes were made with this, so a change to it needs a migration
+    rehashing them, like 0009_stable_code_hash.
+    """
+    return hashlib.sha256(repr(normal_form(tree)).encode()).hexdigest()
+
+
+def parse_code(code):
+    """Parse in a pool process, returning the (possibly empty) errors and
+    the code's hash."""
+    try:
+        tree = ast.parse(code)
+        return [], code_hash(tree)
+    except SyntaxError as e:
+        return [{"lineNum": e.lineno, "reason": e.msg}], None
+    except (RecursionError, MemoryError):
+        return [{"lineNum": None, "reason": "too deeply nested"}], None
+    except ValueError as e:
+        # e.g. null bytes in the source
+        return [{"lineNum": None, "reason": str(e)}], None
+
+
+class Validator:
+    """Parses submitted code in a process pool, off the request worker.
+
+    A parse that runs past VALIDATION_TIMEOUT seconds is abandoned and the
+    pool replaced, so pathological input cannot hold a pool process either.
+    Results are cached by a hash of the code.
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "count": 0,
+            "cache_hits": 0,
+            "rejected_size": 0,
+            "timeouts": 0,
+            "seconds_total": 0.0,
+            "seconds_max": 0.0,
+            "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+        }
+
+    def _get_pool(self):
+        with self._lock:
+            # a pool is never shared with a forked gunicorn worker
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=settings.VALIDATION_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self._pid = os.getpid()
+            return self._pool
+
+    def _reset_pool(self, pool):
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        # a stuck parse never finishes on its own, so kill the processes,
+        # which also fails whatever else was queued on the pool
+        processes = getattr(pool, "_processes", None) or {}
+        for process in list(processes.values()):
+            process.kill()
+        pool.shutdown(wait=False)
+
+    def _run(self, code):
+        """The parse errors and code hash, or None if parsing did not finish
+        in time."""
+        if not settings.VALIDATION_WORKERS:
+            return parse_code(code)
+        pool = self._get_pool()
+        future = pool.submit(parse_code, code)
+        try:
+            return future.result(timeout=settings.VALIDATION_TIMEOUT)
+        except TimeoutError:
+            self._record(timeouts=1)
+            metrics.validation_timeouts.inc()
+            logger.warning("Parsing %s characters timed out", len(code))
+            self._reset_pool(pool)
+        except BrokenProcessPool:
+            logger.exception("Validation pool broke, replacing it")
+            self._reset_pool(pool)
+        return None
+
+    def parse(self, code):
+        """Return (errors, message, code_hash).
+
+        errors and message are None for valid code, and code_hash is None
+        for invalid code.
+        """
+        if not (code and code.strip()):
+            return True, "Submission must not be empty", None
+        max_size = settings.VALIDATION_MAX_SIZE
+        if len(code) > max_size:
+            self._record(rejected_size=1)
+            return True, "Submission must be at most %s characters" % max_size, None
+        start = time.perf_counter()
+        key = PARSE_KEY % hashlib.sha256(code.encode()).hexdigest()
+        result = cache.get(key)
+        metrics.cache_lookups.inc(cache="parse", result="miss" if result is None else "hit")
+        if result is not None:
+            self._record(cache_hits=1)
+        else:
+            result = self._run(code)
+            if result is None:
+                result = [{"lineNum": None, "reason": "took too long to parse"}], None
+            else:
+                cache.set(key, result, PARSE_TIMEOUT)
+        self._observe(time.perf_counter() - start)
+        errors, digest = result
+        if errors:
+            logger.info("Could not parse invalid python: %s", errors)
+            return errors, INVALID, None
+        return None, None, digest
+
+    def parse_errors(self, code):
+        """Return (errors, message) for invalid code, or (None, None)."""
+        errors, message, _ = self.parse(code)
+        return errors, message
+
+    def _record(self, **counts):
+        with self._stats_lock:
+            for name, n in counts.items():
+                self._stats[name] += n
+
+    def _observe(self, seconds):
+        metrics.validation_seconds.observe(seconds)
+        with self._stats_lock:
+            stats = self._stats
+            stats["count"] += 1
+            stats["seconds_total"] += seconds
+            stats["seconds_max"] = max(stats["seconds_max"], seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+                    break
+            else:
+                stats["buckets"][-1] += 1
+
+    def stats(self):
+        """Validation latency and outcome counts for this worker process."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+            buckets = list(stats.pop("buckets"))
+        stats["latency_buckets"] = {
+            str(bound): n for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), buckets)
+        }
+        stats["pid"] = os.getpid()
+        return stats
+
+
+validator = Validator()
+
+
+def parse_errors(code):
+    return validator.parse_errors(code)
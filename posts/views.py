@@ -1,9 +1,11 @@
-import ast
+import bisect
 from functools import partial
 import json
 import logging
 
+from django.conf import settings
 from django.contrib import messages
+from django.db import transaction
 from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -12,12 +14,16 @@ from django.http import (
     HttpResponseNotFound,
 )
 from django.shortcuts import redirect, render, get_object_or_404
-from django.utils.decorators import method_decorator
 from django.views import View
-from ratelimit.decorators import ratelimit
 
+from . import catalog, db_pool, metrics
 from .exceptions import DuplicateError
+from .feed import feed
 from .models import *
+from .profiler import profiler
+from .seen import SEEN_MAX_LENGTH, SeenSet
+from .validation import validator
+from .vote_buffer import vote_buffer
 from django.core.cache.backends import locmem
 
 
@@ -25,33 +31,31 @@ logger = logging.getLogger("posts.views")
 
 
 def ratelimited(request, *args, **kwargs):
-    logger.info("Rate limit reached for request", request.META["CLIENT_IP"])
+    logger.info("Rate limit reached for %s", request.META["CLIENT_IP"])
+    metrics.ratelimited.inc()
     return HttpResponse(status=429, content="Too many requests, please slow down!")
 
 
-GLOBAL_REQUEST_GROUP = "global"
-
-limit = ratelimit(
-    key="header:client-ip",
-    method="GET",
-    rate="5/s",
-    block=True,
-    group=GLOBAL_REQUEST_GROUP,
-)
-
-
 class Index(View):
-    @method_decorator(limit)
     def get(self, request, **kwargs):
         previous_id = request.GET.get("p")
-        post = self._random_post(previous_id=previous_id)
+        seen = None
+        if settings.RANDOM_POST_MODE == "unseen":
+            seen = SeenSet.from_session(request.session.get("posts_seen"))
+        post = self._random_post(previous_id=previous_id, seen=seen)
+        return self._respond(request, post, seen)
+
+    def _respond(self, request, post, seen):
         if post is None:
             logger.debug("Exhausted all posts")
+            if seen:
+                # start over on the next visit
+                del request.session["posts_seen"]
             messages.error(request, "No more posts to view, submit your own!")
             return redirect("submit")
         context = {"post": post}
         context.update(self._session_context(request, post))
-        self._update_seen(request, post)
+        self._update_seen(request, post, seen)
         return render(request, "posts/index.html", context)
 
     def _session_context(self, request, post):
@@ -75,56 +79,55 @@ class Index(View):
             logger.exception("Error trying to construct index context from session")
         return context
 
-    def _update_seen(self, request, post):
-        seen = request.session.setdefault("posts_seen", list())
-        if post.id not in seen:
-            seen.append(post.id)
-        request.session["posts_seen"] = seen
-        request.session.modified = True
+    def _update_seen(self, request, post, seen=None):
+        if seen is None:
+            seen = SeenSet.from_session(request.session.get("posts_seen"))
+        if seen.add(post.id):
+            encoded = seen.encode()
+            if len(encoded) > SEEN_MAX_LENGTH:
+                # start over rather than outgrow the session's cache slot
+                encoded = SeenSet([post.id]).encode()
+            request.session["posts_seen"] = encoded
 
-    @classmethod
-    def _random_post(cls, previous_id=None):
-        post = None
-        if previous_id:
-            post_search = Post.objects.filter(pk=previous_id)
-            if len(post_search) > 0:
-                post = post_search[0]
-        where = ""
-        if post is not None:
-            where = f"AND p.id != {post.id}"
-            logger.debug("filtering previous post: %s", where)
+    @staticmethod
+    def _previous_id(previous_id):
         try:
-            sql = f"""
-                SELECT * 
-                FROM posts_post p
-                LEFT JOIN posts_postapproval a ON p.id = a.post_id
-                WHERE a.approved_at IS NOT NULL
-                {where}
-                LIMIT 1 
-                OFFSET floor(random() * (SELECT count(*)
-                    FROM posts_post p
-                    LEFT JOIN posts_postapproval a ON p.id = a.post_id
-                    WHERE a.approved_at IS NOT NULL
-                    {where}
-                ));
-                """
-            return Post.objects.raw(sql)[0]
-        except IndexError as e:
-            logger.exception("could not get random post")
+            return int(previous_id) if previous_id else None
+        except ValueError:
             return None
 
+    @classmethod
+    def _random_post(cls, previous_id=None, seen=None):
+        previous_id = cls._previous_id(previous_id)
+        if settings.RANDOM_FEED:
+            post = feed.draw(exclude=previous_id, seen=seen)
+            if post is not None:
+                return post
+        # the id list may briefly lag behind deletes, so retry on a miss
+        for _ in range(3):
+            if seen is None:
+                post_id = catalog.random_post_id(exclude=previous_id)
+            else:
+                post_id = catalog.random_unseen_post_id(seen, exclude=previous_id)
+            if post_id is None:
+                break
+            post = Post.objects.filter(pk=post_id).first()
+            if post is not None:
+                return post
+            catalog.invalidate_approved_posts()
+        logger.info("could not get random post")
+        return None
+
 
 index = Index.as_view()
 
 
 class SubmissionView(View):
-    @method_decorator(limit)
     def get(self, request):
         """The submission form."""
         context = {"submission": True}
         return render(request, "posts/submit.html", context)
 
-    @method_decorator(limit)
     def post(self, request, **kwargs):
         """Submit some code."""
         try:
@@ -136,16 +139,20 @@ class SubmissionView(View):
         if title is None or code is None:
             logger.error("Submission missing title [%s] or code [%s]", title, code)
             return HttpResponseBadRequest("must submit code and title!")
-        err, msg = parse_errors(code)
+        err, msg, code_hash = validator.parse(code)
         if err:
+            metrics.submissions.inc(kind="post", result="invalid")
             return JsonResponse({"message": msg, "errors": err})
-        post = Post.new(title, code)
-        unapproved = PostApproval(post=post)
+        try:
+            post = Post.new(title, code, code_hash=code_hash)
+        except DuplicateError:
+            logger.info("Rejected duplicate submission %s", code_hash)
+            metrics.submissions.inc(kind="post", result="duplicate")
+            return JsonResponse({"message": "That code has already been submitted!", "errors": []})
         if post is None:
             return HttpResponseBadRequest("Unable to save your submission!")
         else:
-            post.save()
-            unapproved.save()
+            metrics.submissions.inc(kind="post", result="accepted")
             self._update_session(request, post)
             messages.success(request, "Submitted successfully! A moderator will approve your post shortly.")
             return redirect("index")
@@ -158,24 +165,7 @@ class SubmissionView(View):
         request.session.modified = True
 
 
-def parse_errors(code):
-    if not (code and code.strip()):
-        return True, "Submission must not be empty"
-    try:
-        ast.parse(code)
-    except SyntaxError as e:
-        logger.exception("Could not parse invalid python: %s", code)
-        return [
-            {
-                "lineNum": e.lineno,
-                "reason": e.msg,
-            },
-        ], "Code must be valid python. Please try again."
-    return None, None
-
-
 class SuggestionView(View):
-    @method_decorator(limit)
     def get(self, request, post_id, **kwargs):
         """The suggestion form."""
         post = get_object_or_404(Post, pk=post_id) 
@@ -186,7 +176,7 @@ class SuggestionView(View):
         return render(request, "posts/suggest.html", context)
     
     def _already_suggested(self, request, post_id):
-        existing = request.session.setdefault("suggestions", dict())
+        existing = request.session.get("suggestions", dict())
         logger.debug("Existing suggestions %s", existing)
         if str(post_id) in existing:
             logger.info("Session cannot submit another suggestion")
@@ -196,7 +186,6 @@ class SuggestionView(View):
             return True
         return False
 
-    @method_decorator(limit)
     def post(self, request, post_id, **kwargs):
         """Submit the suggestion."""
         post = get_object_or_404(Post, pk=post_id)
@@ -209,13 +198,18 @@ class SuggestionView(View):
         code, summary = body.get("code"), body.get("summary")
         if code is None or summary is None:
             return HttpResponseBadRequest("must include code and summary")
-        err, msg = parse_errors(code)
+        err, msg, code_hash = validator.parse(code)
         if err:
+            metrics.submissions.inc(kind="suggestion", result="invalid")
             return JsonResponse({"message": msg, "errors": err})
-        suggestion = Suggestion.new(post.id, code, summary)
-        unapproved_suggestion = SuggestionApproval(suggestion=suggestion)
+        try:
+            suggestion = Suggestion.new(post, code, summary, code_hash=code_hash)
+        except DuplicateError:
+            logger.info("Rejected duplicate suggestion %s for post %s", code_hash, post.id)
+            metrics.submissions.inc(kind="suggestion", result="duplicate")
+            return JsonResponse({"message": "That suggestion has already been made!", "errors": []})
         suggestion.save()
-        unapproved_suggestion.save()
+        metrics.submissions.inc(kind="suggestion", result="accepted")
         self._update_session(request, post, suggestion)
         return redirect("index")
 
@@ -230,38 +224,36 @@ class PostSuggestionView(View):
     def get(self, request, post_id):
         """View suggestions."""
         post = get_object_or_404(Post, pk=post_id)
-        suggestion_id = request.GET.get("s")
-        approved_suggestions = SuggestionApproval.objects.exclude(
-            approved_at=None).values('suggestion_id')
-        query = Suggestion.objects.filter(pk__in=approved_suggestions.all())
+        ids = catalog.approved_suggestion_ids(post.id)
+        try:
+            current_id, next_id = self._current_and_next(ids, request.GET.get("s"))
+        except LookupError:
+            return HttpResponseNotFound()
+        suggestions = {}
+        if current_id is not None:
+            suggestions = Suggestion.objects.in_bulk({current_id, next_id})
+        return self._render(
+            request, post, suggestions.get(current_id), suggestions.get(next_id))
+
+    @staticmethod
+    def _current_and_next(ids, suggestion_id):
+        """The ids of the suggestion to show and of the next one, or Nones
+        without suggestions; raises LookupError for an unknown suggestion."""
         if suggestion_id:
-            suggestion = (query
-                .filter(post__id=post_id, pk=suggestion_id)
-                .first()
-            )
-            if not suggestion:
-                return HttpResponseNotFound()
-            next_suggestion = query.filter(post__id=post_id, id__gt=suggestion_id).order_by('id').first()
-        else:
-            suggestions = (
-                query
-                    .filter(post__id=post_id)
-                    .order_by('id')
-                    .iterator()
-            )
             try:
-                suggestion = next(suggestions)
-            except:
-                suggestion = None
-            if suggestion:
-                try:
-                    next_suggestion = next(suggestions)
-                except:
-                    next_suggestion = None
-            else:
-                next_suggestion = None
-        if not next_suggestion:
-            next_suggestion = query.filter(post__id=post_id).order_by('id').first()
+                i = bisect.bisect_left(ids, int(suggestion_id))
+            except ValueError:
+                raise LookupError(suggestion_id)
+            if i == len(ids) or ids[i] != int(suggestion_id):
+                raise LookupError(suggestion_id)
+        else:
+            i = 0
+        if not ids:
+            return None, None
+        # the last suggestion wraps around to the first
+        return ids[i], ids[(i + 1) % len(ids)]
+
+    def _render(self, request, post, suggestion, next_suggestion):
         if suggestion:
             no_suggestions = False
         else:
@@ -279,77 +271,146 @@ class PostSuggestionDetailView(View):
         """View a specific suggestion."""
         post = get_object_or_404(Post, pk=post_id)
         suggestion = get_object_or_404(Suggestion, pk=suggestion_id)
+        return self._render(request, post, suggestion)
+
+    def _render(self, request, post, suggestion):
         context = {
             "post": post,
-            "suggestions": suggestion
+            "suggestion": suggestion
         }
         return render(request, "posts/suggestion_detail.html", context)
 
 
 class VoteView(View):
-    @method_decorator(limit)
     def post(self, request, post_id, **kwargs):
+        vote_field, error = self._read_vote(request)
+        if error:
+            return error
+        if settings.VOTE_BUFFER:
+            return self._buffered_vote(request, post_id, vote_field)
         post = get_object_or_404(Post, pk=post_id)
+        vote, previous = self._apply_vote(post, self._existing_vote(request, post), vote_field)
+        self._save_vote(post, vote, previous)
+        metrics.votes.inc(buffered="false")
+        self._update_session(request, post, {"id": vote.id, "is_bad": vote.is_bad})
+        counts = post.get_current_vote_counts()
+        return self._vote_response(vote.id, counts['is_bad'], counts['not_bad'])
+
+    def _read_vote(self, request):
+        """The vote in the request body, and an error response if it has none."""
         try:
             body = json.loads(request.body)
         except:
-            return HttpResponseBadRequest("could not parse body!")
+            return None, HttpResponseBadRequest("could not parse body!")
         is_bad = body.get("isBad")
         if is_bad is None or not isinstance(is_bad, bool):
-            return HttpResponseBadRequest("isBad must be one of 'true' or 'false'")
-        vote_field = VoteField.from_is_bad(is_bad)
-        existing_vote = self._existing_vote(request, post)
+            return None, HttpResponseBadRequest("isBad must be one of 'true' or 'false'")
+        return VoteField.from_is_bad(is_bad), None
+
+    def _apply_vote(self, post, existing_vote, vote_field):
+        """The vote to save, and the choice it replaces if it was cast before."""
         if existing_vote:
             logger.info("Updating existing vote %s", existing_vote.id)
+            previous = existing_vote.is_bad
             existing_vote.is_bad = vote_field
-            vote = existing_vote
-        else:
-            logger.info("Creating new vote %s", vote_field)
-            vote = Vote.new(post_id=post.id, is_bad=vote_field)
-        if vote is None:
-            return HttpResponse(status=500)
-        else:
-            vote.save()
-            self._update_session(request, post, vote)
-            counts = post.get_current_vote_counts()
-            print(counts)
-            return JsonResponse(
-                {
-                    "vote": {
-                        "id": vote.id,
-                    },
-                    "currentVoteCounts": {
-                        "bad": counts['is_bad'],
-                        "notBad": counts['not_bad'],
-                    }
+            return existing_vote, previous
+        logger.info("Creating new vote %s", vote_field)
+        return Vote.new(post, is_bad=vote_field), None
+
+    @staticmethod
+    def _save_vote(post, vote, previous):
+        with transaction.atomic():
+            if previous is None:
+                vote.save()
+            elif not Vote.objects.filter(pk=vote.id, is_bad=previous).update(is_bad=vote.is_bad):
+                # another request changed it first, and counted the change
+                logger.info("Vote %s was already changed", vote.id)
+                return
+            Post.count_vote(post.id, vote.is_bad, previous=previous)
+
+    def _buffered_vote(self, request, post_id, vote_field):
+        """Queue the vote for a batched write and answer with optimistic counts."""
+        post = get_object_or_404(
+            Post.objects.only("bad_votes", "not_bad_votes"), pk=post_id)
+        previous = request.session.get("votes", dict()).get(str(post.id))
+        vote = vote_buffer.cast(post.id, vote_field, previous)
+        metrics.votes.inc(buffered="true")
+        bad, not_bad = vote_buffer.pending_counts(post.id)
+        self._update_session(request, post, vote)
+        return self._vote_response(
+            vote["id"], post.bad_votes + bad, post.not_bad_votes + not_bad)
+
+    def _vote_response(self, vote_id, bad, not_bad):
+        return JsonResponse(
+            {
+                "vote": {
+                    "id": vote_id,
+                },
+                "currentVoteCounts": {
+                    "bad": bad,
+                    "notBad": not_bad,
                 }
-            )
-    
+            }
+        )
+
     def _existing_vote(self, request, post):
+        vote_id = self._existing_vote_id(request, post)
+        if vote_id:
+            try:
+                return Vote.objects.get(pk=vote_id)
+            except Exception as e:
+                logger.exception("Could not get existing vote for id %s", vote_id)
+        return None
+
+    def _existing_vote_id(self, request, post):
         try:
-            votes = request.session.setdefault("votes", dict())
+            votes = request.session.get("votes", dict())
             logger.debug("session votes: %s", votes)
             vote = votes.get(str(post.id), {})
             logger.debug("session vote for %s: %s", post.id, vote)
             vote_id = vote.get("id")
             logger.debug("vote id: %s", vote_id)
-            if vote_id:
-                try:
-                    vote = Vote.objects.get(pk=vote_id)
-                except Exception as e:
-                    logger.exception("Could not get existing vote for id %s", vote_id)
-                    return None
-                return vote
-            return None
+            return vote_id
         except Exception as e:
             logger.exception("Failed trying to look up existing vote")
         return None
 
     def _update_session(self, request, post, vote):
         votes = request.session.setdefault("votes", dict())
-        votes[post.id] = {
-            "id": vote.id,
-            "is_bad": vote.is_bad
-        }
+        votes[post.id] = vote
         request.session["votes"] = votes
         request.session.modified = True
+
+
+class ValidationStatsView(View):
+    def get(self, request):
+        """Code validation latency for this worker, for staff only."""
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        return JsonResponse(validator.stats())
+
+
+class ProfileStatsView(View):
+    def get(self, request):
+        """Per-view request and query statistics for this worker, for staff only."""
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        return JsonResponse(profiler.stats())
+
+
+class DatabasePoolStatsView(View):
+    def get(self, request):
+        """Database connection pools of this worker, for staff only."""
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        return JsonResponse(db_pool.stats())
+
+
+class MetricsView(View):
+    def get(self, request):
+        """Metrics of every worker process, in the Prometheus text format."""
+        token = settings.METRICS_TOKEN
+        if token and request.headers.get("Authorization") != "Bearer %s" % token:
+            return HttpResponseForbidden()
+        return HttpResponse(
+            metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,185 @@
+from collections import defaultdict
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import (
+    IntegrityError, InterfaceError, OperationalError, connections, models, transaction)
+
+from . import metrics
+from .models import Post, Vote
+
+
+logger = logging.getLogger("posts.vote_buffer")
+
+
+# maps the token handed out for a buffered vote to its id once flushed
+TOKEN_KEY = "votes:token:%s"
+TOKEN_TIMEOUT = 60 * 60 * 24
+
+
+class VoteBuffer:
+    """Collects votes in memory and writes them in batches.
+
+    Each worker process holds one buffer. New votes are created with
+    ``bulk_create``, changed votes with ``bulk_update``, and the per-post
+    counters with one F() update per post, all in a single transaction.
+    A new vote has no id until it is flushed, so the session keeps a token
+    for it instead, which resolves to the id afterwards.
+    """
+
+    def __init__(self, flush_interval=1.0, max_pending=500):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self._new = {}
+        self._changed = {}
+        self._deltas = defaultdict(lambda: [0, 0])
+
+    def cast(self, post_id, is_bad, previous=None):
+        """Buffer a vote, returning the session entry to store for it.
+
+        `previous` is the session entry of this session's earlier vote on
+        the post, if any.
+        """
+        previous = previous or {}
+        vote_id, token = previous.get("id"), previous.get("token")
+        if vote_id is None and token:
+            vote_id = cache.get(TOKEN_KEY % token)
+        with self._lock:
+            if vote_id is None and token in self._new:
+                vote = self._new[token]
+                self._count(post_id, is_bad, vote.is_bad)
+                vote.is_bad = is_bad
+            elif vote_id is not None:
+                self._changed[vote_id] = Vote(id=vote_id, post_id=post_id, is_bad=is_bad)
+                self._count(post_id, is_bad, previous.get("is_bad"))
+                token = None
+            else:
+                if token:
+                    logger.info("Could not resolve buffered vote %s, casting a new one", token)
+                token = uuid.uuid4().hex
+                self._new[token] = Vote.new(post_id, is_bad)
+                self._count(post_id, is_bad)
+            pending = len(self._new) + len(self._changed)
+        self._start()
+        if pending >= self.max_pending:
+            self._wake.set()
+        return {"id": vote_id, "token": token, "is_bad": is_bad}
+
+    def _count(self, post_id, is_bad, previous=None):
+        if previous == is_bad:
+            return
+        delta = self._deltas[post_id]
+        delta[0 if is_bad else 1] += 1
+        if previous is not None:
+            delta[1 if is_bad else 0] -= 1
+
+    def pending_counts(self, post_id):
+        """The (bad, not bad) votes buffered but not yet written for a post."""
+        with self._lock:
+            delta = self._deltas.get(post_id, (0, 0))
+            return delta[0], delta[1]
+
+    def flush(self):
+        with self._lock:
+            new, changed, deltas = self._new, self._changed, self._deltas
+            self._reset()
+        if not (new or changed or deltas):
+            return
+        try:
+            try:
+                self._write(new, changed, deltas)
+            except IntegrityError:
+                # retrying votes for a deleted post would fail for good
+                new, changed, deltas = self._drop_deleted_posts(new, changed, deltas)
+                self._write(new, changed, deltas)
+        except (OperationalError, InterfaceError):
+            logger.exception("Failed to flush %s buffered votes, will retry", len(new) + len(changed))
+            self._requeue(new, changed, deltas)
+            return
+        except IntegrityError:
+            logger.exception("Dropped %s buffered votes that could not be written",
+                             len(new) + len(changed))
+            metrics.votes_dropped.inc(len(new) + len(changed))
+            return
+        cache.set_many(
+            {TOKEN_KEY % token: vote.id for token, vote in new.items()},
+            TOKEN_TIMEOUT,
+        )
+        metrics.votes_flushed.inc(len(new) + len(changed))
+        logger.info("Flushed %s new and %s changed votes", len(new), len(changed))
+
+    def _write(self, new, changed, deltas):
+        with transaction.atomic():
+            Vote.objects.bulk_create(new.values())
+            Vote.objects.bulk_update(changed.values(), ["is_bad"])
+            for post_id, (bad, not_bad) in deltas.items():
+                if bad or not_bad:
+                    Post.objects.filter(pk=post_id).update(
+                        bad_votes=models.F("bad_votes") + bad,
+                        not_bad_votes=models.F("not_bad_votes") + not_bad,
+                    )
+
+    def _drop_deleted_posts(self, new, changed, deltas):
+        """The votes and deltas whose posts still exist."""
+        post_ids = set(deltas)
+        post_ids.update(vote.post_id for vote in new.values())
+        post_ids.update(vote.post_id for vote in changed.values())
+        existing = set(Post.objects.filter(pk__in=post_ids).values_list("pk", flat=True))
+        kept_new = {token: vote for token, vote in new.items() if vote.post_id in existing}
+        kept_changed = {
+            vote_id: vote for vote_id, vote in changed.items() if vote.post_id in existing}
+        dropped = len(new) + len(changed) - len(kept_new) - len(kept_changed)
+        if dropped:
+            logger.warning("Dropped %s buffered votes for deleted posts %s",
+                           dropped, sorted(post_ids - existing))
+            metrics.votes_dropped.inc(dropped)
+        kept_deltas = defaultdict(lambda: [0, 0])
+        kept_deltas.update(
+            (post_id, delta) for post_id, delta in deltas.items() if post_id in existing)
+        return kept_new, kept_changed, kept_deltas
+
+    def _requeue(self, new, changed, deltas):
+        with self._lock:
+            new.update(self._new)
+            self._new = new
+            changed.update(self._changed)
+            self._changed = changed
+            for post_id, (bad, not_bad) in self._deltas.items():
+                deltas[post_id][0] += bad
+                deltas[post_id][1] += not_bad
+            self._deltas = deltas
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="vote-buffer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Unexpected error flushing votes")
+            finally:
+                connections.close_all()
+
+
+vote_buffer = VoteBuffer(
+    flush_interval=settings.VOTE_BUFFER_FLUSH_INTERVAL,
+    max_pending=settings.VOTE_BUFFER_MAX_PENDING,
+)